@@ -17,14 +17,25 @@ try:
     import cElementTree as etree
 except ImportError:
     try:
-        import xml.etree.ElementTree as etree
+        import xml.etree.cElementTree as etree
     except ImportError:
-        from elementtree import ElementTree as etree
+        try:
+            import xml.etree.ElementTree as etree
+        except ImportError:
+            from elementtree import ElementTree as etree
 
+import os
 import re
 import types
 import inspect
 import logging
+import cPickle
+import tempfile
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from springpython.context import scope
 from decorator import decorator, partial
@@ -172,6 +183,16 @@ class ValueDef(object):
         through and pre-fetching items."""
         pass
 
+    def __getstate__(self):
+        """Loggers can't be pickled, see SnapshotConfig."""
+        state = self.__dict__.copy()
+        del state["logger"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger("springpython.config.%s" % self.__class__.__name__)
+
     def __str__(self):
         return "name=%s value=%s" % (self.name, self.value)
 
@@ -195,7 +216,7 @@ class ListDef(ValueDef):
 
     def _replace_refs_with_actuals(self, obj, container):
         for i in range(0, len(self.value)):
-            self.logger.debug("Checking out %s, wondering if I need to do any replacement..." % str(self.value[i]))
+            self.logger.debug("Checking out %s, wondering if I need to do any replacement...", self.value[i])
             if hasattr(self.value[i], "ref"):
                 self.value[i] = container.get_object(self.value[i].ref)
             else:
@@ -228,27 +249,27 @@ class SetDef(ValueDef):
 
     def _replace_refs_with_actuals(self, obj, container):
         self.logger.debug("Replacing refs with actuals...")
-        self.logger.debug("set before changes = %s" % self.value)
+        self.logger.debug("set before changes = %s", self.value)
         new_set = set()
         for item in self.value:
             if hasattr(item, "ref"):
-                self.logger.debug("Item !!!%s!!! is a ref, trying to replace with actual object !!!%s!!!" % (item, item.ref))
+                self.logger.debug("Item !!!%s!!! is a ref, trying to replace with actual object !!!%s!!!", item, item.ref)
                 #self.value.remove(item)
                 #self.value.add(container.get_object(item.ref))
                 newly_fetched_value = container.get_object(item.ref)
                 new_set.add(newly_fetched_value)
-                self.logger.debug("Item !!!%s!!! was removed, and newly fetched value !!!%s!!! was added." % (item, newly_fetched_value))
+                self.logger.debug("Item !!!%s!!! was removed, and newly fetched value !!!%s!!! was added.", item, newly_fetched_value)
                 #new_set.add(container.get_object(item.ref))
             else:
-                self.logger.debug("Item !!!%s!!! is NOT a ref, trying to replace with scanned value" % str(item))
+                self.logger.debug("Item !!!%s!!! is NOT a ref, trying to replace with scanned value", item)
                 #self.value.remove(item)
                 #self.value.add(self.scan_value(container, item))
                 newly_scanned_value = self.scan_value(container, item)
                 new_set.add(newly_scanned_value)
-                self.logger.debug("Item !!!%s!!! was removed, and newly scanned value !!!%s!!! was added." % (item, newly_scanned_value))
+                self.logger.debug("Item !!!%s!!! was removed, and newly scanned value !!!%s!!! was added.", item, newly_scanned_value)
                 #new_set.add(self.scan_value(container, item))
         #self.value = new_set
-        self.logger.debug("set after changes = %s" % new_set)
+        self.logger.debug("set after changes = %s", new_set)
         #return self.value
         try:
             setattr(obj, self.name, new_set)
@@ -264,31 +285,31 @@ class FrozenSetDef(ValueDef):
 
     def _replace_refs_with_actuals(self, obj, container):
         self.logger.debug("Replacing refs with actuals...")
-        self.logger.debug("set before changes = %s" % self.value)
+        self.logger.debug("set before changes = %s", self.value)
         new_set = set()
         for item in self.value:
             if hasattr(item, "ref"):
-                self.logger.debug("Item <<<%s>>> is a ref, trying to replace with actual object <<<%s>>>" % (item, item.ref))
+                self.logger.debug("Item <<<%s>>> is a ref, trying to replace with actual object <<<%s>>>", item, item.ref)
                 #new_set.remove(item)
                 #debug begin
                 newly_fetched_value = container.get_object(item.ref)
                 new_set.add(newly_fetched_value)
-                self.logger.debug("Item <<<%s>>> was removed, and newly fetched value <<<%s>>> was added." % (item, newly_fetched_value))
+                self.logger.debug("Item <<<%s>>> was removed, and newly fetched value <<<%s>>> was added.", item, newly_fetched_value)
                 #debug end
                 #new_set.add(container.get_object(item.ref))
             else:
-                self.logger.debug("Item <<<%s>>> is NOT a ref, trying to replace with scanned value" % str(item))
+                self.logger.debug("Item <<<%s>>> is NOT a ref, trying to replace with scanned value", item)
                 #new_set.remove(item)
                 #debug begin
                 newly_scanned_value = self.scan_value(container, item)
                 new_set.add(newly_scanned_value)
-                self.logger.debug("Item <<<%s>>> was removed, and newly scanned value <<<%s>>> was added." % (item, newly_scanned_value))
+                self.logger.debug("Item <<<%s>>> was removed, and newly scanned value <<<%s>>> was added.", item, newly_scanned_value)
                 #debug end
                 #new_set.add(self.scan_value(container, item))
         #self.logger.debug("Newly built set = %s" % new_set)
         #self.value = frozenset(new_set)
         new_frozen_set = frozenset(new_set)
-        self.logger.debug("set after changes = %s" % new_frozen_set)
+        self.logger.debug("set after changes = %s", new_frozen_set)
         #return self.value
         try:
             setattr(obj, self.name, new_frozen_set)
@@ -306,6 +327,119 @@ class Config(object):
         """Abstract method definition - should return an array of Object objects"""
         raise NotImplementedError()
 
+class SnapshotConfig(Config):
+    """
+    SnapshotConfig wraps a Config that reads files, like XMLConfig or YamlConfig, and keeps the
+    object definitions it reads as a pickled snapshot in cache_dir. As long as the files are the
+    same, later reads load the snapshot instead of parsing them again, which makes the startup of
+    large contexts, and of many worker processes, faster.
+
+    A file is the same if its modification time and size haven't changed, or failing that, if its
+    content hashes to the same value. Anything else, including a snapshot written by another version
+    of this class, leads to parsing the files and writing a new snapshot.
+
+    NOTE: Loading a snapshot unpickles it, so cache_dir must not be writable by anyone untrusted.
+    It defaults to ~/.springpython/snapshots.
+    """
+    VERSION = 1
+
+    def __init__(self, config, cache_dir = None):
+        self.config = config
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".springpython", "snapshots")
+        self.cache_dir = cache_dir
+        self.logger = logging.getLogger("springpython.config.SnapshotConfig")
+
+    def read_object_defs(self):
+        locations = getattr(self.config, "config_location", None)
+        if not locations or [location for location in locations if not isinstance(location, basestring)]:
+            self.logger.debug("%s doesn't read from files, it can't be snapshot" % self.config)
+            return self.config.read_object_defs()
+
+        locations = [os.path.abspath(location) for location in locations]
+        key = "%s.%s %s" % (self.config.__class__.__module__, self.config.__class__.__name__, locations)
+        path = os.path.join(self.cache_dir, sha1(key).hexdigest() + ".snapshot")
+
+        object_defs = self._load(path, key, locations)
+        if object_defs is not None:
+            self.logger.debug("Loaded the object definitions of %s from %s" % (locations, path))
+            return object_defs
+
+        # The files are stamped before they are parsed, so a change in between shows up next time.
+        stamps = [self._stamp(location) for location in locations]
+        object_defs = self.config.read_object_defs()
+        try:
+            self._save(path, key, stamps, object_defs)
+        except Exception, e:
+            self.logger.warning("Could not write snapshot %s: %s" % (path, e))
+        return object_defs
+
+    def _load(self, path, key, locations):
+        try:
+            snapshot = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                version, snapshot_key, stamps, object_defs = cPickle.load(snapshot)
+            except Exception, e:
+                self.logger.debug("Ignoring unreadable snapshot %s: %s" % (path, e))
+                return None
+        finally:
+            snapshot.close()
+
+        if version != self.VERSION or snapshot_key != key:
+            return None
+        touched = False
+        for i, (location, mtime, size, digest) in enumerate(stamps):
+            try:
+                stat = os.stat(location)
+            except OSError:
+                return None
+            if stat.st_mtime == mtime and stat.st_size == size:
+                continue
+            if stat.st_size != size or self._stamp(location)[3] != digest:
+                self.logger.debug("%s has changed since snapshot %s was taken" % (location, path))
+                return None
+            stamps[i] = (location, stat.st_mtime, size, digest)
+            touched = True
+
+        if touched:
+            # Only modification times moved, keep the next check cheap.
+            try:
+                self._save(path, key, stamps, object_defs)
+            except Exception, e:
+                self.logger.debug("Could not update snapshot %s: %s" % (path, e))
+        return object_defs
+
+    def _save(self, path, key, stamps, object_defs):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0700)
+        # Write to a file of our own, then move it in place, so readers never see half a snapshot.
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            snapshot = os.fdopen(fd, "wb")
+            try:
+                cPickle.dump((self.VERSION, key, stamps, object_defs), snapshot, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                snapshot.close()
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _stamp(self, location):
+        stat = os.stat(location)
+        source = open(location, "rb")
+        try:
+            digest = sha1(source.read()).hexdigest()
+        finally:
+            source.close()
+        return (location, stat.st_mtime, stat.st_size, digest)
+
 class PyContainerConfig(Config):
     """
     PyContainerConfig supports the legacy XML dialect (PyContainer) of reading object definitions.
@@ -462,6 +596,9 @@ class SpringJavaConfig(Config):
 class XMLConfig(Config):
     """
     XMLConfig supports current Spring Python format of XML object definitions.
+
+    Files are converted while they are parsed, one top-level object at a time, so very large
+    ones don't have to fit in memory as a whole.
     """
 
     NS = "{http://www.springframework.org/springpython/schema/objects}"
@@ -484,42 +621,95 @@ class XMLConfig(Config):
         self.objects = []
         for config in self.config_location:
             self.logger.debug("* Parsing %s" % config)
+            self._read_objects(config)
 
-            # A flat list of objects, as found in the XML document.
-            objects = etree.parse(config).getroot()
-
-            # We need to handle both 1.0 and 1.1 XSD schemata *and* we may be
-            # passed a list of config locations of different XSD versions so we
-            # must find out here which one is used in the current config file
-            # and pass the correct namespace down to other parts of XMLConfig.
-            ns = objects.tag[:objects.tag.find("}") + 1]
+        self.logger.debug("==============================================================")
+        for object in self.objects:
+            self.logger.debug("Parsed %s" % object)
+        return self.objects
 
-            # A dictionary of abstract objects, keyed by their IDs, used in
-            # traversing the hierarchies of parents; built upfront here for
-            # convenience.
-            abstract_objects = {}
-            for obj in objects:
-                if obj.get("abstract"):
-                    abstract_objects[obj.get("id")] = obj
+    def _read_objects(self, config):
+        """ Converts the objects of a config file while it is being parsed. Each
+        top-level element is turned into an object definition as soon as it's
+        complete and then thrown away, so only the largest one is ever held in
+        memory, along with the abstract objects their children need. A child
+        coming before one of its parents is put off until the end of the file,
+        keeping its place in the list of objects.
+        """
 
-            for obj in objects:
-                if obj.get("class") is None and not obj.get("parent"):
-                    self._map_custom_class(obj, xml_mappings, ns)
+        # A dictionary of abstract objects, keyed by their IDs, used in
+        # traversing the hierarchies of parents.
+        abstract_objects = {}
+        deferred = []
+        root = None
+        depth = 0
+
+        for event, obj in etree.iterparse(config, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = obj
+
+                    # We need to handle both 1.0 and 1.1 XSD schemata *and* we may be
+                    # passed a list of config locations of different XSD versions so we
+                    # must find out here which one is used in the current config file
+                    # and pass the correct namespace down to other parts of XMLConfig.
+                    ns = root.tag[:root.tag.find("}") + 1]
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if obj.get("abstract"):
+                abstract_objects[obj.get("id")] = obj
+
+            if obj.get("parent") and not self._has_parents(obj, abstract_objects):
+                deferred.append((len(self.objects), obj))
+                self.objects.append(None)
+                continue
+
+            self._read_object(obj, ns, abstract_objects)
+            if not obj.get("abstract"):
+                root.remove(obj)
+
+        # Fill in the children whose parents came after them, last one first so
+        # that the places of the others don't move.
+        for index, obj in reversed(deferred):
+            objects, self.objects = self.objects, []
+            try:
+                self._read_object(obj, ns, abstract_objects)
+            finally:
+                converted, self.objects = self.objects, objects
+            self.objects[index:index + 1] = converted
+
+    def _has_parents(self, obj, abstract_objects):
+        """ Tells whether all parents of an object have been read already.
+        """
+        seen = set()
+        parent = obj.get("parent")
+        while parent and parent not in seen:
+            if parent not in abstract_objects:
+                return False
+            seen.add(parent)
+            parent = abstract_objects[parent].get("parent")
+        return True
 
-                elif obj.get("parent"):
-                    # Children are added to self.objects during the children->abstract parents traversal.
-                    pos_constr = self._get_pos_constr(obj, ns)
-                    named_constr = self._get_named_constr(obj, ns)
-                    props = self._get_props(obj, ns)
-                    self._traverse_parents(obj, obj, ns, pos_constr, named_constr, props, abstract_objects)
-                    continue
+    def _read_object(self, obj, ns, abstract_objects):
+        """ Converts a single top-level element into an object definition.
+        """
+        if obj.get("class") is None and not obj.get("parent"):
+            self._map_custom_class(obj, xml_mappings, ns)
 
-                self.objects.append(self._convert_object(obj, ns=ns))
+        elif obj.get("parent"):
+            # Children are added to self.objects during the children->abstract parents traversal.
+            pos_constr = self._get_pos_constr(obj, ns)
+            named_constr = self._get_named_constr(obj, ns)
+            props = self._get_props(obj, ns)
+            self._traverse_parents(obj, obj, ns, pos_constr, named_constr, props, abstract_objects)
+            return
 
-        self.logger.debug("==============================================================")
-        for object in self.objects:
-            self.logger.debug("Parsed %s" % object)
-        return self.objects
+        self.objects.append(self._convert_object(obj, ns=ns))
 
     def _map_custom_class(self, obj, mappings, ns):
         """ Fill in the missing attributes of Python objects and make it look
@@ -1363,6 +1553,9 @@ def Object(theScope=scope.SINGLETON, lazy_init=False, abstract=False, parent=Non
     elif theScope == scope.PROTOTYPE:
         log_func_name = "objectPrototype"
 
+    elif scope.is_known(theScope):
+        log_func_name = "objectScoped"
+
     else:
         raise InvalidObjectScope("Don't know how to handle scope %s" % theScope)
 
@@ -15,7 +15,51 @@
 """
 
 import logging
+import threading
+import time
+from traceback import format_exc
 from springpython.context import scope
+from springpython.context.profiling import StartupProfile
+
+class CreationPlan(object):
+    """
+    Everything _create_object needs to know about an ObjectDef, worked out once: which constructor
+    arguments and properties take part, and the bound methods that fetch and set them. Creating an
+    object is then a walk down a few flat lists, instead of re-inspecting the definition each time.
+    """
+    def __init__(self, object_def):
+        self.object_def = object_def
+        self.scope = object_def.scope
+        self.abstract = object_def.abstract
+        self.create_object = object_def.factory.create_object
+        self.prefetches = [constr.prefetch for constr in object_def.pos_constr if hasattr(constr, "prefetch")] + \
+                          [constr.prefetch for constr in object_def.named_constr.values() if hasattr(constr, "prefetch")] + \
+                          [prop.prefetch for prop in object_def.props if hasattr(prop, "prefetch")]
+        self.pos_constr = [constr.get_value for constr in object_def.pos_constr if hasattr(constr, "get_value")]
+        self.named_constr = [(key, constr.get_value) for (key, constr) in object_def.named_constr.items()
+                             if hasattr(constr, "get_value")]
+        self.setters = [prop.set_value for prop in object_def.props if hasattr(prop, "set_value")]
+
+    def create(self, container):
+        for prefetch in self.prefetches:
+            prefetch(container)
+
+        # Res up an instance of the object, with ONLY constructor-based properties set.
+        obj = self.create_object(tuple([get_value(container) for get_value in self.pos_constr]),
+                                 dict([(key, get_value(container)) for (key, get_value) in self.named_constr]))
+
+        # Fill in the other property values.
+        for set_value in self.setters:
+            set_value(obj, container)
+        return obj
+
+class _Creation(object):
+    """A singleton being created by one thread. Other threads wanting it wait on its lock."""
+    def __init__(self, owner, chain):
+        self.owner = owner
+        self.chain = chain
+        self.lock = threading.Lock()
+        self.lock.acquire()
 
 class ObjectContainer(object):
     """
@@ -31,9 +75,30 @@ class ObjectContainer(object):
     reach this container, it doesn't matter what their original format was when a object
     instance is needed. NOTE: This explicitly means that one object in one source
     can refer to another object in another source OF ANY FORMAT as a property.
+
+    With thread_safe set, lazy singletons can be fetched from many threads at once: each singleton
+    is created by one thread, while the others wait for it. Fetching a singleton that already exists
+    takes no lock at all. Circular references between objects are reported with a
+    CircularReferenceException, whether or not the container is thread safe.
+
+    With profile set, the time spent reading each config and creating each object is recorded in
+    a StartupProfile, kept as the profile attribute. Otherwise profile is None, and nothing is timed.
+
+    Objects of any scope besides SINGLETON and PROTOTYPE are kept by the Scope registered for it in
+    scopes. THREAD, REQUEST, SESSION and POOLED are there from the start, more can be passed in or
+    added with register_scope. POOLED objects are best fetched with borrow_object.
     """
-    def __init__(self, config = None):
+    def __init__(self, config = None, thread_safe = False, profile = False, scopes = None):
         self.logger = logging.getLogger("springpython.container.ObjectContainer")
+        self.thread_safe = thread_safe
+        self.scopes = {scope.THREAD: scope.ThreadScope(), scope.REQUEST: scope.RequestScope(),
+                       scope.SESSION: scope.SessionScope(), scope.POOLED: scope.PooledScope()}
+        if scopes is not None:
+            self.scopes.update(scopes)
+        if profile:
+            self.profile = StartupProfile()
+        else:
+            self.profile = None
 
         if config is None:
             self.configs = []
@@ -43,56 +108,253 @@ class ObjectContainer(object):
             self.configs = [config]
 
         self.object_defs = {}
+        # The config each definition came from.
+        self._sources = {}
     
         for configuration in self.configs:
             self.logger.debug("=== Scanning configuration %s for object definitions ===" % configuration)
-            for object_def in configuration.read_object_defs():
+            if self.profile is None:
+                object_defs = configuration.read_object_defs()
+            else:
+                start = time.time()
+                object_defs = configuration.read_object_defs()
+                self.profile.record_config(configuration, time.time() - start, len(object_defs))
+            for object_def in object_defs:
                 if object_def.id not in self.object_defs:
                     self.logger.debug("%s object definition does not exist. Adding to list of definitions." % object_def.id)
                 else:
                     self.logger.debug("Overriding previous definition of %s" % object_def.id)
                 self.object_defs[object_def.id] = object_def
+                self._sources[object_def.id] = configuration
 
         self.logger.debug("=== Done reading object definitions. ===")
 
         self.objects = {}
 
+        # Compiled CreationPlans by object name, and the names of abstract objects in the singleton storage.
+        self._plans = {}
+        self._abstract_objects = set()
+
+        # The names each thread is creating, and in thread safe mode, the singletons under creation
+        # along with what each thread is waiting for, guarded by _creation_lock.
+        self._bound = threading.local()
+        self._creation_lock = threading.Lock()
+        self._creations = {}
+        self._waiting = {}
+
+        # An index of the singletons by type, dropped whenever one is stored.
+        self._type_index = None
+
+    def register_scope(self, name, custom_scope):
+        """Have the objects of scope name kept by custom_scope, a Scope."""
+        self.scopes[name] = custom_scope
+
     def get_object(self, name, ignore_abstract=False):
         """
         This function attempts to find the object in the singleton cache. If not found, 
         delegates to _create_object in order to hunt for the definition, and request a
         object factory to generate one.
+
+        Fetching a singleton that exists already costs a single dictionary lookup.
         """
         try:
-            object_def = self.object_defs[name]
-            if object_def.abstract and not ignore_abstract:
-                raise AbstractObjectException("Object [%s] is an abstract one." % name)
-                
-            return self.objects[name]
-            
-        except KeyError, e:
-            self.logger.debug("Did NOT find object '%s' in the singleton storage." % name)
+            obj = self.objects[name]
+        except KeyError:
+            return self._get_uncached_object(name, ignore_abstract)
+        if self._abstract_objects and not ignore_abstract and name in self._abstract_objects:
+            raise AbstractObjectException("Object [%s] is an abstract one." % name)
+        return obj
+
+    def _get_uncached_object(self, name, ignore_abstract):
+        self.logger.debug("Did NOT find object '%s' in the singleton storage.", name)
+        plan = self._get_plan(name)
+        if plan.abstract and not ignore_abstract:
+            raise AbstractObjectException("Object [%s] is an abstract one." % name)
+
+        if plan.scope == scope.SINGLETON:
+            if self.thread_safe:
+                return self._get_singleton(name, plan)
+        elif plan.scope != scope.PROTOTYPE:
+            return self._get_scoped(name, plan)
+        return self._create_and_store(name, plan)
+
+    def _get_scoped(self, name, plan):
+        """Fetch an object from the Scope of its definition, which has it created if need be. The object
+        is destroyed when it leaves the scope, like at shutdown."""
+        custom_scope = self.scopes[plan.scope]
+        return custom_scope.get(name, self._scoped_creator(name, plan, custom_scope))
+
+    def _scoped_creator(self, name, plan, custom_scope):
+        def create():
+            obj = self._create_and_store(name, plan)
+            custom_scope.register_destruction_callback(name, lambda: self._destroy(name, obj))
+            return obj
+        return create
+
+    def borrow_object(self, name, timeout=None):
+        """
+        Borrow an object of a pooled scope, like POOLED, as a Lease. Its object attribute holds the
+        object, which goes back to the pool with release, or at the end of a with block:
+
+            with container.borrow_object("parser") as parser:
+                parser.parse(text)
+
+        timeout is how long to wait for an object to come back when the pool has max_active of them out.
+        """
+        plan = self._get_plan(name)
+        custom_scope = self.scopes.get(plan.scope)
+        if not hasattr(custom_scope, "lease"):
+            raise InvalidObjectScope("Object [%s] is not pooled." % name)
+        if plan.abstract:
+            raise AbstractObjectException("Object [%s] is an abstract one." % name)
+        return custom_scope.lease(name, self._scoped_creator(name, plan, custom_scope), timeout)
+
+    def _destroy(self, obj_name, obj):
+        """Call the destroy_method of a DisposableObject, by default destroy."""
+        from springpython.context import DisposableObject
+
+        if isinstance(obj, DisposableObject):
             try:
-                object_def = self.object_defs[name]
-                if object_def.abstract and not ignore_abstract:
-                    raise AbstractObjectException("Object [%s] is an abstract one." % name)
-                
-                comp = self._create_object(object_def)
-                
-                # Evaluate any scopes, and store appropriately.
-                if self.object_defs[name].scope == scope.SINGLETON:
-                    self.objects[name] = comp
-                    self.logger.debug("Stored object '%s' in container's singleton storage" % name)
-                elif self.object_defs[name].scope == scope.PROTOTYPE:
-                    pass
+                if hasattr(obj, "destroy_method"):
+                    destroy_method_name = getattr(obj, "destroy_method")
                 else:
-                    raise InvalidObjectScope("Don't know how to handle scope %s" % self.object_defs[name].scope)
-                
-                return comp
-            except KeyError, e:
-                self.logger.error("Object '%s' has no definition!" % name)
-                raise e
+                    destroy_method_name = "destroy"
+                        
+                destroy_method = getattr(obj, destroy_method_name)
+                    
+            except Exception, e:
+                self.logger.error("Could not destroy object '%s', exception '%s'" % (obj_name, format_exc()))
+                    
+            else:
+                if callable(destroy_method):
+                    try:
+                        self.logger.debug("About to destroy object '%s'" % obj_name)
+                        destroy_method()
+                        self.logger.debug("Successfully destroyed object '%s'" % obj_name)
+                    except Exception, e:
+                        self.logger.error("Could not destroy object '%s', exception '%s'" % (obj_name, format_exc()))
+                else:
+                    self.logger.error("Could not destroy object '%s', " \
+                        "the 'destroy_method' attribute it defines is not callable, " \
+                        "its type is '%r', value is '%r'" % (obj_name, type(destroy_method), destroy_method))
+
+
+    def _create_and_store(self, name, plan):
+        chain = getattr(self._bound, "chain", None)
+        if chain is None:
+            chain = self._bound.chain = []
+        if name in chain:
+            raise CircularReferenceException(chain[chain.index(name):] + [name])
+
+        chain.append(name)
+        try:
+            comp = self._create_object(plan.object_def, plan)
+        finally:
+            chain.pop()
+
+        # Evaluate any scopes, and store appropriately.
+        if plan.scope == scope.SINGLETON:
+            self.objects[name] = comp
+            self._type_index = None
+            if plan.abstract:
+                self._abstract_objects.add(name)
+            self.logger.debug("Stored object '%s' in container's singleton storage", name)
+        return comp
+
+    def _get_singleton(self, name, plan):
+        """Create a singleton at most once, however many threads ask for it at the same time. The thread
+        that gets to it first creates it, the others wait for it to be done and check again, as creation may
+        have failed. Waiting for a singleton that is itself waiting for the caller is a circular reference."""
+        me = threading.currentThread()
+        while True:
+            self._creation_lock.acquire()
+            try:
+                if name in self.objects:
+                    return self.objects[name]
+                creation = self._creations.get(name)
+                if creation is None:
+                    chain = getattr(self._bound, "chain", None)
+                    if chain is None:
+                        chain = self._bound.chain = []
+                    creation = self._creations[name] = _Creation(me, chain)
+                    break
+                if creation.owner is not me:
+                    self._check_waits(me, name)
+                    self._waiting[me] = name
+            finally:
+                self._creation_lock.release()
+
+            if creation.owner is me:
+                # The creation chain of this very thread loops back to the object.
+                return self._create_and_store(name, plan)
+            self.logger.debug("Waiting for another thread to create '%s'", name)
+            creation.lock.acquire()
+            creation.lock.release()
+            self._creation_lock.acquire()
+            del self._waiting[me]
+            self._creation_lock.release()
+
+        try:
+            return self._create_and_store(name, plan)
+        finally:
+            self._creation_lock.acquire()
+            del self._creations[name]
+            self._creation_lock.release()
+            creation.lock.release()
+
+    def _check_waits(self, me, name):
+        """Follow which thread creates name, what that thread waits for, and so on. Coming back to
+        this thread means no thread can ever go on. Called with _creation_lock held."""
+        chain = list(getattr(self._bound, "chain", []))
+        waited = name
+        while True:
+            creation = self._creations[waited]
+            if creation.owner is me:
+                raise CircularReferenceException(chain[chain.index(waited):] + [waited])
+            chain.append(waited)
+            waited = self._waiting.get(creation.owner)
+            if waited is None:
+                return
+
+    def _get_plan(self, name):
+        """Fetch the CreationPlan of an object, compiling it the first time. Plans are checked against
+        object_defs, so replacing a definition there is picked up."""
+        plan = self._plans.get(name)
+        object_def = self.object_defs.get(name)
+        if plan is not None and plan.object_def is object_def:
+            return plan
+        if object_def is None:
+            self.logger.error("Object '%s' has no definition!" % name)
+            raise KeyError(name)
+        if object_def.scope != scope.SINGLETON and object_def.scope != scope.PROTOTYPE and \
+           object_def.scope not in self.scopes:
+            raise InvalidObjectScope("Don't know how to handle scope %s" % object_def.scope)
+        plan = self._plans[name] = CreationPlan(object_def)
+        self._abstract_objects.discard(name)
+        return plan
             
+    def _dependencies(self, object_def):
+        """The names of the objects object_def refers to, through references, inner objects (inside
+        collections too) and its parent. Objects fetched by code, like the @Object methods of a
+        PythonConfig calling each other, can't be seen from the definition."""
+        names = set()
+        values = list(object_def.pos_constr) + object_def.named_constr.values() + list(object_def.props)
+        while values:
+            value = values.pop()
+            if hasattr(value, "ref"):
+                names.add(value.ref)
+            elif hasattr(value, "inner_comp"):
+                names.add(value.inner_comp.id)
+            elif hasattr(value, "value"):
+                values.append(value.value)
+            elif isinstance(value, dict):
+                values.extend(value.values())
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                values.extend(value)
+        if object_def.parent:
+            names.add(object_def.parent)
+        return names
+
     def _get_constructors_pos(self, object_def):
         """
         This function iterates over the positional constructors, and assembles their values into a list.
@@ -112,26 +374,27 @@ class ObjectContainer(object):
                      if hasattr(kwargs[key], "get_value")])
 
 
-    def _create_object(self, object_def):
+    def _create_object(self, object_def, plan=None):
         """
         If the object isn't stored in any scoped cache, and must instead be created, this method
         takes all the steps to read the object's definition, res it up, and store it in the appropriate
         scoped cache.
         """
-        self.logger.debug("Creating an instance of %s" % object_def)
-        
-        [constr.prefetch(self) for constr in object_def.pos_constr if hasattr(constr, "prefetch")]
-        [constr.prefetch(self) for constr in object_def.named_constr.values() if hasattr(constr, "prefetch")]
-        [prop.prefetch(self) for prop in object_def.props if hasattr(prop, "prefetch")]
-        
-        # Res up an instance of the object, with ONLY constructor-based properties set.
-        obj = object_def.factory.create_object(self._get_constructors_pos(object_def),
-                                               self._get_constructors_kw(object_def.named_constr))
+        self.logger.debug("Creating an instance of %s", object_def)
 
-        # Fill in the other property values.
-        [prop.set_value(obj, self) for prop in object_def.props if hasattr(prop, "set_value")]
-        
-        return obj
+        if plan is None:
+            plan = self._plans.get(object_def.id)
+        if plan is None or plan.object_def is not object_def:
+            plan = CreationPlan(object_def)
+            if self.object_defs.get(object_def.id) is object_def:
+                self._plans[object_def.id] = plan
+        if self.profile is None:
+            return plan.create(self)
+        self.profile.begin_create(object_def.id)
+        try:
+            return plan.create(self)
+        finally:
+            self.profile.end_create()
         
         
 class AbstractObjectException(Exception):
@@ -141,3 +404,11 @@ class AbstractObjectException(Exception):
     
 class InvalidObjectScope(Exception):
     pass
+
+class CircularReferenceException(Exception):
+    """ Raised when creating an object requires the object itself. chain holds
+    the names of the objects involved, in the order they were asked for.
+    """
+    def __init__(self, chain):
+        Exception.__init__(self, "Circular reference between objects: %s" % " -> ".join(chain))
+        self.chain = chain
@@ -15,23 +15,60 @@
 """
 
 import atexit
+import inspect
 import logging
-from traceback import format_exc
+import Queue
+import sys
+import threading
+import time
+import types
 
 from springpython.container import ObjectContainer
+from springpython.context import scope
+from springpython.factory import PythonObjectFactory
 
 class ApplicationContext(ObjectContainer):
     """
     ApplicationContext IS a ObjectContainer. It also has the ability to define the lifecycle of
     objects.
+
+    Objects that aren't lazy are created up front, dependencies first. With startup_workers above one,
+    objects that don't depend on each other are created at the same time by that many threads, which
+    pays off when they open connections or load data. The container is thread safe while they run.
+    The objects of a PythonConfig are still created one after another in the calling thread, as the
+    @Object decorator keeps its state in globals. creation_times holds how long fetching each of these
+    objects took, and get_startup_critical_path tells which chain of dependencies held startup up.
+
+    With profile set, profile holds a StartupProfile telling where the time went while starting,
+    down to each object and post processor.
+
+    Objects of the THREAD, REQUEST and SESSION scopes, or of any other in scopes, are never created up
+    front. Those still in their scope when the context shuts down are destroyed along with the singletons.
+
+    get_dependencies and get_dependents tell which objects refer to which, as far as their definitions
+    tell. On shutdown, objects are destroyed before those they depend on. In a context created with
+    refreshable set, refresh reads configs again, and only replaces the objects affected by what changed
+    in them. It costs a walk through every definition at startup, so it is off by default.
     """
-    def __init__(self, config = None):
-        super(ApplicationContext, self).__init__(config)
+    def __init__(self, config = None, thread_safe = False, startup_workers = 1, profile = False, scopes = None, refreshable = False):
+        super(ApplicationContext, self).__init__(config, thread_safe, profile, scopes)
         
         atexit.register(self.shutdown_hook)
         
         self.logger = logging.getLogger("springpython.context.ApplicationContext")
         self.classnames_to_avoid = set(["PyroProxyFactory", "ProxyFactoryObject"])
+        self.startup_workers = startup_workers
+        self.creation_times = {}
+        self.startup_dependencies = {}
+        self._dependency_graph = {}
+        self._dependents = {}
+        self._graph_defs = {}
+        self._type_index_size = 0
+        self._sync_dependency_graph()
+        # Creating objects changes some definitions, so refresh compares against them as they were read.
+        self._definition_keys = None
+        if refreshable:
+            self._definition_keys = dict([(name, _definition_key(object_def)) for (name, object_def) in self.object_defs.items()])
          
         for object_def in self.object_defs.values():
             self._apply(object_def)
@@ -39,27 +76,267 @@ class ApplicationContext(ObjectContainer):
         for configuration in self.configs:
             self._apply(configuration)
 
-        for object_def in self.object_defs.values():
-            if not object_def.lazy_init and object_def.id not in self.objects:
-                self.logger.debug("Eagerly fetching %s" % object_def.id)
-                self.get_object(object_def.id, ignore_abstract=True)
-
-        post_processors = [object for object in self.objects.values() if isinstance(object, ObjectPostProcessor)]
+        self._create_eager_objects([object_def.id for object_def in self.object_defs.values()
+                                    if not object_def.lazy_init and object_def.id not in self.objects
+                                    and object_def.scope not in self.scopes])
 
-        for obj_name, obj in self.objects.iteritems():
-            if not isinstance(obj, ObjectPostProcessor):
-                for post_processor in post_processors:
-                    self.objects[obj_name] = post_processor.post_process_before_initialization(obj, obj_name)
+        post_processors = [(obj_name, obj) for (obj_name, obj) in self.objects.items() if isinstance(obj, ObjectPostProcessor)]
 
+        for hook in ("before", "apply", "after"):
+            for obj_name, obj in self.objects.items():
+                if hook == "apply":
+                    self._timed(self._apply, (obj,), "record_apply", (obj_name,))
+                elif not isinstance(obj, ObjectPostProcessor):
+                    for post_processor_name, post_processor in post_processors:
+                        method = getattr(post_processor, "post_process_%s_initialization" % hook)
+                        self.objects[obj_name] = self._timed(method, (obj, obj_name),
+                                                             "record_post_processor", (post_processor_name, obj_name, hook))
 
-        for object in self.objects.values():
-            self._apply(object)
+        if self.profile is not None:
+            self.profile.finish(self._sync_dependency_graph()[0])
+        # Post processors may have replaced objects.
+        self._type_index = None
 
-        for obj_name, obj in self.objects.iteritems():
-            if not isinstance(obj, ObjectPostProcessor):
-                for post_processor in post_processors:
-                    self.objects[obj_name] = post_processor.post_process_after_initialization(obj, obj_name)
+    def _timed(self, function, args, record, record_args):
+        """Call function(*args). With a profile, also tell its record method, after record_args, how long it took."""
+        if self.profile is None:
+            return function(*args)
+        start = time.time()
+        result = function(*args)
+        getattr(self.profile, record)(*(record_args + (time.time() - start,)))
+        return result
             
+    def _create_eager_objects(self, names):
+        self.startup_dependencies = self._startup_graph(names)
+        serial = [name for name in names if isinstance(self.object_defs[name].factory, PythonObjectFactory)]
+        if self.startup_workers > 1 and len(serial) < len(names):
+            for name in self._in_dependency_order(serial, self.startup_dependencies):
+                self._create_eager_object(name)
+            thread_safe = self.thread_safe
+            self.thread_safe = True
+            try:
+                self._create_in_parallel([name for name in names if name not in self.objects])
+            finally:
+                self.thread_safe = thread_safe
+        else:
+            for name in self._in_dependency_order(names, self.startup_dependencies):
+                self._create_eager_object(name)
+
+    def _create_eager_object(self, name):
+        self.logger.debug("Eagerly fetching %s" % name)
+        start = time.time()
+        self.get_object(name, ignore_abstract=True)
+        self.creation_times[name] = time.time() - start
+
+    def _startup_graph(self, names, edges = None):
+        """Map each of names to the others it depends on, directly or through objects created on demand.
+        Dependencies are followed in edges, the graph of _sync_dependency_graph by default, which holds them
+        as read, before creating objects replaced the references in the lists, sets and dicts of definitions."""
+        if edges is None:
+            edges = self._sync_dependency_graph()[0]
+        eager = set(names)
+        graph = {}
+        for name in names:
+            dependencies = set()
+            seen = set([name])
+            stack = [name]
+            while stack:
+                for dependency in edges.get(stack.pop(), ()):
+                    if dependency in seen or dependency not in edges:
+                        continue
+                    seen.add(dependency)
+                    if dependency in eager:
+                        dependencies.add(dependency)
+                    elif dependency not in self.objects:
+                        stack.append(dependency)
+            graph[name] = dependencies
+        return graph
+
+    def _in_dependency_order(self, names, graph):
+        """Sort names so that dependencies, as found in graph, come first. Whatever is left in a cycle
+        comes last, in no particular order, and reports itself when created."""
+        ordered = []
+        done = set()
+        pending = list(names)
+        while pending:
+            left = set(pending)
+            ready = [name for name in pending if not graph[name] & left]
+            if not ready:
+                ready = pending
+            ordered.extend(ready)
+            done.update(ready)
+            pending = [name for name in pending if name not in done]
+        return ordered
+
+    def _create_in_parallel(self, names):
+        """Create names on startup_workers threads, each object as soon as those it depends on are done.
+        If creating one fails, the others are still created, and the first error is raised in the end."""
+        pending = dict([(name, self.startup_dependencies[name] & set(names)) for name in names])
+        dependents = {}
+        for name, dependencies in pending.items():
+            for dependency in dependencies:
+                dependents.setdefault(dependency, []).append(name)
+
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        def work():
+            while True:
+                name = tasks.get()
+                if name is None:
+                    return
+                try:
+                    self._create_eager_object(name)
+                    results.put((name, None))
+                except Exception:
+                    results.put((name, sys.exc_info()))
+
+        workers = [threading.Thread(target=work, name="springpython-startup-%s" % i) for i in range(self.startup_workers)]
+        for worker in workers:
+            worker.setDaemon(True)
+            worker.start()
+
+        queued = set()
+        errors = []
+        running = 0
+        try:
+            ready = [name for name in names if not pending[name]]
+            while len(queued) < len(names) or running:
+                if not ready and not running:
+                    # Only objects in a cycle are left, creating them reports it.
+                    ready = [name for name in names if name not in queued]
+                for name in ready:
+                    queued.add(name)
+                    tasks.put(name)
+                    running += 1
+                ready = []
+
+                name, error = results.get()
+                running -= 1
+                if error is not None:
+                    errors.append(error)
+                for dependent in dependents.get(name, []):
+                    pending[dependent].discard(name)
+                    if not pending[dependent] and dependent not in queued:
+                        ready.append(dependent)
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def get_startup_critical_path(self):
+        """The chain of dependencies that took longest to create at startup, as a list of names from the
+        first object created to the last, along with the seconds it took altogether."""
+        longest = {}
+        def path(name, visiting):
+            if name not in longest:
+                best = (0.0, [])
+                for dependency in self.startup_dependencies.get(name, ()):
+                    if dependency not in visiting and dependency in self.creation_times:
+                        candidate = path(dependency, visiting | set([dependency]))
+                        if candidate[0] > best[0]:
+                            best = candidate
+                longest[name] = (best[0] + self.creation_times[name], best[1] + [name])
+            return longest[name]
+
+        critical = (0.0, [])
+        for name in self.creation_times:
+            candidate = path(name, set([name]))
+            if candidate[0] > critical[0]:
+                critical = candidate
+        return critical[1], critical[0]
+
+    def refresh(self, changed_configs):
+        """
+        Read changed_configs again, a config or a list of them, and bring the context up to date with
+        the definitions they hold now. The objects whose definitions were added, changed or removed are
+        destroyed, along with all those depending on them, and the singletons among them are created
+        again and post processed as at startup. All other objects are left as they are. Configs which
+        aren't part of the context yet are added to it, after the others. Returns the names of the
+        objects affected.
+
+        As when the context is built, a definition in a later config overrides one in an earlier
+        config. A definition removed from a config isn't replaced by one it overrode. No other thread
+        should be using the context during a refresh.
+        """
+        if self._definition_keys is None:
+            raise Exception("This context can't be refreshed, it wasn't created with refreshable=True")
+        if not isinstance(changed_configs, list):
+            changed_configs = [changed_configs]
+        for configuration in changed_configs:
+            if configuration not in self.configs:
+                self.configs.append(configuration)
+
+        replaced = {}
+        for configuration in changed_configs:
+            self.logger.debug("=== Reading configuration %s again ===" % configuration)
+            rank = self.configs.index(configuration)
+            object_defs = dict([(object_def.id, object_def) for object_def in configuration.read_object_defs()])
+            for name, source in self._sources.items():
+                if source is configuration and name not in object_defs:
+                    replaced[name] = None
+            for name, object_def in object_defs.items():
+                source = self._sources.get(name)
+                if source is not None and source is not configuration and self.configs.index(source) > rank:
+                    continue
+                key = _definition_key(object_def)
+                if source is configuration and key == self._definition_keys.get(name):
+                    continue
+                replaced[name] = (object_def, configuration, key)
+
+        affected = set(replaced)
+        for name in replaced:
+            affected.update(self.get_dependents(name, transitive=True))
+        # The objects in place were created from the definitions being replaced, so destroy them in their order.
+        previous_graph = dict(self._dependency_graph)
+        for name, replacement in replaced.items():
+            self._plans.pop(name, None)
+            if replacement is None:
+                self.logger.debug("Definition of %s was removed" % name)
+                del self.object_defs[name]
+                del self._sources[name]
+                self._definition_keys.pop(name, None)
+            else:
+                self.logger.debug("Definition of %s changed" % name)
+                self.object_defs[name], self._sources[name], self._definition_keys[name] = replacement
+                self._apply(replacement[0])
+        for name in replaced:
+            affected.update(self.get_dependents(name, transitive=True))
+        if not affected:
+            return []
+
+        stale = [name for name in affected if name in self.objects]
+        for name in reversed(self._in_dependency_order(stale, self._startup_graph(stale, previous_graph))):
+            self._destroy(name, self.objects.pop(name))
+            self._abstract_objects.discard(name)
+        self._type_index = None
+        for name in affected:
+            for custom_scope in self.scopes.values():
+                custom_scope.discard(name)
+
+        names = [name for name in affected if name in self.object_defs and self.object_defs[name].scope == scope.SINGLETON
+                 and (name in stale or not self.object_defs[name].lazy_init)]
+        for name in self._in_dependency_order(names, self._startup_graph(names)):
+            self.get_object(name, ignore_abstract=True)
+
+        created = [name for name in names if name in self.objects and not isinstance(self.objects[name], ObjectPostProcessor)]
+        post_processors = [obj for obj in self.objects.values() if isinstance(obj, ObjectPostProcessor)]
+        for name in created:
+            for post_processor in post_processors:
+                self.objects[name] = post_processor.post_process_before_initialization(self.objects[name], name)
+        for name in names:
+            if name in self.objects:
+                self._apply(self.objects[name])
+        for name in created:
+            for post_processor in post_processors:
+                self.objects[name] = post_processor.post_process_after_initialization(self.objects[name], name)
+        self._type_index = None
+
+        return sorted(affected)
+
     def _apply(self, obj):
         if not (obj.__class__.__name__ in self.classnames_to_avoid): 
             if hasattr(obj, "after_properties_set"):
@@ -73,47 +350,108 @@ class ApplicationContext(ObjectContainer):
         """ Returns all objects which are instances of a given type.
         If include_type is False then only instances of the type's subclasses
         will be returned.
+
+        Classes are looked up in an index of the objects by each class they
+        derive from, built again once new objects are created. Tuples of types,
+        and abstract base classes, which may claim any class, are checked
+        against each object.
         """
+        if isinstance(type_, (type, types.ClassType)) and not hasattr(type_, "_abc_registry"):
+            matches = self._get_type_index().get(type_, {})
+        else:
+            matches = dict([(obj_name, obj) for (obj_name, obj) in self.objects.iteritems() if isinstance(obj, type_)])
+
         result = {}
-        for obj_name, obj in self.objects.iteritems():
-            if isinstance(obj, type_):
-                if include_type == False and type(obj) is type_:
-                    continue
-                result[obj_name] = obj
+        for obj_name, obj in matches.iteritems():
+            if include_type == False and type(obj) is type_:
+                continue
+            result[obj_name] = obj
                 
         return result
+
+    def _get_type_index(self):
+        """Map each class to the objects deriving from it. Objects put into objects by hand, rather than
+        created, are caught by the count of objects changing."""
+        index = self._type_index
+        if index is None or self._type_index_size != len(self.objects):
+            index = {}
+            for obj_name, obj in self.objects.items():
+                for cls in set(inspect.getmro(obj.__class__) + inspect.getmro(type(obj))):
+                    index.setdefault(cls, {})[obj_name] = obj
+            self._type_index = index
+            self._type_index_size = len(self.objects)
+        return index
+
+    def get_dependencies(self, name, transitive=False):
+        """The names of the objects the definition of name refers to, through references, inner objects
+        and its parent. With transitive set, those they refer to as well, and so on."""
+        return self._follow(self._sync_dependency_graph()[0], name, transitive)
+
+    def get_dependents(self, name, transitive=False):
+        """The names of the objects whose definitions refer to name. With transitive set, those referring
+        to them as well, and so on."""
+        return self._follow(self._sync_dependency_graph()[1], name, transitive)
+
+    def _follow(self, edges, name, transitive):
+        found = set(edges.get(name, ()))
+        if transitive:
+            stack = list(found)
+            while stack:
+                for other in edges.get(stack.pop(), ()):
+                    if other not in found:
+                        found.add(other)
+                        stack.append(other)
+            found.discard(name)
+        return found
+
+    def _sync_dependency_graph(self):
+        """Bring the dependency graph, and its reverse, up to date with object_defs, looking again only at
+        the definitions added, replaced or removed since the last time. Returns both."""
+        graph, dependents, known = self._dependency_graph, self._dependents, self._graph_defs
+        changed = [name for (name, object_def) in self.object_defs.iteritems() if known.get(name) is not object_def]
+        removed = [name for name in known if name not in self.object_defs]
+        for name in changed + removed:
+            for dependency in graph.pop(name, ()):
+                dependents[dependency].discard(name)
+            known.pop(name, None)
+        for name in changed:
+            object_def = known[name] = self.object_defs[name]
+            graph[name] = self._dependencies(object_def)
+            for dependency in graph[name]:
+                dependents.setdefault(dependency, set()).add(name)
+        return graph, dependents
                 
     def shutdown_hook(self):
         self.logger.debug("Invoking the destroy_method on registered objects")
-        
-        for obj_name, obj in self.objects.iteritems():
-            if isinstance(obj, DisposableObject):
-                try:
-                    if hasattr(obj, "destroy_method"):
-                        destroy_method_name = getattr(obj, "destroy_method")
-                    else:
-                        destroy_method_name = "destroy"
-                        
-                    destroy_method = getattr(obj, destroy_method_name)
-                    
-                except Exception, e:
-                    self.logger.error("Could not destroy object '%s', exception '%s'" % (obj_name, format_exc()))
-                    
-                else:
-                    if callable(destroy_method):
-                        try:
-                            self.logger.debug("About to destroy object '%s'" % obj_name)
-                            destroy_method()
-                            self.logger.debug("Successfully destroyed object '%s'" % obj_name)
-                        except Exception, e:
-                            self.logger.error("Could not destroy object '%s', exception '%s'" % (obj_name, format_exc()))
-                    else:
-                        self.logger.error("Could not destroy object '%s', " \
-                            "the 'destroy_method' attribute it defines is not callable, " \
-                            "its type is '%r', value is '%r'" % (obj_name, type(destroy_method), destroy_method))
-                        
+
+        # Objects go before those they depend on, also when it is through objects which aren't kept.
+        names = self.objects.keys()
+        for obj_name in reversed(self._in_dependency_order(names, self._startup_graph(names))):
+            self._destroy(obj_name, self.objects[obj_name])
+
+        for custom_scope in self.scopes.values():
+            custom_scope.destroy()
+
         self.logger.debug("Successfully invoked the destroy_method on registered objects")
             
+def _definition_key(value):
+    """Something equal for definitions that create the same objects: the state of the definition, and of
+    the factory and values in it, as they are pickled, without their loggers."""
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted([(key, _definition_key(item)) for (key, item) in value.items()])))
+    if isinstance(value, (list, tuple)):
+        return (value.__class__.__name__, tuple([_definition_key(item) for item in value]))
+    if isinstance(value, (set, frozenset)):
+        return (value.__class__.__name__, tuple(sorted([_definition_key(item) for item in value])))
+    if isinstance(value, (types.FunctionType, types.MethodType, types.ClassType, type, types.ModuleType)) or \
+       not hasattr(value, "__dict__"):
+        return value
+    if hasattr(value, "__getstate__"):
+        state = value.__getstate__()
+    else:
+        state = dict([(key, item) for (key, item) in vars(value).items() if not isinstance(item, logging.Logger)])
+    return (value.__class__.__module__, value.__class__.__name__, _definition_key(state))
+
 class InitializingObject(object):
     """This allows definition of a method which is invoked by the container after an object has had all properties set."""
     def after_properties_set(self):
@@ -0,0 +1,152 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+
+class StartupProfile(object):
+    """
+    StartupProfile collects where the time goes while an ApplicationContext starts: reading each
+    config, creating each object, applying after_properties_set and set_app_context to it, and the
+    before and after hooks of each ObjectPostProcessor. An ApplicationContext created with
+    profile=True keeps one as its profile attribute, and goes on recording objects created later.
+
+    Creation times are given twice, "create" including the objects created on the way (like the ones
+    it refers to), and "self" without them. "depth" is how long the longest chain of references
+    starting from the object is.
+    """
+    COLUMNS = ["create", "self", "count", "apply", "post", "depth"]
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.configs = []
+        self.objects = {}
+        self.post_processors = {}
+        self.dependencies = {}
+        self._lock = threading.Lock()
+        self._bound = threading.local()
+
+    def record_config(self, config, seconds, count):
+        label = config.__class__.__name__
+        locations = getattr(config, "config_location", None)
+        if locations:
+            label = "%s(%s)" % (label, ", ".join([str(location) for location in locations]))
+        self.configs.append({"config": label, "seconds": seconds, "objects": count})
+
+    def begin_create(self, name):
+        stack = getattr(self._bound, "stack", None)
+        if stack is None:
+            stack = self._bound.stack = []
+        stack.append([name, time.time(), 0.0])
+
+    def end_create(self):
+        name, start, nested = self._bound.stack.pop()
+        seconds = time.time() - start
+        if self._bound.stack:
+            self._bound.stack[-1][2] += seconds
+        self._lock.acquire()
+        try:
+            stats = self._object(name)
+            stats["create"] += seconds
+            stats["self"] += seconds - nested
+            stats["count"] += 1
+        finally:
+            self._lock.release()
+
+    def record_apply(self, name, seconds):
+        self._lock.acquire()
+        try:
+            self._object(name)["apply"] += seconds
+        finally:
+            self._lock.release()
+
+    def record_post_processor(self, post_processor, name, hook, seconds):
+        """hook is either "before" or "after"."""
+        self._lock.acquire()
+        try:
+            self._object(name)["post"] += seconds
+            stats = self.post_processors.get(post_processor)
+            if stats is None:
+                stats = self.post_processors[post_processor] = {"before": 0.0, "after": 0.0}
+            stats[hook] += seconds
+        finally:
+            self._lock.release()
+
+    def finish(self, dependencies):
+        """Called once the context is built, with the names of the objects each object refers to."""
+        self.finished = time.time()
+        self.dependencies = dependencies
+
+    def report(self):
+        """Everything recorded, as a dictionary."""
+        objects = {}
+        depths = {}
+        for name, stats in self.objects.items():
+            objects[name] = dict(stats)
+            objects[name]["depth"] = self._depth(name, depths, set())
+        if self.finished is None:
+            total = time.time() - self.started
+        else:
+            total = self.finished - self.started
+        return {"total": total,
+                "configs": list(self.configs),
+                "objects": objects,
+                "post_processors": dict([(name, dict(stats)) for (name, stats) in self.post_processors.items()])}
+
+    def format_table(self, sort_by="create", limit=None):
+        """The report as a text table, one object per line, sorted by one of COLUMNS (largest first)
+        or by "name", and cut down to limit lines if given."""
+        report = self.report()
+        if sort_by == "name":
+            names = sorted(report["objects"].keys())
+        elif sort_by in self.COLUMNS:
+            names = sorted(report["objects"].keys(), key=lambda name: (-report["objects"][name][sort_by], name))
+        else:
+            raise ValueError("Can't sort by %s, only by name or one of %s" % (sort_by, ", ".join(self.COLUMNS)))
+        if limit is not None:
+            names = names[:limit]
+
+        width = max([len("object")] + [len(name) for name in names])
+        lines = ["Started in %.3fs" % report["total"]]
+        for config in report["configs"]:
+            lines.append("  read %s: %.3fs, %s objects" % (config["config"], config["seconds"], config["objects"]))
+        for name, stats in sorted(report["post_processors"].items()):
+            lines.append("  post processor %s: %.3fs before, %.3fs after" % (name, stats["before"], stats["after"]))
+        lines.append("")
+        lines.append("%-*s %9s %9s %6s %9s %9s %6s" % tuple([width, "object"] + self.COLUMNS))
+        for name in names:
+            stats = report["objects"][name]
+            lines.append("%-*s %9.4f %9.4f %6d %9.4f %9.4f %6d" % (width, name, stats["create"], stats["self"],
+                         stats["count"], stats["apply"], stats["post"], stats["depth"]))
+        return "\n".join(lines)
+
+    def _object(self, name):
+        stats = self.objects.get(name)
+        if stats is None:
+            stats = self.objects[name] = {"create": 0.0, "self": 0.0, "count": 0, "apply": 0.0, "post": 0.0}
+        return stats
+
+    def _depth(self, name, depths, visiting):
+        if name not in depths:
+            depth = 0
+            visiting.add(name)
+            for dependency in self.dependencies.get(name, ()):
+                if dependency not in visiting:
+                    depth = max(depth, self._depth(dependency, depths, visiting) + 1)
+            visiting.discard(name)
+            depths[name] = depth
+        return depths[name]
@@ -14,15 +14,613 @@
    limitations under the License.       
 """
 
+import itertools
+import logging
+import threading
+import time
+
 PROTOTYPE = "scope.PROTOTYPE"
 SINGLETON = "scope.SINGLETON"
+THREAD = "scope.THREAD"
+REQUEST = "scope.REQUEST"
+SESSION = "scope.SESSION"
+POOLED = "scope.POOLED"
+
+_names = {"prototype": PROTOTYPE, "singleton": SINGLETON, "thread": THREAD, "request": REQUEST, "session": SESSION,
+          "pooled": POOLED}
 
 def convert(scope_str):
     "This function converts the string-version of scope into the internal, enumerated version."
-    if scope_str == "prototype":
-        return PROTOTYPE
-    elif scope_str == "singleton":
-        return SINGLETON
-    else:
-        raise Exception("Can not handle scope %s" % s)
-    
+    try:
+        return _names[scope_str]
+    except KeyError:
+        raise Exception("Can not handle scope %s" % scope_str)
+
+def register(scope_str, value):
+    """Let convert, and with it the XML and YAML configs and the @Object decorator, know about a custom
+    scope. value is the key the Scope is registered under in the container."""
+    _names[scope_str] = value
+
+def is_known(value):
+    "Whether value is one of the enumerated scopes, either built in or registered."
+    return value in _names.values()
+
+class ScopeNotActive(Exception):
+    """Raised when fetching an object of a scope which isn't active in the calling thread, like a
+    request scoped object outside of any request."""
+
+class PoolExhausted(Exception):
+    """Raised when no pooled object came back in time to be borrowed."""
+
+class Scope(object):
+    """
+    Besides SINGLETON and PROTOTYPE, which the container handles itself, the objects of a scope are
+    kept by a Scope registered in the container under the scope's name. The container asks the Scope
+    for an object through get, with a function creating the object should the Scope have none yet.
+    """
+    def get(self, name, create):
+        """Return the object called name, calling create() to get one if there is none in the current scope."""
+        raise NotImplementedError("Should be overridden by subclasses")
+
+    def remove(self, name):
+        """Take the object called name out of the current scope, without destroying it. Returns the
+        object, or None if there was none."""
+        raise NotImplementedError("Should be overridden by subclasses")
+
+    def register_destruction_callback(self, name, callback):
+        """Have callback() called when the object called name leaves the current scope."""
+        raise NotImplementedError("Should be overridden by subclasses")
+
+    def destroy(self):
+        """Called when the container shuts down, to destroy the objects of all scopes still active."""
+        pass
+
+    def discard(self, name):
+        """Destroy the objects called name in all scopes, as their definition changed."""
+        pass
+
+class ScopedCache(object):
+    """
+    The objects of a single thread, request or session. With max_size set, the least recently used
+    object makes room for a new one. The destruction callbacks of an object are called when it leaves
+    the cache, whether it is pushed out or the whole cache is cleared.
+    """
+    def __init__(self, max_size=None):
+        self.logger = logging.getLogger("springpython.context.scope.ScopedCache")
+        self.max_size = max_size
+        self.objects = {}
+        self._used = {}
+        self._callbacks = {}
+        self._tick = 0
+        self._lock = threading.RLock()
+
+    def get(self, name, create):
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            try:
+                obj = self.objects[name]
+            except KeyError:
+                obj = create()
+                while self.max_size is not None and self.objects and len(self.objects) >= self.max_size:
+                    self._drop(min(self._used, key=self._used.get))
+                self.objects[name] = obj
+            self._used[name] = self._tick
+            return obj
+        finally:
+            self._lock.release()
+
+    def remove(self, name):
+        self._lock.acquire()
+        try:
+            self._used.pop(name, None)
+            self._callbacks.pop(name, None)
+            return self.objects.pop(name, None)
+        finally:
+            self._lock.release()
+
+    def register_destruction_callback(self, name, callback):
+        self._lock.acquire()
+        try:
+            self._callbacks.setdefault(name, []).append(callback)
+        finally:
+            self._lock.release()
+
+    def discard(self, name):
+        self._lock.acquire()
+        try:
+            if name in self.objects:
+                self._drop(name)
+            self._callbacks.pop(name, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for name in self.objects.keys():
+                self._drop(name)
+            self._callbacks.clear()
+        finally:
+            self._lock.release()
+
+    def _drop(self, name):
+        del self.objects[name]
+        del self._used[name]
+        for callback in self._callbacks.pop(name, []):
+            try:
+                callback()
+            except Exception, e:
+                self.logger.error("Destruction callback of '%s' failed: %s" % (name, e))
+
+class ThreadScope(Scope):
+    """
+    Each thread gets its own objects, at most max_objects of them. They are destroyed by end, called
+    from the thread, when one of a pool moves on to other work, or else once the thread is over and
+    another one starts using the scope.
+    """
+    def __init__(self, max_objects=None):
+        self.max_objects = max_objects
+        self._bound = threading.local()
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def _cache(self):
+        cache = getattr(self._bound, "cache", None)
+        if cache is None:
+            cache = self._bound.cache = ScopedCache(self.max_objects)
+            self._lock.acquire()
+            try:
+                finished = [thread for thread in self._caches if not thread.isAlive()]
+                self._caches[threading.currentThread()] = cache
+                finished = [self._caches.pop(thread) for thread in finished]
+            finally:
+                self._lock.release()
+            for old in finished:
+                old.clear()
+        return cache
+
+    def get(self, name, create):
+        return self._cache().get(name, create)
+
+    def remove(self, name):
+        return self._cache().remove(name)
+
+    def register_destruction_callback(self, name, callback):
+        self._cache().register_destruction_callback(name, callback)
+
+    def end(self):
+        """Destroy the objects of the calling thread."""
+        cache = getattr(self._bound, "cache", None)
+        if cache is not None:
+            del self._bound.cache
+            self._lock.acquire()
+            try:
+                self._caches.pop(threading.currentThread(), None)
+            finally:
+                self._lock.release()
+            cache.clear()
+
+    def discard(self, name):
+        self._lock.acquire()
+        try:
+            caches = self._caches.values()
+        finally:
+            self._lock.release()
+        for cache in caches:
+            cache.discard(name)
+
+    def destroy(self):
+        self._lock.acquire()
+        try:
+            caches = self._caches.values()
+            self._caches.clear()
+        finally:
+            self._lock.release()
+        for cache in caches:
+            cache.clear()
+
+class ConversationScope(Scope):
+    """
+    Objects kept per conversation, like a request or a session, which may go on in different threads.
+    The conversation of the calling thread is either told by the conversation_id function, or bound
+    to the thread with begin and let go with release. Each conversation has at most max_objects
+    objects, and past max_conversations conversations, the least recently used one is destroyed. end
+    destroys a conversation, by default that of the calling thread.
+    """
+    kind = "conversation"
+
+    def __init__(self, conversation_id=None, max_objects=None, max_conversations=1000):
+        self.conversation_id = conversation_id
+        self.max_objects = max_objects
+        self.max_conversations = max_conversations
+        self._bound = threading.local()
+        self._caches = {}
+        self._used = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get_conversation_id(self):
+        if self.conversation_id is not None:
+            return self.conversation_id()
+        try:
+            return self._bound.conversation_id
+        except AttributeError:
+            raise ScopeNotActive("There is no active %s in this thread" % self.kind)
+
+    def begin(self, conversation_id):
+        self._bound.conversation_id = conversation_id
+        return conversation_id
+
+    def release(self):
+        if hasattr(self._bound, "conversation_id"):
+            del self._bound.conversation_id
+
+    def end(self, conversation_id=None):
+        if conversation_id is None:
+            conversation_id = self.get_conversation_id()
+        if getattr(self._bound, "conversation_id", None) == conversation_id:
+            self.release()
+        self._lock.acquire()
+        try:
+            self._used.pop(conversation_id, None)
+            cache = self._caches.pop(conversation_id, None)
+        finally:
+            self._lock.release()
+        if cache is not None:
+            cache.clear()
+
+    def _cache(self):
+        conversation_id = self.get_conversation_id()
+        evicted = None
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            cache = self._caches.get(conversation_id)
+            if cache is None:
+                if self.max_conversations is not None and self._caches and len(self._caches) >= self.max_conversations:
+                    oldest = min(self._used, key=self._used.get)
+                    del self._used[oldest]
+                    evicted = self._caches.pop(oldest)
+                cache = self._caches[conversation_id] = ScopedCache(self.max_objects)
+            self._used[conversation_id] = self._tick
+        finally:
+            self._lock.release()
+        if evicted is not None:
+            evicted.clear()
+        return cache
+
+    def get(self, name, create):
+        return self._cache().get(name, create)
+
+    def remove(self, name):
+        return self._cache().remove(name)
+
+    def register_destruction_callback(self, name, callback):
+        self._cache().register_destruction_callback(name, callback)
+
+    def discard(self, name):
+        self._lock.acquire()
+        try:
+            caches = self._caches.values()
+        finally:
+            self._lock.release()
+        for cache in caches:
+            cache.discard(name)
+
+    def destroy(self):
+        self._lock.acquire()
+        try:
+            caches = self._caches.values()
+            self._caches.clear()
+            self._used.clear()
+        finally:
+            self._lock.release()
+        for cache in caches:
+            cache.clear()
+
+class RequestScope(ConversationScope):
+    """
+    Objects kept for the length of a request. Call begin when a request starts and end when it is
+    done, for example from the on_start_resource and on_end_request hooks of CherryPy.
+    """
+    kind = "request"
+
+    def __init__(self, conversation_id=None, max_objects=None, max_conversations=1000):
+        ConversationScope.__init__(self, conversation_id, max_objects, max_conversations)
+        self._ids = itertools.count()
+
+    def begin(self, request_id=None):
+        if request_id is None:
+            request_id = self._ids.next()
+        return ConversationScope.begin(self, request_id)
+
+class SessionScope(ConversationScope):
+    """
+    Objects kept for the length of a session. Either give the session id with begin at the start of
+    each request, and release at its end, or pass a function returning it, like
+    SessionScope(lambda: cherrypy.session.id). Call end with the session id once the session is over.
+    """
+    kind = "session"
+
+class Lease(object):
+    """
+    An object borrowed from an ObjectPool, held by the object attribute. release, or the end of a
+    with block on the lease, gives it back.
+    """
+    def __init__(self, pool, obj):
+        self.pool = pool
+        self.object = obj
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool.return_object(self.object)
+
+    def __enter__(self):
+        return self.object
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+class ObjectPool(object):
+    """
+    A pool of objects made by create, for objects that are costly to build and can't be shared by
+    threads. Objects are borrowed with borrow_object, or lease, and given back with return_object.
+
+    At most max_idle objects wait in the pool, and those that waited longer than idle_timeout seconds
+    are evicted. With max_active set, no more than that many objects are borrowed at a time, and
+    borrowing waits for one to come back. validate, if given, is called with each object taken from
+    the pool, and those it returns False for are dropped. Evicted and dropped objects are handed to
+    destroy, if given.
+
+    hits counts the borrows served by an idle object, misses those which created one, waits those
+    which had to wait, and invalid the objects validate turned down.
+    """
+    def __init__(self, create, max_idle=8, idle_timeout=None, max_active=None, validate=None, destroy=None):
+        self.logger = logging.getLogger("springpython.context.scope.ObjectPool")
+        self.create = create
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_active = max_active
+        self.validate = validate
+        self.destroy = destroy
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.invalid = 0
+        self.evictions = 0
+        self.active = 0
+        self._idle = []
+        self._condition = threading.Condition(threading.Lock())
+
+    def borrow_object(self, timeout=None):
+        """Take an object out of the pool, to be given back with return_object. If max_active objects
+        are out, wait up to timeout seconds, or for ever if it is None, before raising PoolExhausted."""
+        return self._take(True, timeout)
+
+    def take_object(self):
+        """Take an object out of the pool for good, or create one if none is idle. It doesn't count
+        against max_active, and isn't expected back."""
+        return self._take(False, None)
+
+    def _take(self, borrow, timeout):
+        dropped = []
+        found = False
+        self._condition.acquire()
+        try:
+            if borrow:
+                if self.max_active is not None and self.active >= self.max_active:
+                    self._wait(timeout)
+                self.active += 1
+            while True:
+                dropped.extend(self._expire())
+                if not self._idle:
+                    self.misses += 1
+                    break
+                obj = self._idle.pop()[0]
+                if self.validate is None or self._check(obj):
+                    self.hits += 1
+                    found = True
+                    break
+                self.invalid += 1
+                dropped.append(obj)
+        finally:
+            self._condition.release()
+        self._discard(dropped)
+        if found:
+            return obj
+
+        try:
+            return self.create()
+        except:
+            if borrow:
+                self._condition.acquire()
+                self.active -= 1
+                self._condition.notify()
+                self._condition.release()
+            raise
+
+    def _check(self, obj):
+        """Validate obj, letting go of the lock meanwhile, as validating may take a while."""
+        self._condition.release()
+        try:
+            try:
+                return self.validate(obj)
+            except Exception, e:
+                self.logger.debug("Validating %s failed: %s" % (obj, e))
+                return False
+        finally:
+            self._condition.acquire()
+
+    def _wait(self, timeout):
+        """Wait for a borrowed object to come back. Called with the lock held."""
+        self.waits += 1
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.active >= self.max_active:
+            if timeout is None:
+                self._condition.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted("All %s pooled objects are in use" % self.max_active)
+                self._condition.wait(remaining)
+
+    def return_object(self, obj):
+        """Give back a borrowed object."""
+        self._condition.acquire()
+        try:
+            self.active -= 1
+            self._idle.append((obj, time.time()))
+            evicted = self._expire()
+            if self.max_idle is not None and len(self._idle) > self.max_idle:
+                overflow = len(self._idle) - self.max_idle
+                evicted.extend([entry[0] for entry in self._idle[:overflow]])
+                del self._idle[:overflow]
+                self.evictions += overflow
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        self._discard(evicted)
+
+    def lease(self, timeout=None):
+        """Borrow an object as a Lease, for a with block to give it back."""
+        return Lease(self, self.borrow_object(timeout))
+
+    def clear(self):
+        """Destroy all idle objects."""
+        self._condition.acquire()
+        try:
+            evicted = [entry[0] for entry in self._idle]
+            self._idle = []
+        finally:
+            self._condition.release()
+        self._discard(evicted)
+
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return {"hits": self.hits, "misses": self.misses, "waits": self.waits, "invalid": self.invalid,
+                    "evictions": self.evictions, "active": self.active, "idle": len(self._idle)}
+        finally:
+            self._condition.release()
+
+    def _expire(self):
+        """Pull out the objects idle for longer than idle_timeout, oldest first in the list. Called
+        with the lock held."""
+        if self.idle_timeout is None or not self._idle:
+            return []
+        limit = time.time() - self.idle_timeout
+        count = 0
+        while count < len(self._idle) and self._idle[count][1] < limit:
+            count += 1
+        expired = [entry[0] for entry in self._idle[:count]]
+        del self._idle[:count]
+        self.evictions += count
+        return expired
+
+    def _discard(self, objects):
+        if self.destroy is not None:
+            for obj in objects:
+                try:
+                    self.destroy(obj)
+                except Exception, e:
+                    self.logger.error("Destroying pooled object %s failed: %s" % (obj, e))
+
+class PooledScope(Scope):
+    """
+    Keeps an ObjectPool for each object of the scope, made with the settings given here, or with
+    those given to configure for that object. get_object takes an object out of its pool for good,
+    like a prototype which is only created when the pool is empty, while the container's
+    borrow_object leases it, to be given back once done. Pooled objects are destroyed when they are
+    evicted, and idle ones when the container shuts down.
+    """
+    def __init__(self, max_idle=8, idle_timeout=None, max_active=None, validate=None):
+        self.logger = logging.getLogger("springpython.context.scope.PooledScope")
+        self.defaults = {"max_idle": max_idle, "idle_timeout": idle_timeout, "max_active": max_active,
+                         "validate": validate}
+        self.settings = {}
+        self.pools = {}
+        self._callbacks = {}
+        self._bound = threading.local()
+        self._lock = threading.Lock()
+
+    def configure(self, name, **settings):
+        """Give the pool of object name its own max_idle, idle_timeout, max_active or validate. Only
+        pools made after the call are affected."""
+        self.settings[name] = settings
+
+    def get_pool(self, name, create):
+        pool = self.pools.get(name)
+        if pool is None:
+            self._lock.acquire()
+            try:
+                pool = self.pools.get(name)
+                if pool is None:
+                    settings = dict(self.defaults)
+                    settings.update(self.settings.get(name, {}))
+                    pool = self.pools[name] = ObjectPool(lambda: self._create(create), destroy=self._destroy, **settings)
+            finally:
+                self._lock.release()
+        return pool
+
+    def get(self, name, create):
+        obj = self.get_pool(name, create).take_object()
+        self._lock.acquire()
+        self._callbacks.pop(id(obj), None)
+        self._lock.release()
+        return obj
+
+    def lease(self, name, create, timeout=None):
+        return self.get_pool(name, create).lease(timeout)
+
+    def remove(self, name):
+        return None
+
+    def register_destruction_callback(self, name, callback):
+        stack = getattr(self._bound, "stack", None)
+        if stack:
+            stack[-1].append(callback)
+
+    def stats(self):
+        """The stats of each pool, by object name."""
+        return dict([(name, pool.stats()) for (name, pool) in self.pools.items()])
+
+    def discard(self, name):
+        self._lock.acquire()
+        try:
+            pool = self.pools.pop(name, None)
+        finally:
+            self._lock.release()
+        if pool is not None:
+            pool.clear()
+
+    def destroy(self):
+        for pool in self.pools.values():
+            pool.clear()
+
+    def _create(self, create):
+        """Call create, catching the destruction callbacks the container registers meanwhile."""
+        stack = getattr(self._bound, "stack", None)
+        if stack is None:
+            stack = self._bound.stack = []
+        stack.append([])
+        try:
+            obj = create()
+        finally:
+            callbacks = stack.pop()
+        if callbacks:
+            self._lock.acquire()
+            self._callbacks[id(obj)] = callbacks
+            self._lock.release()
+        return obj
+
+    def _destroy(self, obj):
+        self._lock.acquire()
+        callbacks = self._callbacks.pop(id(obj), [])
+        self._lock.release()
+        for callback in callbacks:
+            callback()
@@ -29,3 +29,6 @@ class InvalidArgumentType(DataAccessException):
         DataAccessException.__init__(self, msg)
         self.arg_type = arg_type
         self.valid_types = valid_types
+
+class CannotGetConnectionException(DataAccessException):
+    pass
@@ -0,0 +1,292 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.       
+"""
+import logging
+import Queue
+import threading
+from springpython.database.core import DatabaseTemplate
+from springpython.database.transaction import TransactionTemplate
+from springpython.database.transaction import transactional
+
+try:
+    # Futures from the standard library (or the futures backport) can be awaited by asyncio,
+    # through asyncio.wrap_future.
+    from concurrent.futures import Future
+except ImportError:
+    class Future(object):
+        """A stand-in for concurrent.futures.Future, covering what DatabaseExecutor and its callers need."""
+        def __init__(self):
+            self._condition = threading.Condition()
+            self._state = "PENDING"
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+
+        def cancel(self):
+            self._condition.acquire()
+            try:
+                if self._state != "PENDING":
+                    return self._state == "CANCELLED"
+                self._state = "CANCELLED"
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+            self._run_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._state == "CANCELLED"
+
+        def running(self):
+            return self._state == "RUNNING"
+
+        def done(self):
+            return self._state in ("CANCELLED", "FINISHED")
+
+        def result(self, timeout = None):
+            self._wait(timeout)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+        def exception(self, timeout = None):
+            self._wait(timeout)
+            return self._exception
+
+        def add_done_callback(self, fn):
+            self._condition.acquire()
+            try:
+                if not self.done():
+                    self._callbacks.append(fn)
+                    return
+            finally:
+                self._condition.release()
+            fn(self)
+
+        def set_running_or_notify_cancel(self):
+            self._condition.acquire()
+            try:
+                if self._state == "CANCELLED":
+                    return False
+                self._state = "RUNNING"
+                return True
+            finally:
+                self._condition.release()
+
+        def set_result(self, result):
+            self._finish(result, None)
+
+        def set_exception(self, exception):
+            self._finish(None, exception)
+
+        def _finish(self, result, exception):
+            self._condition.acquire()
+            try:
+                self._result = result
+                self._exception = exception
+                self._state = "FINISHED"
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+            self._run_callbacks()
+
+        def _run_callbacks(self):
+            callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                fn(self)
+
+        def _wait(self, timeout):
+            self._condition.acquire()
+            try:
+                if not self.done():
+                    self._condition.wait(timeout)
+                if self._state == "CANCELLED":
+                    raise CancelledError()
+                if not self.done():
+                    raise TimeoutError()
+            finally:
+                self._condition.release()
+
+    class CancelledError(Exception):
+        pass
+
+    class TimeoutError(Exception):
+        pass
+
+class DatabaseExecutor(object):
+    """
+    Runs database work on a fixed number of worker threads, and hands back a Future for each piece
+    of work. Work submitted while every worker is busy waits in a queue, so any number of calls can
+    be in flight without opening more than max_workers threads (or database connections).
+
+    Work submitted from one of the workers runs right away in that worker. That keeps every step of
+    a transaction started by AsyncTransactionTemplate in the same thread, where the transaction
+    manager keeps track of it.
+    """
+    def __init__(self, max_workers = 1):
+        self.max_workers = max_workers
+        self.logger = logging.getLogger("springpython.database.asynchronous.DatabaseExecutor")
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        if self.in_worker():
+            self._run(future, fn, args, kwargs)
+            return future
+
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError("Can't submit work to a DatabaseExecutor that was shut down")
+            self._queue.put((future, fn, args, kwargs))
+            if self._idle == 0 and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="DatabaseExecutor-%s" % len(self._workers))
+                worker.setDaemon(True)
+                self._workers.append(worker)
+                worker.start()
+        finally:
+            self._lock.release()
+        return future
+
+    def in_worker(self):
+        """Tells whether the calling thread is one of this executor's workers."""
+        return getattr(self._local, "worker", False)
+
+    def shutdown(self, wait = True):
+        """Stop the workers once the queued work is done."""
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            workers = list(self._workers)
+            for worker in workers:
+                self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            self._lock.acquire()
+            self._idle += 1
+            self._lock.release()
+            work = self._queue.get()
+            self._lock.acquire()
+            self._idle -= 1
+            self._lock.release()
+            if work is None:
+                break
+            future, fn, args, kwargs = work
+            self._run(future, fn, args, kwargs)
+
+    def _run(self, future, fn, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, e:
+            self.logger.debug("Trapped %s, handing it to the future" % e)
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+class AsyncDatabaseTemplate(object):
+    """
+    This offers the operations of DatabaseTemplate, but each call returns a Future right away, while
+    the statement runs on a DatabaseExecutor. Errors are raised by the Future's result(), as the
+    same DataAccessExceptions DatabaseTemplate raises.
+
+    Each worker needs a connection of its own, so this is meant to be used with a
+    PooledConnectionFactory (around a Sqlite3ConnectionFactory created with check_same_thread=False,
+    for sqlite). Unless an executor is given, one is created with as many workers as the pool has
+    connections.
+    """
+    def __init__(self, connection_factory = None, executor = None):
+        self.database_template = DatabaseTemplate()
+        self.executor = executor
+        self.connection_factory = connection_factory
+
+    def __setattr__(self, name, value):
+        """When the connection factory is set, pass it on through to the database template, and create
+        an executor matching its pool size if none was given."""
+        self.__dict__[name] = value
+        if name == "connection_factory" and value:
+            self.__dict__["database_template"].connection_factory = value
+            if self.__dict__.get("executor") is None:
+                self.__dict__["executor"] = DatabaseExecutor(getattr(value, "max_size", 1))
+
+    def execute(self, sql_statement, args = None):
+        return self.executor.submit(self.database_template.execute, sql_statement, args)
+
+    def query(self, sql_query, args = None, rowhandler = None):
+        return self.executor.submit(self.database_template.query, sql_query, args, rowhandler)
+
+    def query_for_list(self, sql_query, args = None):
+        return self.executor.submit(self.database_template.query_for_list, sql_query, args)
+
+    def query_for_int(self, sql_query, args = None):
+        return self.executor.submit(self.database_template.query_for_int, sql_query, args)
+
+    def query_for_long(self, sql_query, args = None):
+        return self.executor.submit(self.database_template.query_for_long, sql_query, args)
+
+    def query_for_object(self, sql_query, args = None, required_type = None):
+        return self.executor.submit(self.database_template.query_for_object, sql_query, args, required_type)
+
+    def update(self, sql_statement, args = None):
+        return self.executor.submit(self.database_template.update, sql_statement, args)
+
+    def batch_update(self, sql_statement, seq_of_args, batch_size = 1000):
+        return self.executor.submit(self.database_template.batch_update, sql_statement, seq_of_args, batch_size)
+
+class AsyncTransactionTemplate(TransactionTemplate):
+    """
+    A TransactionTemplate whose execute() runs the whole transaction on one worker of a DatabaseExecutor,
+    and returns a Future of the callback's result. Calls made through an AsyncDatabaseTemplate sharing
+    the same executor from inside the callback run in that worker too, and so join the transaction.
+    """
+    def __init__(self, tx_manager, executor):
+        TransactionTemplate.__init__(self, tx_manager)
+        self.executor = executor
+
+    def execute(self, transactionCallback):
+        return self.executor.submit(TransactionTemplate.execute, self, transactionCallback)
+
+def async_transactional(executor, tx_attributes = None):
+    """
+    Like @transactional, but calling the decorated function returns a Future right away, while the
+    function runs in a transaction on one of executor's workers.
+
+    @async_transactional(executor, ["PROPAGATION_REQUIRED"])
+    def transfer(self, amount, from_account, to_account):
+        pass
+    """
+    def async_transactional_wrapper(f):
+        tx_function = transactional(tx_attributes)(f)
+        def submit(*args, **kwargs):
+            return executor.submit(tx_function, *args, **kwargs)
+        submit.__name__ = f.__name__
+        submit.__doc__ = f.__doc__
+        # Lets AutoTransactionalObject link the transaction manager, as it does for @transactional.
+        submit.transactional_function = tx_function
+        return submit
+    return async_transactional_wrapper
@@ -0,0 +1,191 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.       
+"""
+import logging
+import re
+import time
+from threading import RLock
+from springpython.util import LRUCache
+
+_LITERALS = r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\""
+_WHITESPACE = re.compile(r"(%s)|\s+" % _LITERALS)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_IDENTIFIER = r"(?:\"[^\"]+\"|`[^`]+`|\[[^\]]+\]|[\w$.]+)+"
+_SOURCE = re.compile(r"\b(?:from|join)\s+", re.I)
+_CLAUSE_END = re.compile(r"\b(?:where|group|order|having|limit|offset|union|intersect|except|on|using|inner|left|right|full|cross|natural|join|set|values|select|for|window)\b|[();]", re.I)
+_WRITE_TARGET = re.compile(r"""^\s*(?:insert\s+(?:or\s+\w+\s+)?into|replace\s+into|update(?:\s+or\s+\w+)?|delete\s+from|delete|
+                               truncate(?:\s+table)?|merge\s+into|(?:drop|alter|create)\s+table(?:\s+if\s+(?:not\s+)?exists)?)
+                               \s+(%s)""" % _IDENTIFIER, re.I | re.X)
+_READ_ONLY = re.compile(r"^\s*select\b", re.I)
+
+def normalize_sql(sql):
+    """Collapses runs of whitespace outside of string literals, so that the same query written
+    across a different number of lines ends up with the same key."""
+    return _WHITESPACE.sub(lambda match: match.group(1) or " ", sql).strip()
+
+def _table_name(identifier):
+    return identifier.split(".")[-1].strip("\"`[]").lower()
+
+def tables_read(sql):
+    """Returns the set of tables named in the FROM and JOIN clauses of a statement."""
+    sql = _STRINGS.sub("''", sql)
+    tables = set()
+    for match in _SOURCE.finditer(sql):
+        end = _CLAUSE_END.search(sql, match.end())
+        clause = sql[match.end():end and end.start() or len(sql)]
+        for item in clause.split(","):
+            words = item.split()
+            if words:
+                tables.add(_table_name(words[0]))
+    return tables
+
+def tables_written(sql):
+    """Returns the set of tables a statement may change, an empty set for a plain SELECT, or None if it
+    can't be worked out (a stored procedure call for example). Tables the statement reads are included,
+    to stay on the safe side with multi-table updates and deletes."""
+    match = _WRITE_TARGET.match(sql)
+    if match is None:
+        if _READ_ONLY.match(sql):
+            return set()
+        return None
+    return tables_read(sql) | set([_table_name(match.group(1))])
+
+class QueryCache(object):
+    """
+    This is a read-through cache for the results of DatabaseTemplate queries. Plug it into a
+    DatabaseTemplate (or DaoSupport) as query_cache.
+
+    Results are keyed on the normalized SQL and its arguments. Up to max_size results are kept, each
+    for ttl seconds (or until invalidated, if ttl is None). When the template runs an update, execute
+    or batch_update, every cached result that read one of the changed tables is dropped. If the changed
+    tables can't be worked out from the statement, the whole cache is cleared.
+
+    queries optionally maps statements to their own ttl. When it is set, only those statements are
+    cached; a ttl of None there means the default ttl, and 0 turns caching off for that statement.
+
+    Writes made by other programs (or by SQL that doesn't go through a DatabaseTemplate using this
+    cache) are only seen once the entries expire, so this is meant for reference data.
+    """
+    def __init__(self, max_size=1000, ttl=None, queries=None):
+        self.logger = logging.getLogger("springpython.database.cache.QueryCache")
+        self.lock = RLock()
+        self.entries = LRUCache(max_size)
+        self.index = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.ttl = ttl
+        self.queries = queries
+
+    def __setattr__(self, name, value):
+        """When the per-query settings are set, normalize their SQL so they match the statements run."""
+        self.__dict__[name] = value
+        if name == "queries":
+            if value is None:
+                self.__dict__["_query_ttls"] = None
+            else:
+                self.__dict__["_query_ttls"] = dict([(normalize_sql(sql), ttl) for (sql, ttl) in value.items()])
+
+    def _key(self, sql, args):
+        if isinstance(args, dict):
+            args = tuple(sorted(args.items()))
+        key = (normalize_sql(sql), args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _ttl(self, key):
+        if self._query_ttls is None:
+            return self.ttl
+        if key[0] not in self._query_ttls:
+            return 0
+        ttl = self._query_ttls[key[0]]
+        if ttl is None:
+            return self.ttl
+        return ttl
+
+    def get(self, sql, args):
+        """Returns the (results, metadata) cached for this query, or None."""
+        key = self._key(sql, args)
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, results, metadata = entry
+            if expires is None or expires > time.time():
+                self.hits += 1
+                return results, metadata
+            self.entries.pop(key)
+        self.misses += 1
+        return None
+
+    def begin(self):
+        """Returns a token to hand to put() once the query has run. If a write is made to the cache
+        in the meantime, the results are thrown away, since they may already be stale."""
+        return self.generation
+
+    def put(self, sql, args, results, metadata, token):
+        key = self._key(sql, args)
+        if key is None:
+            return
+        ttl = self._ttl(key)
+        if ttl == 0:
+            return
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+
+        self.lock.acquire()
+        try:
+            if token != self.generation:
+                return
+            self.entries.put(key, (expires, results, metadata))
+            for table in tables_read(key[0]):
+                keys = self.index.setdefault(table, set())
+                keys.add(key)
+                if len(keys) > self.entries.max_size:
+                    keys.intersection_update(self.entries.keys())
+        finally:
+            self.lock.release()
+
+    def invalidate(self, sql):
+        """Drops the cached results that read any of the tables changed by this statement."""
+        tables = tables_written(sql)
+        if tables is not None and not tables:
+            return
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if tables is None:
+                self.logger.debug("Can't tell which tables '%s' changes, clearing the cache" % sql)
+                self.clear()
+                return
+            for table in tables:
+                for key in self.index.pop(table, ()):
+                    self.entries.pop(key)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.entries.clear()
+            self.index = {}
+        finally:
+            self.lock.release()
@@ -13,13 +13,18 @@
    See the License for the specific language governing permissions and
    limitations under the License.       
 """
+import array
 import logging
 import types
+from itertools import islice
 from springpython.database import ArgumentMustBeNamed
 from springpython.database import DataAccessException
 from springpython.database import IncorrectResultSizeDataAccessException
 from springpython.database import InvalidArgumentType
 from springpython.database import factory
+from springpython.database.instrumentation import NULL_PROBE
+from springpython.database.instrumentation import QueryProbe
+from springpython.util import LRUCache
 
 class DaoSupport(object):
     """
@@ -27,55 +32,102 @@ class DaoSupport(object):
     to help carry out database operations. It requires that a connection object be
     provided during instantion.
     """
-    def __init__(self, connection_factory = None):
+    def __init__(self, connection_factory = None, instrumentation = None, query_cache = None):
         self.database_template = DatabaseTemplate()
         self.connection_factory = connection_factory
+        self.instrumentation = instrumentation
+        self.query_cache = query_cache
         
     def __setattr__(self, name, value):
-        """When the connection factory is set, pass it on through to the database template."""
+        """When the connection factory, the instrumentation or the query cache is set, pass it on through
+        to the database template."""
         self.__dict__[name] = value
         if name == "connection_factory" and value:
             self.__dict__["database_template"].connection_factory = value
+        elif name in ("instrumentation", "query_cache"):
+            setattr(self.__dict__["database_template"], name, value)
 
 class DatabaseTemplate(object):
     """
     This class is meant to mimic the Spring framework's JdbcTemplate class.
     Since Python doesn't use JDBC, the name is generalized to "Database"
+
+    If instrumentation is set (see springpython.database.instrumentation), it is told about the
+    timings and row counts of every statement. Without it, nothing is measured.
+
+    If query_cache is set (see springpython.database.cache), query results are read through it, and
+    updates drop the cached results of the tables they change. Queries bypass the cache while the
+    thread holds a connection, inside a transaction for example, and the results dropped by the updates
+    of a transaction are dropped once more when it commits or rolls back.
+
+    query_many runs its queries on fan_out_executor (see springpython.database.asynchronous). If none
+    is set, the executor of a pooled connection factory is used, which is shared by every DatabaseTemplate
+    of the pool, and shut down along with it.
     """
-    def __init__(self, connection_factory = None):
+
+    def __init__(self, connection_factory = None, instrumentation = None, query_cache = None, fan_out_executor = None):
+        self.instrumentation = instrumentation
+        self.query_cache = query_cache
+        self.fan_out_executor = fan_out_executor
         self.connection_factory = connection_factory
         self.logger = logging.getLogger("springpython.database.core.DatabaseTemplate")
+        self.metadata_cache = LRUCache(100)
 
     def __setattr__(self, name, value):
-        """When the connection factory is set, initialize a connection to the database."""
+        """When the connection factory is set, initialize a connection to the database. The connection
+        is handed back right away, and fetched again from the factory by every operation."""
         self.__dict__[name] = value
         if name == "connection_factory" and value:
-            self.__db = value.getConnection()
+            value.releaseConnection(value.getReadConnection())
+
+    def __invalidate(self, sql):
+        cache = self.query_cache
+        if cache is None:
+            return
+        cache.invalidate(sql)
+        if self.connection_factory.holds_connection():
+            # Until the transaction ends, other threads can still read, and cache, what it is about to change.
+            self.connection_factory.after_transaction(lambda: cache.invalidate(sql))
+
+    def __probe(self, operation, sql, args = None):
+        if self.instrumentation is None:
+            return NULL_PROBE
+        return QueryProbe(self.instrumentation, operation, sql, args)
             
     def execute(self, sql_statement, args = None):
         """Issue a single SQL execute, typically a DDL statement."""
-        sql_statement = self.connection_factory.convert_sql_binding(sql_statement)
+        sql_statement, args = self.connection_factory.convert_sql_binding_args(sql_statement, args)
 
-        cursor = self.__db.cursor()
+        probe = self.__probe("execute", sql_statement, args)
+        connection = self.connection_factory.getConnection()
+        probe.got_connection()
         error = None
         rows_affected = 0
         try:
+            cursor = self.connection_factory.open_cursor(connection, sql_statement)
+            probe.opened_cursor()
             try:
-                if args:
-                    cursor.execute(sql_statement, args)
-                    rows_affected = cursor.rowcount
-                else:
-                    cursor.execute(sql_statement)
-                    rows_affected = cursor.rowcount
-            except Exception, e:
-                self.logger.debug("execute.execute: Trapped %s while trying to execute '%s'" % (e, sql_statement))
-                error = e
+                try:
+                    if args:
+                        cursor.execute(sql_statement, args)
+                        rows_affected = cursor.rowcount
+                    else:
+                        cursor.execute(sql_statement)
+                        rows_affected = cursor.rowcount
+                except Exception, e:
+                    self.logger.debug("execute.execute: Trapped %s while trying to execute '%s'" % (e, sql_statement))
+                    error = e
+            finally:
+                try:
+                    self.connection_factory.close_cursor(connection, sql_statement, cursor, error is None)
+                except Exception, e:
+                    self.logger.debug("execute.close: Trapped %s, and throwing away." % e)
+                probe.closed_cursor()
         finally:
-            try:
-                cursor.close()
-            except Exception, e:
-                self.logger.debug("execute.close: Trapped %s, and throwing away." % e)
-            
+            self.connection_factory.releaseConnection(connection)
+            self.__invalidate(sql_statement)
+            probe.done(rows_affected, error)
+
         if error:
             raise DataAccessException(error)
         
@@ -92,48 +144,325 @@ class DatabaseTemplate(object):
             raise ArgumentMustBeNamed(arg_name="rowhandler")
 
         results, metadata = self.__query_for_list(sql_query, args)
+        return self.__map_rows(results, metadata, rowhandler)
+
+    def __map_rows(self, results, metadata, rowhandler):
+        if not results:
+            # Nothing to map, and no metadata to compile a row mapper with if the query failed.
+            return []
+        if hasattr(rowhandler, "compile_row_mapper"):
+            map_row = rowhandler.compile_row_mapper(metadata)
+            return [map_row(row) for row in results]
         return [rowhandler.map_row(row, metadata) for row in results]
 
     def query_for_list(self, sql_query, args = None):
         results, metadata = self.__query_for_list(sql_query, args)
         return results
+
+    def query_many(self, queries):
+        """Run independent queries at the same time, each on a connection of its own, and return their
+        results in the same order. Each query is a SQL string, a (sql_query, args) tuple, or a
+        (sql_query, args, rowhandler) tuple, and gives the same result as query_for_list or query.
+        Any failure is raised as a DataAccessException, once every query is over.
+
+        The queries run one after the other in the calling thread when the connection factory has a single
+        connection, or when the calling thread holds one (inside a transaction), so they see its work."""
+        calls = []
+        for query in queries:
+            if isinstance(query, types.StringTypes):
+                query = (query,)
+            sql_query, args, rowhandler = (tuple(query) + (None, None))[:3]
+            calls.append((self.__query_or_raise, (sql_query, args, rowhandler)))
+
+        executor = None
+        if len(calls) > 1 and not self.connection_factory.holds_connection():
+            executor = self.__fan_out_executor()
+        if executor is None:
+            futures = None
+        else:
+            futures = [executor.submit(function, *args) for (function, args) in calls]
+
+        results = []
+        error = None
+        for i, (function, args) in enumerate(calls):
+            try:
+                if futures is None:
+                    results.append(function(*args))
+                else:
+                    results.append(futures[i].result())
+            except DataAccessException, e:
+                error = error or e
+            except Exception, e:
+                self.logger.debug("query_many: Trapped %s while running '%s'" % (e, args[0]))
+                error = error or DataAccessException(e)
+        if error is not None:
+            raise error
+        return results
+
+    def __query_or_raise(self, sql_query, args, rowhandler):
+        """Give what query_for_list, or query with a rowhandler, would, but raise a DataAccessException
+        when the query fails, rather than returning no rows."""
+        results, metadata = self.__query_for_list(sql_query, args, raise_error = True)
+        if rowhandler is None:
+            return results
+        return self.__map_rows(results, metadata, rowhandler)
+
+    def batched_query(self, sql_query, keys, args = None, rowhandler = None, key_column = 0, batch_size = 500):
+        """Run one query per batch_size keys, instead of one query per key, and return the results grouped by
+        key, as a dictionary of lists holding every key asked for. This is the way out of N+1 query loops like
+        looking up the visits of each pet in turn:
+
+            visits = dt.batched_query("SELECT pet_id, visit_date FROM visits WHERE pet_id IN (?)", pet_ids,
+                                      rowhandler=VisitRowMapper(), key_column="pet_id")
+
+        The keys go to the last positional binding variable of sql_query, which is repeated once per key, while
+        a tuple of args is bound to the others. With a dictionary of args, the keys go to :keys instead.
+        key_column is the position or the name of the column holding the key. Rows are mapped by rowhandler,
+        if given."""
+        unique_keys = []
+        results = {}
+        for key in keys:
+            if key not in results:
+                results[key] = []
+                unique_keys.append(key)
+
+        for start in range(0, len(unique_keys), batch_size):
+            batch = unique_keys[start:start + batch_size]
+            # Pad the batch to a power of two, so only a few distinct statements are ever prepared.
+            size = 1
+            while size < len(batch):
+                size *= 2
+            batch = batch + [batch[-1]] * (min(size, batch_size) - len(batch))
+
+            if isinstance(args, dict):
+                batch_sql = factory.expand_binding(sql_query, len(batch), "keys", self.connection_factory.backslash_escapes)
+                batch_args = dict(args)
+                for i, key in enumerate(batch):
+                    batch_args["keys_%s" % i] = key
+            else:
+                batch_sql = factory.expand_binding(sql_query, len(batch), None, self.connection_factory.backslash_escapes)
+                batch_args = tuple(args or ()) + tuple(batch)
+
+            rows, metadata = self.__query_for_list(batch_sql, batch_args, "batched_query")
+            if not rows:
+                continue
+            if isinstance(key_column, types.StringTypes):
+                key_index = [column["name"] for column in metadata].index(key_column)
+            else:
+                key_index = key_column
+            if rowhandler is None:
+                map_row = None
+            elif hasattr(rowhandler, "compile_row_mapper"):
+                map_row = rowhandler.compile_row_mapper(metadata)
+            else:
+                map_row = lambda row: rowhandler.map_row(row, metadata)
+
+            for row in rows:
+                if map_row is None:
+                    results.setdefault(row[key_index], []).append(row)
+                else:
+                    results.setdefault(row[key_index], []).append(map_row(row))
+        return results
+
+    def __fan_out_executor(self):
+        if self.fan_out_executor is not None:
+            return self.fan_out_executor
+        if hasattr(self.connection_factory, "get_executor") and self.connection_factory.max_size > 1:
+            return self.connection_factory.get_executor()
+        return None
     
-    def __query_for_list(self, sql_query, args = None):
+    def __query_for_list(self, sql_query, args = None, operation = "query", raise_error = False):
         """Execute a query for a result list, given static SQL. If args is provided, bind the arguments 
-        (to avoid SQL injection attacks)."""
+        (to avoid SQL injection attacks). A failing query gives no rows, or with raise_error, a DataAccessException."""
 
-        if args and type(args) not in self.connection_factory.acceptable_types:
-            raise InvalidArgumentType(type(args), self.connection_factory.acceptable_types)
-
-        sql_query = self.connection_factory.convert_sql_binding(sql_query)
+        sql_query, args = self.__prepare_query(sql_query, args)
+
+        cache = self.query_cache
+        if cache is not None and self.connection_factory.holds_connection():
+            cache = None
+        if cache is not None:
+            cached = cache.get(sql_query, args)
+            if cached is not None:
+                return list(cached[0]), cached[1]
+            token = cache.begin()
         
-        cursor = self.__db.cursor()
+        probe = self.__probe(operation, sql_query, args)
+        connection = self.connection_factory.getReadConnection()
+        probe.got_connection()
         error = None
         results = None
         metadata = None
         try:
+            cursor = self.connection_factory.open_cursor(connection, sql_query)
+            probe.opened_cursor()
             try:
-                if args:
-                    cursor.execute(sql_query, args)
-                else:
-                    cursor.execute(sql_query)
-                results = cursor.fetchall()
-                metadata = [{"name":row[0], "type_code":row[1], "display_size":row[2], "internal_size":row[3], "precision":row[4], "scale":row[5], "null_ok":row[6]} for row in cursor.description]
-            except Exception, e:
-                self.logger.debug("query_for_list.execute: Trapped %s while trying to execute '%s'" % (e, sql_query))
-                error = e
+                try:
+                    if args:
+                        cursor.execute(sql_query, args)
+                    else:
+                        cursor.execute(sql_query)
+                    results = cursor.fetchall()
+                    metadata = self.__metadata(cursor)
+                except Exception, e:
+                    self.logger.debug("query_for_list.execute: Trapped %s while trying to execute '%s'" % (e, sql_query))
+                    error = e
+            finally:
+                try:
+                    self.connection_factory.close_cursor(connection, sql_query, cursor, error is None)
+                except Exception, e:
+                    self.logger.debug("query_for_list.close: Trapped %s, and throwing away." % e)
+                probe.closed_cursor()
         finally:
-            try:
-                cursor.close()
-            except Exception, e:
-                self.logger.debug("query_for_list.close: Trapped %s, and throwing away." % e)
+            self.connection_factory.releaseConnection(connection)
+            probe.done(len(results or []), error)
 
         if error:
+            if raise_error:
+                raise DataAccessException(error)
             self.logger.debug("query_for_list: I thought about kicking this up the chain => %s" % error)
+        elif cache is not None:
+            cache.put(sql_query, args, tuple(results), metadata, token)
 
         # Convert multi-item tuple into list
         return [result for result in results or []], metadata
 
+    def __metadata(self, cursor):
+        """Result sets of the same shape share the same metadata list, so row mappers only have to
+        compile it once."""
+        description = tuple([tuple(column) for column in cursor.description])
+        metadata = self.metadata_cache.get(description)
+        if metadata is None:
+            metadata = [{"name":row[0], "type_code":row[1], "display_size":row[2], "internal_size":row[3], "precision":row[4], "scale":row[5], "null_ok":row[6]} for row in description]
+            self.metadata_cache.put(description, metadata)
+        return metadata
+
+    def query_iter(self, sql_query, args = None, rowhandler = None, fetch_size = None):
+        """Execute a query given static SQL, and return a generator that maps each row with a RowMapper
+        as it is read. Rows are pulled from the cursor fetch_size at a time (defaulting to the cursor's
+        arraysize), so memory stays flat no matter how big the result set is. The cursor is closed when the
+        generator is exhausted or closed. If args is provided, bind the arguments (to avoid SQL injection attacks)."""
+
+        # Same argument shifting check as query().
+        if args and not rowhandler:
+            raise ArgumentMustBeNamed(arg_name="rowhandler")
+
+        sql_query, args = self.__prepare_query(sql_query, args)
+        return self.__query_for_iter(sql_query, args, rowhandler, fetch_size)
+
+    def query_for_iter(self, sql_query, args = None, fetch_size = None):
+        """Execute a query for a stream of raw rows, given static SQL. See query_iter."""
+        sql_query, args = self.__prepare_query(sql_query, args)
+        return self.__query_for_iter(sql_query, args, None, fetch_size)
+
+    def query_columns(self, sql_query, args = None, fetch_size = None):
+        """Execute a query given static SQL, and return its result set as a ColumnResult. Rows are read
+        fetch_size at a time straight into one buffer per column. Integer and float columns are stored in
+        typed array.array buffers, everything else (and any column holding NULLs) in lists. If args is provided,
+        bind the arguments (to avoid SQL injection attacks)."""
+        sql_query, args = self.__prepare_query(sql_query, args)
+        return self.__query_columns("query_columns", sql_query, args, fetch_size)
+
+    def query_to_arrays(self, sql_query, args = None, fetch_size = None):
+        """Like query_columns, but when NumPy is available, the columns of the result are NumPy arrays.
+        Typed columns are wrapped without being copied."""
+        sql_query, args = self.__prepare_query(sql_query, args)
+        result = self.__query_columns("query_to_arrays", sql_query, args, fetch_size)
+        try:
+            import numpy
+        except ImportError:
+            return result
+        return ColumnResult(result.names, [_to_numpy(numpy, column) for column in result.columns])
+
+    def __query_columns(self, operation, sql_query, args, fetch_size):
+        chunks = self.__query_for_chunks(operation, sql_query, args, fetch_size)
+        try:
+            metadata = chunks.next()
+            buffers = None
+            for rows in chunks:
+                columns = zip(*rows)
+                if buffers is None:
+                    buffers = [_ColumnBuffer(_typecode(column_metadata["type_code"], column))
+                               for column_metadata, column in zip(metadata, columns)]
+                for buffer, column in zip(buffers, columns):
+                    buffer.extend(column)
+        finally:
+            chunks.close()
+
+        if buffers is None:
+            buffers = [_ColumnBuffer(_typecode(column_metadata["type_code"], ())) for column_metadata in metadata]
+        return ColumnResult([column_metadata["name"] for column_metadata in metadata], [buffer.values for buffer in buffers])
+
+    def __prepare_query(self, sql_query, args):
+        if args and type(args) not in self.connection_factory.acceptable_types:
+            raise InvalidArgumentType(type(args), self.connection_factory.acceptable_types)
+
+        return self.connection_factory.convert_sql_binding_args(sql_query, args)
+
+    def __query_for_iter(self, sql_query, args, rowhandler, fetch_size):
+        chunks = self.__query_for_chunks("query_iter", sql_query, args, fetch_size)
+        try:
+            metadata = chunks.next()
+            if rowhandler is None:
+                map_row = None
+            elif hasattr(rowhandler, "compile_row_mapper"):
+                map_row = rowhandler.compile_row_mapper(metadata)
+            else:
+                map_row = lambda row: rowhandler.map_row(row, metadata)
+
+            for rows in chunks:
+                if map_row is None:
+                    for row in rows:
+                        yield row
+                else:
+                    for row in rows:
+                        yield map_row(row)
+        finally:
+            chunks.close()
+
+    def __query_for_chunks(self, operation, sql_query, args, fetch_size):
+        """Generator running the query, which first yields the metadata of the result set, and then
+        its rows, fetch_size at a time. The cursor stays open until the generator is exhausted or closed."""
+        probe = self.__probe(operation, sql_query, args)
+        connection = self.connection_factory.getReadConnection()
+        probe.got_connection()
+        error = None
+        row_count = 0
+        exhausted = False
+        try:
+            cursor = self.connection_factory.open_cursor(connection, sql_query)
+            probe.opened_cursor()
+            try:
+                try:
+                    if args:
+                        cursor.execute(sql_query, args)
+                    else:
+                        cursor.execute(sql_query)
+                    if fetch_size is not None:
+                        cursor.arraysize = fetch_size
+                    metadata = self.__metadata(cursor)
+                except Exception, e:
+                    self.logger.debug("%s.execute: Trapped %s while trying to execute '%s'" % (operation, e, sql_query))
+                    error = e
+                    raise DataAccessException(e)
+
+                yield metadata
+                while True:
+                    rows = cursor.fetchmany()
+                    if not rows:
+                        exhausted = True
+                        break
+                    row_count += len(rows)
+                    yield rows
+            finally:
+                try:
+                    self.connection_factory.close_cursor(connection, sql_query, cursor, exhausted)
+                except Exception, e:
+                    self.logger.debug("%s.close: Trapped %s, and throwing away." % (operation, e))
+                probe.closed_cursor()
+        finally:
+            self.connection_factory.releaseConnection(connection)
+            probe.done(row_count, error)
+
     def query_for_int(self, sql_query, args = None):
         """Execute a query that results in an int value, given static SQL. If args is provided, bind the arguments 
         (to avoid SQL injection attacks)."""
@@ -180,42 +509,253 @@ class DatabaseTemplate(object):
         """Issue a single SQL update.  If args is provided, bind the arguments 
         (to avoid SQL injection attacks)."""
         return self.execute(sql_statement, args)
+
+    def batch_update(self, sql_statement, seq_of_args, batch_size = 1000):
+        """Issue the same SQL update once for every set of arguments in seq_of_args, which can be any
+        iterable, including a generator. The arguments are sent to cursor.executemany batch_size at a
+        time, so only one batch is held in memory. Returns the list of rows affected by each batch, as
+        reported by the driver. Like update, this joins the current transaction, if there is one."""
+        converted_sql = self.connection_factory.convert_sql_binding(sql_statement)
+        seq_of_args = iter(seq_of_args)
+
+        probe = self.__probe("batch_update", converted_sql)
+        connection = self.connection_factory.getConnection()
+        probe.got_connection()
+        error = None
+        rows_affected = []
+        try:
+            cursor = self.connection_factory.open_cursor(connection, converted_sql)
+            probe.opened_cursor()
+            try:
+                while True:
+                    batch = []
+                    for args in islice(seq_of_args, batch_size):
+                        if type(args) not in self.connection_factory.acceptable_types:
+                            raise InvalidArgumentType(type(args), self.connection_factory.acceptable_types)
+                        batch.append(self.connection_factory.convert_sql_binding_args(sql_statement, args)[1])
+                    if not batch:
+                        break
+                    try:
+                        cursor.executemany(converted_sql, batch)
+                    except Exception, e:
+                        self.logger.debug("batch_update.executemany: Trapped %s while trying to execute '%s'" % (e, sql_statement))
+                        error = e
+                        raise DataAccessException(e)
+                    rows_affected.append(cursor.rowcount)
+            finally:
+                try:
+                    self.connection_factory.close_cursor(connection, converted_sql, cursor, error is None)
+                except Exception, e:
+                    self.logger.debug("batch_update.close: Trapped %s, and throwing away." % e)
+                probe.closed_cursor()
+        finally:
+            self.connection_factory.releaseConnection(connection)
+            self.__invalidate(converted_sql)
+            probe.done(sum([count for count in rows_affected if count > 0]), error)
+
+        return rows_affected
+
+    def bulk_load(self, table, columns, rows, batch_size = 1000):
+        """Load rows, any iterable of tuples lined up with columns, into table with the bulk loader of the
+        connection factory (see ConnectionFactory.bulk_load), which is much faster than batch_update for large
+        loads. Returns the number of rows loaded. Like update, this joins the current transaction, if there is one."""
+        sql = "INSERT INTO %s (%s)" % (table, ", ".join(columns))
+        probe = self.__probe("bulk_load", sql)
+        error = None
+        loaded = 0
+        try:
+            try:
+                loaded = self.connection_factory.bulk_load(table, columns, rows, batch_size)
+            except Exception, e:
+                error = e
+                raise
+        finally:
+            self.__invalidate(sql)
+            probe.done(loaded, error)
+        return loaded
     
     
+def _typecode(type_code, values):
+    """Pick the array.array typecode for a column, going by cursor.description when the driver describes
+    columns with Python types, and by the first value otherwise. None means the column is kept in a list."""
+    if type_code in (types.IntType, types.LongType, types.FloatType):
+        kind = type_code
+    else:
+        kind = None
+        for value in values:
+            if value is not None:
+                kind = type(value)
+                break
+    if kind in (types.IntType, types.LongType):
+        return "l"
+    if kind is types.FloatType:
+        return "d"
+    return None
+
+def _to_numpy(numpy, column):
+    if isinstance(column, array.array):
+        return numpy.frombuffer(column, dtype=column.typecode)
+    return numpy.array(column, dtype=object)
+
+class _ColumnBuffer(object):
+    """Grows one column of a ColumnResult, falling back from a typed array to a list when a value doesn't fit."""
+    def __init__(self, typecode):
+        if typecode is None:
+            self.values = []
+        else:
+            self.values = array.array(typecode)
+
+    def extend(self, values):
+        size = len(self.values)
+        try:
+            self.values.extend(values)
+        except (TypeError, OverflowError):
+            del self.values[size:]
+            self.values = self.values.tolist()
+            self.values.extend(values)
+
+class ColumnResult(object):
+    """
+    A column oriented result set, returned by DatabaseTemplate.query_columns and query_to_arrays.
+
+    result["name"] (or result.column("name")) returns a whole column, result[i] returns one row as a
+    tuple, and slicing (result[10:20]) returns another ColumnResult sharing the same column buffers,
+    without copying them. Fetching a column of a slice copies that part of it, unless the columns are
+    NumPy arrays, which are sliced into views.
+    """
+    def __init__(self, names, columns, start = 0, stop = None):
+        self.names = names
+        self.columns = columns
+        self._index = dict([(name, i) for (i, name) in enumerate(names)])
+        self._start = start
+        if stop is None:
+            if columns:
+                stop = len(columns[0])
+            else:
+                stop = 0
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def column(self, name):
+        column = self.columns[self._index[name]]
+        if self._start == 0 and self._stop == len(column):
+            return column
+        return column[self._start:self._stop]
+
+    def __getitem__(self, key):
+        if isinstance(key, types.SliceType):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("ColumnResult can only be sliced with a step of 1")
+            return ColumnResult(self.names, self.columns, self._start + start, self._start + max(start, stop))
+        if isinstance(key, types.StringTypes):
+            return self.column(key)
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("row %s is out of range" % key)
+        return tuple([column[self._start + key] for column in self.columns])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def as_dict(self):
+        """Returns a dictionary of columns, keyed by column name."""
+        return dict([(name, self.column(name)) for name in self.names])
+
 class RowMapper(object):
     """
     This is an interface to handle one row of data.
+
+    A row mapper may also offer compile_row_mapper(metadata), returning a callable that maps one
+    row of a result set with that metadata. DatabaseTemplate calls it once per result set, and
+    then skips map_row.
     """
     def map_row(self, row, metadata=None):
         raise NotImplementedError()
 
-class DictionaryRowMapper(RowMapper):
+class CompiledRowMapper(RowMapper):
     """
-    This row mapper converts the tuple into a dictionary using the column names as the keys.
+    Base class for row mappers that work out the column layout once per result set. Subclasses
+    implement _compile(names), returning a callable that maps one row. The last compiled layout is
+    kept, since DatabaseTemplate hands the same metadata list to every result set of the same shape.
     """
+    def __init__(self):
+        self._compiled = (None, None)
+
+    def compile_row_mapper(self, metadata):
+        if self.__class__.map_row.im_func is not CompiledRowMapper.map_row.im_func:
+            # A subclass overriding map_row expects to be called for every row.
+            return lambda row: self.map_row(row, metadata)
+        return self._compile_row_mapper(metadata)
+
     def map_row(self, row, metadata=None):
-        if metadata is not None:
-            obj = {}
-            for i, column in enumerate(metadata):
-                obj[column["name"]] = row[i]
-            return obj
-        else:
-            raise DataAccessException("metadata is None, unable to convert result set into a dictionary")
+        return self._compile_row_mapper(metadata)(row)
+
+    def _compile_row_mapper(self, metadata):
+        if metadata is None:
+            raise DataAccessException(self._missing_metadata_message())
+        compiled_metadata, map_row = self._compiled
+        if compiled_metadata is not metadata:
+            map_row = self._compile([column["name"] for column in metadata])
+            self._compiled = (metadata, map_row)
+        return map_row
+
+    def _compile(self, names):
+        raise NotImplementedError()
 
-class SimpleRowMapper(RowMapper):
+    def _missing_metadata_message(self):
+        return "metadata is None, unable to map result set"
+
+class DictionaryRowMapper(CompiledRowMapper):
+    """
+    This row mapper converts the tuple into a dictionary using the column names as the keys.
+    """
+    def _compile(self, names):
+        return lambda row: dict(zip(names, row))
+
+    def _missing_metadata_message(self):
+        return "metadata is None, unable to convert result set into a dictionary"
+
+class SimpleRowMapper(CompiledRowMapper):
     """
     This row mapper uses convention over configuration to create and populate attributes
     of an object.
     """
     def __init__(self, clazz):
+        CompiledRowMapper.__init__(self)
         self.clazz = clazz
 
-    def map_row(self, row, metadata=None):
-        if metadata is not None:
-            obj = self.clazz()
-            for i, column in enumerate(metadata):
-                setattr(obj, column["name"], row[i])
-            return obj
+    def _compile(self, names):
+        clazz = self.clazz
+        if self._plain_attributes(names):
+            def map_row(row):
+                obj = clazz()
+                obj.__dict__.update(zip(names, row))
+                return obj
         else:
-            raise DataAccessException("metadata is None, unable to map result set into %s instance" % self.clazz)
+            def map_row(row):
+                obj = clazz()
+                for name, value in zip(names, row):
+                    setattr(obj, name, value)
+                return obj
+        return map_row
+
+    def _plain_attributes(self, names):
+        """Columns can be stored straight into the instance dictionary, unless the class customizes
+        attribute assignment, or some column is a property, slot or other descriptor of the class."""
+        if not isinstance(self.clazz, type) or "__slots__" in dir(self.clazz):
+            return False
+        if self.clazz.__setattr__ is not object.__setattr__:
+            return False
+        for name in names:
+            if hasattr(getattr(self.clazz, name, None), "__set__"):
+                return False
+        return True
+
+    def _missing_metadata_message(self):
+        return "metadata is None, unable to map result set into %s instance" % self.clazz
 
@@ -13,14 +13,131 @@
    See the License for the specific language governing permissions and
    limitations under the License.       
 """
+import logging
 import re
 import sys
+import tempfile
+import threading
+import time
 import types
+from cStringIO import StringIO
+from itertools import islice
+from springpython.database import CannotGetConnectionException
+from springpython.database import DataAccessException
+from springpython.util import LRUCache
+
+# The transactions of each thread, as the after_transaction callbacks of each one, keyed by connection factory.
+_bound = threading.local()
+
+def _transaction_stack(connection_factory):
+    stacks = getattr(_bound, "transactions", None)
+    if stacks is None:
+        stacks = _bound.transactions = {}
+    return stacks.setdefault(id(connection_factory), [])
+
+# Everything in a SQL statement, but string literals, that can contain, or look like, a binding variable.
+_SQL_TOKEN_RULES = r"""
+    | "(?:[^"]|"")*"                # quoted identifier
+    | --[^\n]*                      # line comment
+    | /\*.*?\*/                     # block comment
+    | ::                            # PostgreSQL cast, not a named parameter
+    | %%                            # escaped percent sign
+    | (?P<positional>\?|%s)
+    | (?<![\w:]):(?P<named>[A-Za-z_]\w*)
+    """
+# Keyed by whether a backslash escapes the next character of a string literal, as it does in MySQL.
+_SQL_TOKENS = {False: re.compile(r"'(?:[^']|'')*'" + _SQL_TOKEN_RULES, re.VERBOSE | re.DOTALL),
+               True: re.compile(r"'(?:[^'\\]|\\.|'')*'" + _SQL_TOKEN_RULES, re.VERBOSE | re.DOTALL)}
+
+def compile_sql_binding(sql_query, paramstyle = "format", named_paramstyle = "pyformat", backslash_escapes = False):
+    """Rewrite the binding variables of sql_query into the notation of a DB-API driver. Positional
+    variables may be written as '?' or '%s', and named variables as ':name'. Anything inside string
+    literals, quoted identifiers and comments is left alone.
+
+    paramstyle is the positional notation of the driver ("format" or "qmark"). named_paramstyle is its
+    named notation ("pyformat", "named"), or None if the driver only knows positional variables, in
+    which case named variables are turned into positional ones. With backslash_escapes, a backslash
+    inside a string literal escapes the next character, so \\' doesn't end it.
+
+    Returns the converted statement, and the tuple of names in the order they must be bound when
+    named variables were turned into positional ones (empty otherwise)."""
+    if paramstyle == "qmark":
+        positional, percent = "?", "%"
+    else:
+        positional, percent = "%s", "%%"
+
+    names = []
+    def convert(match):
+        token = match.group(0)
+        if match.group("positional"):
+            return positional
+        name = match.group("named")
+        if name:
+            if named_paramstyle == "pyformat":
+                return "%%(%s)s" % name
+            elif named_paramstyle == "named":
+                return token
+            names.append(name)
+            return positional
+        if token == "%%":
+            return percent
+        return token
+
+    return _SQL_TOKENS[backslash_escapes].sub(convert, sql_query), tuple(names)
+
+def expand_binding(sql_query, count, name = None, backslash_escapes = False):
+    """Repeat one binding variable of sql_query count times, separated by commas, to bind a list of values
+    to an IN (...) list. The variable is :name if a name is given, and the last positional variable otherwise.
+    Repeated named variables are numbered, :name_0, :name_1 and so on. backslash_escapes is as for
+    compile_sql_binding."""
+    matches = [match for match in _SQL_TOKENS[backslash_escapes].finditer(sql_query)
+               if (name is None and match.group("positional")) or (name is not None and match.group("named") == name)]
+    if not matches:
+        raise DataAccessException("'%s' has no binding variable to put the list in" % sql_query)
+    match = matches[-1]
+    if name is None:
+        expanded = ", ".join([match.group("positional")] * count)
+    else:
+        expanded = ", ".join([":%s_%s" % (name, i) for i in range(count)])
+    return sql_query[:match.start()] + expanded + sql_query[match.end():]
+
+def _copy_value(value):
+    """Write one value the way COPY and LOAD DATA read their default text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, types.UnicodeType):
+        value = value.encode("utf-8")
+    elif not isinstance(value, types.StringType):
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _copy_text(rows):
+    """Lay out a batch of rows as tab separated lines, in an in-memory buffer."""
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join([_copy_value(value) for value in row]))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
 
 class ConnectionFactory(object):
-    def __init__(self, acceptable_types):
+    # The binding variable notations of the underlying driver, and whether backslashes escape quotes in
+    # string literals. See compile_sql_binding.
+    paramstyle = "format"
+    named_paramstyle = "pyformat"
+    backslash_escapes = False
+
+    # Whether bulk_load tries the native loader of the database first. It is switched off the first time
+    # the loader fails, bulk_load then falls back to multi-row INSERTs.
+    native_bulk_load = False
+    # The most binding variables, and rows, a multi-row INSERT of bulk_load may hold.
+    bulk_insert_max_parameters = 999
+    bulk_insert_max_rows = None
+
+    def __init__(self, acceptable_types, sql_cache_size = 500):
         self.__db = None
         self.acceptable_types = acceptable_types
+        self.sql_cache = LRUCache(sql_cache_size)
 
     """This interface defines an object that is able to make database connections.
     This allows database connections to be defined inside application contexts, and
@@ -33,6 +150,50 @@ class ConnectionFactory(object):
             self.__db = self.connect()
         return self.__db
 
+    def getReadConnection(self):
+        """Fetch a connection that will only be read from. Factories that route reads elsewhere,
+        like RoutingConnectionFactory, override this, the others hand out their usual connection."""
+        return self.getConnection()
+
+    def holds_connection(self):
+        """Tells whether the calling thread is holding on to a connection of its own, for example for the
+        length of a transaction. A plain connection factory shares one connection, so it only does while
+        a transaction runs."""
+        return bool(getattr(_bound, "transactions", {}).get(id(self)))
+
+    def releaseConnection(self, connection):
+        """Hand back a connection fetched with getConnection. A plain connection factory
+        keeps reusing the same connection, so there is nothing to do here."""
+        pass
+
+    def begin_transaction(self, connection, read_only = False):
+        """Called by ConnectionFactoryTransactionManager to start a transaction of the calling thread on
+        connection, which runs on it until end_transaction. According to PEP 249, a commit silently starts
+        a new transaction, so whatever was pending on the connection is committed."""
+        self.commit()
+        _transaction_stack(self).append([])
+
+    def end_transaction(self, connection):
+        """Called by ConnectionFactoryTransactionManager once the transaction running on connection
+        committed or rolled back, and let go of it. Runs the callbacks registered with after_transaction."""
+        stack = _transaction_stack(self)
+        if not stack:
+            return
+        callbacks = stack.pop()
+        if not stack:
+            del _bound.transactions[id(self)]
+        for callback in callbacks:
+            callback()
+
+    def after_transaction(self, callback):
+        """Have callback() called once the transaction of the calling thread ends, whether it committed or
+        rolled back. Outside of a transaction, it is called right away."""
+        stack = getattr(_bound, "transactions", {}).get(id(self))
+        if stack:
+            stack[-1].append(callback)
+        else:
+            callback()
+
     def commit(self):
         if self.in_transaction():
             self.getConnection().commit()
@@ -46,24 +207,151 @@ class ConnectionFactory(object):
 
     def count_type(self):
         raise NotImplementedError()
+
+    def open_cursor(self, connection, sql_query):
+        """Returns a cursor to run sql_query on. DatabaseTemplate hands it back to close_cursor when it is
+        done with it, saying whether it is in a state to be reused."""
+        return connection.cursor()
+
+    def close_cursor(self, connection, sql_query, cursor, reusable = True):
+        cursor.close()
+
+    def supports_savepoints(self):
+        return True
+
+    def set_savepoint(self, connection, name):
+        self._execute_on(connection, "SAVEPOINT %s" % name)
+
+    def release_savepoint(self, connection, name):
+        self._execute_on(connection, "RELEASE SAVEPOINT %s" % name)
+
+    def rollback_to_savepoint(self, connection, name):
+        self._execute_on(connection, "ROLLBACK TO SAVEPOINT %s" % name)
+
+    def _execute_on(self, connection, sql):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+
+    def bulk_load(self, table, columns, rows, batch_size = 1000):
+        """Insert rows, any iterable of tuples lined up with columns, into table with the fastest means the
+        database offers: COPY for PostgreSQL, LOAD DATA LOCAL INFILE for MySQL, and INSERTs of many rows at
+        once everywhere else. Rows are read batch_size at a time, so only one batch is ever held in memory.
+        If the native loader fails on the first batch, it is given up for good, and INSERTs are used instead.
+
+        Returns the number of rows loaded. Like update, this joins the current transaction, and nothing is
+        committed here."""
+        connection = self.getConnection()
+        try:
+            try:
+                return self._bulk_load(connection, table, list(columns), iter(rows), batch_size)
+            except DataAccessException:
+                raise
+            except Exception, e:
+                raise DataAccessException(e)
+        finally:
+            self.releaseConnection(connection)
+
+    def _bulk_load(self, connection, table, columns, rows, batch_size):
+        loaded = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return loaded
+            if not self.native_bulk_load:
+                self._insert_rows(connection, table, columns, batch)
+            elif loaded == 0:
+                self._first_native_load(connection, table, columns, batch)
+            else:
+                self._native_load(connection, table, columns, batch)
+            loaded += len(batch)
+
+    def _first_native_load(self, connection, table, columns, rows):
+        """Try the native loader, and if it fails, undo whatever it did and insert the rows instead."""
+        savepoint = self.supports_savepoints()
+        if savepoint:
+            self.set_savepoint(connection, "SPRINGPYTHON_BULK_LOAD")
+        try:
+            self._native_load(connection, table, columns, rows)
+        except Exception, e:
+            logging.getLogger("springpython.database.factory.ConnectionFactory").warning(
+                "Native bulk load into %s failed (%s), falling back to INSERT" % (table, e))
+            self.native_bulk_load = False
+            if savepoint:
+                self.rollback_to_savepoint(connection, "SPRINGPYTHON_BULK_LOAD")
+            self._insert_rows(connection, table, columns, rows)
+            return
+        if savepoint:
+            self.release_savepoint(connection, "SPRINGPYTHON_BULK_LOAD")
+
+    def _native_load(self, connection, table, columns, rows):
+        raise NotImplementedError()
+
+    def _insert_rows(self, connection, table, columns, rows):
+        """INSERT as many rows per statement as the database accepts. Only the last statement of a batch
+        holds fewer rows, so a few statements are converted and prepared over and over."""
+        per_statement = max(1, self.bulk_insert_max_parameters // len(columns))
+        if self.bulk_insert_max_rows is not None:
+            per_statement = min(per_statement, self.bulk_insert_max_rows)
+        row_sql = "(%s)" % ", ".join(["?"] * len(columns))
+        cursor = connection.cursor()
+        try:
+            for start in range(0, len(rows), per_statement):
+                chunk = rows[start:start + per_statement]
+                sql = self.convert_sql_binding("INSERT INTO %s (%s) VALUES %s" % (table, ", ".join(columns), ", ".join([row_sql] * len(chunk))))
+                args = []
+                for row in chunk:
+                    args.extend(row)
+                cursor.execute(sql, tuple(args))
+        finally:
+            cursor.close()
     
     def convert_sql_binding(self, sql_query):
         """This is to help Java users migrate to Python. Java notation defines binding variables
         points with '?', while Python uses '%s', and this method will convert from one format
         to the other."""
-        return re.sub(pattern="\?", repl="%s", string=sql_query)
+        return self._compile_sql_binding(sql_query)[0]
+
+    def convert_sql_binding_args(self, sql_query, args):
+        """Convert the binding variables of sql_query like convert_sql_binding, and when named variables
+        had to be turned into positional ones, reorder a dictionary of args into the matching tuple."""
+        sql_query, names = self._compile_sql_binding(sql_query)
+        if names and isinstance(args, dict):
+            args = tuple([args[name] for name in names])
+        return sql_query, args
+
+    def _compile_sql_binding(self, sql_query):
+        """Statements are converted once, and then served from a bounded LRU cache."""
+        key = (self.paramstyle, self.named_paramstyle, sql_query, self.backslash_escapes)
+        compiled = self.sql_cache.get(key)
+        if compiled is None:
+            compiled = compile_sql_binding(sql_query, self.paramstyle, self.named_paramstyle, self.backslash_escapes)
+            self.sql_cache.put(key, compiled)
+        return compiled
 
 class MySQLConnectionFactory(ConnectionFactory):
-    def __init__(self, username = None, password = None, hostname = None, db = None):
-        ConnectionFactory.__init__(self, [types.TupleType])
+    """With local_infile, connections are allowed to send files to the server, and bulk_load uses
+    LOAD DATA LOCAL INFILE. It is off by default, since it also lets the server ask for client files.
+
+    MySQL lets backslashes escape quotes in string literals, unless the server runs in the
+    NO_BACKSLASH_ESCAPES SQL mode, in which case backslash_escapes should be turned off."""
+    def __init__(self, username = None, password = None, hostname = None, db = None, local_infile = False, backslash_escapes = True):
+        ConnectionFactory.__init__(self, [types.TupleType, types.DictType])
         self.username = username
         self.password = password
         self.hostname = hostname
         self.db = db
+        self.local_infile = local_infile
+        self.native_bulk_load = local_infile
+        self.backslash_escapes = backslash_escapes
         
     def connect(self):
         """The import statement is delayed so the library is loaded ONLY if this factory is really used."""
         import MySQLdb
+        if self.local_infile:
+            return MySQLdb.connect(self.hostname, self.username, self.password, self.db, local_infile=1)
         return MySQLdb.connect(self.hostname, self.username, self.password, self.db)
 
     def in_transaction(self):
@@ -72,9 +360,22 @@ class MySQLConnectionFactory(ConnectionFactory):
     def count_type(self):
         return types.LongType
 
+    def _native_load(self, connection, table, columns, rows):
+        """MySQLdb can only send a real file, so each batch is spilled to a temporary file of its own."""
+        data = tempfile.NamedTemporaryFile(prefix="springpython_bulk_load")
+        try:
+            data.write(_copy_text(rows).getvalue())
+            data.flush()
+            path = data.name.replace("\\", "\\\\").replace("'", "\\'")
+            self._execute_on(connection, "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s (%s)" % (path, table, ", ".join(columns)))
+        finally:
+            data.close()
+
 class PgdbConnectionFactory(ConnectionFactory):
+    native_bulk_load = True
+
     def __init__(self, user = None, password = None, host = None, database = None):
-        ConnectionFactory.__init__(self, [types.TupleType])
+        ConnectionFactory.__init__(self, [types.TupleType, types.DictType])
         self.user = user
         self.password = password
         self.host = host
@@ -91,17 +392,26 @@ class PgdbConnectionFactory(ConnectionFactory):
     def count_type(self):
         return types.LongType
 
+    def _native_load(self, connection, table, columns, rows):
+        """COPY ... FROM STDIN, fed from an in-memory buffer. Drivers without cursor.copy_from fall back to INSERT."""
+        cursor = connection.cursor()
+        try:
+            cursor.copy_from(_copy_text(rows), table, columns=columns)
+        finally:
+            cursor.close()
+
 class Sqlite3ConnectionFactory(ConnectionFactory):
-    def __init__(self, db = None):
-        ConnectionFactory.__init__(self, [types.TupleType])
+    def __init__(self, db = None, check_same_thread = True):
+        ConnectionFactory.__init__(self, [types.TupleType, types.DictType])
         self.db = db
+        self.check_same_thread = check_same_thread
         self.using_sqlite3 = True
 
     def connect(self):
         """The import statement is delayed so the library is loaded ONLY if this factory is really used."""
         try:
             import sqlite3
-            return sqlite3.connect(self.db)               
+            return sqlite3.connect(self.db, check_same_thread=self.check_same_thread)               
         except:
             import sqlite
             self.using_sqlite3 = False
@@ -113,15 +423,32 @@ class Sqlite3ConnectionFactory(ConnectionFactory):
     def count_type(self):
         return types.IntType
 
-    def convert_sql_binding(self, sql_query):
+    def supports_savepoints(self):
+        """Before Python 3.6, the sqlite3 module commits the current transaction ahead of any statement
+        it doesn't recognize, SAVEPOINT included."""
+        return sys.version_info >= (3, 6)
+
+    def _get_paramstyle(self):
         if self.using_sqlite3:
             """sqlite3 uses the ? notation, like Java's JDBC."""
-            return re.sub(pattern="%s", repl="?", string=sql_query)
+            return "qmark"
         else:
             """Older versions of sqlite use the %s notation"""
-            return re.sub(pattern="\?", repl="%s", string=sql_query)
+            return "format"
+
+    def _get_named_paramstyle(self):
+        if self.using_sqlite3:
+            return "named"
+        else:
+            return "pyformat"
+
+    paramstyle = property(_get_paramstyle)
+    named_paramstyle = property(_get_named_paramstyle)
 
 class cxoraConnectionFactory(ConnectionFactory):
+    # cx_Oracle binds :name variables natively.
+    named_paramstyle = "named"
+
     def __init__(self, username = None, password = None, hostname = None, db = None):
         ConnectionFactory.__init__(self, [types.DictType])
         self.username = username
@@ -133,10 +460,20 @@ class cxoraConnectionFactory(ConnectionFactory):
         """The import statement is delayed so the library is loaded ONLY if this factory is really used."""
         import cx_Oracle
         return cx_Oracle.connect(self.username, self.password, self.db)
+
+    def release_savepoint(self, connection, name):
+        """Oracle has no RELEASE SAVEPOINT, savepoints go away with the transaction."""
+        pass
         
 class SQLServerConnectionFactory(ConnectionFactory):
+    """SQL Server expects parameters to be passed as question marks, and pyodbc has no named notation."""
+    paramstyle = "qmark"
+    named_paramstyle = None
+    bulk_insert_max_parameters = 2000
+    bulk_insert_max_rows = 1000
+
     def __init__(self, **odbc_info):
-        ConnectionFactory.__init__(self, [types.TupleType])
+        ConnectionFactory.__init__(self, [types.TupleType, types.DictType])
         self.odbc_info = odbc_info
 
     def connect(self):
@@ -150,7 +487,586 @@ class SQLServerConnectionFactory(ConnectionFactory):
         
     def count_type(self):
         return types.IntType
-        
+
+    def set_savepoint(self, connection, name):
+        self._execute_on(connection, "SAVE TRANSACTION %s" % name)
+
+    def release_savepoint(self, connection, name):
+        """SQL Server has no way to release a savepoint, they go away with the transaction."""
+        pass
+
+    def rollback_to_savepoint(self, connection, name):
+        self._execute_on(connection, "ROLLBACK TRANSACTION %s" % name)
+
+class _ConnectionHolder(object):
+    """Keeps track of the pooled connection bound to one thread, and how many callers are holding it."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 1
+        self.read_only = False
+
+class StatementCache(object):
+    """
+    Keeps open cursors for one connection, one per distinct SQL string, so statements can be reused
+    instead of being parsed again. Drivers that prepare statements through cursor.prepare (like cx_Oracle)
+    get each statement prepared once, and skip parsing when the same statement runs again on that cursor.
+
+    A cursor is taken out of the cache while in use, so two calls running the same statement at once
+    each get their own. Once max_size statements are cached, the least recently used cursor is closed.
+    """
+    def __init__(self, connection, max_size = 100):
+        self.connection = connection
+        self.cursors = LRUCache(max_size, on_evict=self._close_cursor)
+        self.prepares = 0
+        self.hits = 0
+
+    def open_cursor(self, sql_query):
+        cursor = self.cursors.pop(sql_query)
+        if cursor is not None:
+            self.hits += 1
+            return cursor
+        cursor = self.connection.cursor()
+        if hasattr(cursor, "prepare"):
+            cursor.prepare(sql_query)
+        self.prepares += 1
+        return cursor
+
+    def close_cursor(self, sql_query, cursor, reusable = True):
+        if reusable and sql_query not in self.cursors:
+            self.cursors.put(sql_query, cursor)
+        else:
+            cursor.close()
+
+    def close(self):
+        for sql_query in self.cursors.keys():
+            self._close_cursor(sql_query, self.cursors.pop(sql_query))
+
+    def _close_cursor(self, sql_query, cursor):
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+class RoutingConnectionFactory(ConnectionFactory):
+    """
+    This connection factory splits reads from writes. DatabaseTemplate fetches the connections of its
+    query methods with getReadConnection, which goes to one of the replica factories, taken in turn.
+    Everything else (execute, update, batch_update, and transactions that aren't read only) goes to the
+    primary factory. If a replica fails to connect, the next one is tried, and then the primary.
+
+    A transaction runs entirely on the factory its connection came from. Outside of one, writes always go
+    to the primary, even while the thread holds on to a replica connection to read from, for example in the
+    middle of a query_for_iter loop, and reads reuse the connection the thread holds. With sticky_after_write, a thread that wrote to the
+    primary keeps reading from it, so it sees its own writes despite replication lag, until end_request()
+    is called (from a request filter for example) or, if set, sticky_seconds have gone by.
+
+    Every factory is expected to talk to the same kind of database, the primary is the one consulted
+    about SQL conversion and types.
+    """
+    def __init__(self, primary = None, replicas = None, sticky_after_write = True, sticky_seconds = None):
+        self.primary = primary
+        if replicas is None:
+            replicas = []
+        self.replicas = replicas
+        self.sticky_after_write = sticky_after_write
+        self.sticky_seconds = sticky_seconds
+        self.logger = logging.getLogger("springpython.database.factory.RoutingConnectionFactory")
+        self._lock = threading.Lock()
+        self._next_replica = 0
+        self._bound = threading.local()
+
+    def _get_acceptable_types(self):
+        return self.primary.acceptable_types
+
+    acceptable_types = property(_get_acceptable_types)
+
+    def _get_backslash_escapes(self):
+        return self.primary.backslash_escapes
+
+    backslash_escapes = property(_get_backslash_escapes)
+
+    def connect(self):
+        return self.primary.connect()
+
+    def getConnection(self):
+        target = self._transaction_factory()
+        if target is None:
+            target = self.primary
+        if target is self.primary and self.sticky_after_write:
+            self._bound.last_write = time.time()
+        return self._get(target)
+
+    def getReadConnection(self):
+        target = self._transaction_factory()
+        if target is not None:
+            return self._get(target)
+        if not self.replicas or self._sticky():
+            return self._get(self.primary)
+        target = self._held_factory()
+        if target is not None:
+            return self._get(target)
+
+        self._lock.acquire()
+        try:
+            start = self._next_replica % len(self.replicas)
+            self._next_replica = start + 1
+        finally:
+            self._lock.release()
+
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            try:
+                return self._get(replica)
+            except Exception, e:
+                self.logger.debug("Trapped %s while connecting to replica %s, trying the next one." % (e, replica))
+        return self._get(self.primary)
+
+    def releaseConnection(self, connection):
+        holds = self._holds()
+        hold = holds.get(id(connection))
+        if hold is None:
+            return
+        hold[1] -= 1
+        if hold[1] == 0:
+            del holds[id(connection)]
+        hold[0].releaseConnection(connection)
+
+    def holds_connection(self):
+        return self._held_factory() is not None or ConnectionFactory.holds_connection(self)
+
+    def begin_transaction(self, connection, read_only = False):
+        transactions = self._transactions()
+        transactions.append(self._owner(connection))
+        try:
+            ConnectionFactory.begin_transaction(self, connection, read_only)
+        except:
+            transactions.pop()
+            raise
+
+    def end_transaction(self, connection):
+        transactions = self._transactions()
+        if transactions:
+            transactions.pop()
+        ConnectionFactory.end_transaction(self, connection)
+
+    def end_request(self):
+        """Forget about the writes made by the calling thread, so its reads go back to the replicas."""
+        self._bound.last_write = None
+
+    def commit(self):
+        (self._transaction_factory() or self.primary).commit()
+
+    def rollback(self):
+        (self._transaction_factory() or self.primary).rollback()
+
+    def in_transaction(self):
+        return self.primary.in_transaction()
+
+    def count_type(self):
+        return self.primary.count_type()
+
+    def convert_sql_binding(self, sql_query):
+        return self.primary.convert_sql_binding(sql_query)
+
+    def convert_sql_binding_args(self, sql_query, args):
+        return self.primary.convert_sql_binding_args(sql_query, args)
+
+    def open_cursor(self, connection, sql_query):
+        return self._owner(connection).open_cursor(connection, sql_query)
+
+    def close_cursor(self, connection, sql_query, cursor, reusable = True):
+        self._owner(connection).close_cursor(connection, sql_query, cursor, reusable)
+
+    def supports_savepoints(self):
+        return self.primary.supports_savepoints()
+
+    def set_savepoint(self, connection, name):
+        self._owner(connection).set_savepoint(connection, name)
+
+    def release_savepoint(self, connection, name):
+        self._owner(connection).release_savepoint(connection, name)
+
+    def rollback_to_savepoint(self, connection, name):
+        self._owner(connection).rollback_to_savepoint(connection, name)
+
+    def _bulk_load(self, connection, table, columns, rows, batch_size):
+        return self._owner(connection)._bulk_load(connection, table, columns, rows, batch_size)
+
+    def _get(self, target):
+        connection = target.getConnection()
+        holds = self._holds()
+        hold = holds.get(id(connection))
+        if hold is None:
+            holds[id(connection)] = [target, 1]
+        else:
+            hold[1] += 1
+        return connection
+
+    def _holds(self):
+        """The connections held by the calling thread, as [factory, count] keyed by connection id."""
+        holds = getattr(self._bound, "holds", None)
+        if holds is None:
+            holds = self._bound.holds = {}
+        return holds
+
+    def _held_factory(self):
+        for target, count in self._holds().values():
+            return target
+        return None
+
+    def _transactions(self):
+        """The factories the transactions of the calling thread run on, the current one last."""
+        transactions = getattr(self._bound, "transactions", None)
+        if transactions is None:
+            transactions = self._bound.transactions = []
+        return transactions
+
+    def _transaction_factory(self):
+        transactions = self._transactions()
+        if transactions:
+            return transactions[-1]
+        return None
+
+    def _owner(self, connection):
+        hold = self._holds().get(id(connection))
+        if hold is None:
+            return self.primary
+        return hold[0]
+
+    def _sticky(self):
+        last_write = getattr(self._bound, "last_write", None)
+        if last_write is None:
+            return False
+        if self.sticky_seconds is not None and time.time() - last_write > self.sticky_seconds:
+            self._bound.last_write = None
+            return False
+        return True
+
+class PooledConnectionFactory(ConnectionFactory):
+    """
+    This connection factory wraps any other connection factory, and hands out connections from a
+    bounded pool instead of sharing one single connection between every caller.
+
+    A connection is bound to the calling thread from the first getConnection until the matching
+    releaseConnection. DatabaseTemplate holds it for the duration of one call, and the
+    ConnectionFactoryTransactionManager holds it for a whole transaction, while other threads
+    work against their own connections. When the last hold is released, the connection is
+    committed (or rolled back if commit_on_return is False) and returned to the pool.
+
+    With statement_cache_size set, every pooled connection gets a StatementCache of that many statements,
+    and DatabaseTemplate reuses its cursors instead of opening a new one for every call.
+
+    NOTE: sqlite3 connections refuse to be used by more than one thread, unless the wrapped
+    Sqlite3ConnectionFactory is created with check_same_thread=False.
+    """
+    def __init__(self, target_factory = None, min_size = 0, max_size = 10, max_idle_time = None,
+                 validation_query = None, wait_timeout = None, commit_on_return = True, statement_cache_size = 0):
+        self.target_factory = target_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.validation_query = validation_query
+        self.wait_timeout = wait_timeout
+        self.commit_on_return = commit_on_return
+        self.statement_cache_size = statement_cache_size
+        self.logger = logging.getLogger("springpython.database.factory.PooledConnectionFactory")
+        self.statement_caches = {}
+
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = []
+        self._size = 0
+        self._filled = False
+        self._closed = False
+        self._executor = None
+        self._bound = threading.local()
+
+    def _get_acceptable_types(self):
+        return self.target_factory.acceptable_types
+
+    acceptable_types = property(_get_acceptable_types)
+
+    def _get_backslash_escapes(self):
+        return self.target_factory.backslash_escapes
+
+    backslash_escapes = property(_get_backslash_escapes)
+
+    def connect(self):
+        return self.target_factory.connect()
+
+    def getConnection(self):
+        holder = getattr(self._bound, "holder", None)
+        if holder is not None:
+            holder.count += 1
+            return holder.connection
+        connection = self._checkout()
+        self._bound.holder = _ConnectionHolder(connection)
+        return connection
+
+    def holds_connection(self):
+        return getattr(self._bound, "holder", None) is not None or ConnectionFactory.holds_connection(self)
+
+    def releaseConnection(self, connection):
+        holder = getattr(self._bound, "holder", None)
+        if holder is None or holder.connection is not connection:
+            return
+        holder.count -= 1
+        if holder.count == 0:
+            self._bound.holder = None
+            self._checkin(holder)
+
+    def begin_transaction(self, connection, read_only = False):
+        """A connection just checked out for the transaction has nothing pending, it was committed or
+        rolled back on its way back into the pool, so there is no need to commit it. If the transaction
+        is read only, the transaction manager ends it with a rollback, so the connection goes back as is."""
+        holder = getattr(self._bound, "holder", None)
+        if holder is None or holder.count > 1:
+            ConnectionFactory.begin_transaction(self, connection, read_only)
+            return
+        holder.read_only = read_only
+        _transaction_stack(self).append([])
+
+    def commit(self):
+        holder = getattr(self._bound, "holder", None)
+        if holder is not None and self.in_transaction():
+            holder.connection.commit()
+
+    def rollback(self):
+        holder = getattr(self._bound, "holder", None)
+        if holder is not None and self.in_transaction():
+            holder.connection.rollback()
+
+    def in_transaction(self):
+        return self.target_factory.in_transaction()
+
+    def count_type(self):
+        return self.target_factory.count_type()
+
     def convert_sql_binding(self, sql_query):
-        """SQL Server expects parameters to be passed as question marks."""
-        return re.sub(pattern="%s", repl="?", string=sql_query)
+        return self.target_factory.convert_sql_binding(sql_query)
+
+    def convert_sql_binding_args(self, sql_query, args):
+        return self.target_factory.convert_sql_binding_args(sql_query, args)
+
+    def open_cursor(self, connection, sql_query):
+        if not self.statement_cache_size:
+            return connection.cursor()
+        cache = self.statement_caches.get(id(connection))
+        if cache is None:
+            cache = self.statement_caches[id(connection)] = StatementCache(connection, self.statement_cache_size)
+        return cache.open_cursor(sql_query)
+
+    def close_cursor(self, connection, sql_query, cursor, reusable = True):
+        cache = self.statement_caches.get(id(connection))
+        if cache is None:
+            cursor.close()
+        else:
+            cache.close_cursor(sql_query, cursor, reusable)
+
+    def get_statement_cache_stats(self):
+        """Adds up how many statements the connections of this pool prepared, and how many times a cached one was reused."""
+        caches = self.statement_caches.values()
+        return {"prepares": sum([cache.prepares for cache in caches]), "hits": sum([cache.hits for cache in caches])}
+
+    def supports_savepoints(self):
+        return self.target_factory.supports_savepoints()
+
+    def set_savepoint(self, connection, name):
+        self.target_factory.set_savepoint(connection, name)
+
+    def release_savepoint(self, connection, name):
+        self.target_factory.release_savepoint(connection, name)
+
+    def rollback_to_savepoint(self, connection, name):
+        self.target_factory.rollback_to_savepoint(connection, name)
+
+    def _bulk_load(self, connection, table, columns, rows, batch_size):
+        return self.target_factory._bulk_load(connection, table, columns, rows, batch_size)
+
+    def suspend(self):
+        """Unbind the connection held by the calling thread, so the next getConnection checks out
+        another one. The connection stays checked out until it is handed back to resume()."""
+        holder = getattr(self._bound, "holder", None)
+        self._bound.holder = None
+        return holder
+
+    def resume(self, holder):
+        """Bind a connection put aside by suspend() to the calling thread again, releasing whatever
+        connection the thread acquired in the meantime."""
+        current = getattr(self._bound, "holder", None)
+        if current is not None:
+            self._bound.holder = None
+            self._checkin(current)
+        self._bound.holder = holder
+
+    def get_executor(self):
+        """A DatabaseExecutor (see springpython.database.asynchronous) with one worker per connection of the
+        pool, created on first use. Every DatabaseTemplate using the pool shares it to run queries at the same
+        time, and close() shuts it down. Returns None once the pool is closed."""
+        self._lock.acquire()
+        try:
+            if self._executor is None and not self._closed:
+                from springpython.database.asynchronous import DatabaseExecutor
+                self._executor = DatabaseExecutor(self.max_size)
+            return self._executor
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close every idle connection, and shut the executor down. Connections currently checked out are
+        closed when they come back, and no connection is handed out anymore, getConnection raises
+        CannotGetConnectionException."""
+        self._lock.acquire()
+        try:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            executor, self._executor = self._executor, None
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+        for connection, last_used in idle:
+            self._close(connection)
+        if executor is not None:
+            executor.shutdown()
+
+    def get_pool_size(self):
+        """Number of connections currently opened by this pool, whether idle or checked out."""
+        return self._size
+
+    def get_idle_count(self):
+        return len(self._idle)
+
+    def _checkout(self):
+        if not self._filled:
+            self._fill()
+
+        if self.wait_timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + self.wait_timeout
+
+        while True:
+            connection = self._reserve(deadline)
+            if connection is None:
+                try:
+                    return self.connect()
+                except:
+                    self._forget()
+                    raise
+            if self._validate(connection):
+                return connection
+            self.logger.debug("Validation failed, discarding pooled connection %s" % connection)
+            self._close(connection)
+            self._forget()
+
+    def _reserve(self, deadline):
+        """Pick an idle connection, or reserve room for a new one (returning None). If the pool
+        is exhausted, wait until another thread returns a connection."""
+        self._lock.acquire()
+        try:
+            while True:
+                if self._closed:
+                    raise CannotGetConnectionException("The connection pool is closed")
+                self._evict_idle()
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    return connection
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise CannotGetConnectionException("Timed out after %s seconds waiting for one of %s pooled connections" % (self.wait_timeout, self.max_size))
+                    self._lock.wait(remaining)
+        finally:
+            self._lock.release()
+
+    def _checkin(self, holder):
+        connection = holder.connection
+        try:
+            if holder.read_only:
+                pass
+            elif self.commit_on_return:
+                connection.commit()
+            else:
+                connection.rollback()
+        except Exception, e:
+            self.logger.debug("Trapped %s while returning a connection to the pool, discarding it." % e)
+            self._close(connection)
+            self._forget()
+            return
+
+        self._lock.acquire()
+        try:
+            if not self._closed:
+                self._idle.append((connection, time.time()))
+                self._lock.notify()
+                return
+        finally:
+            self._lock.release()
+        self._close(connection)
+        self._forget()
+
+    def _fill(self):
+        """Open min_size connections up front, the first time the pool is used."""
+        self._lock.acquire()
+        try:
+            if self._filled or self._closed:
+                return
+            self._filled = True
+            while self._size < self.min_size:
+                self._idle.append((self.connect(), time.time()))
+                self._size += 1
+        finally:
+            self._lock.release()
+
+    def _evict_idle(self):
+        """Close connections that stayed idle longer than max_idle_time, while keeping min_size
+        connections open. Must be called with the lock held."""
+        if self.max_idle_time is None or not self._idle:
+            return
+        expired_before = time.time() - self.max_idle_time
+        kept = []
+        for connection, last_used in self._idle:
+            if last_used < expired_before and self._size > self.min_size:
+                self._close(connection)
+                self._size -= 1
+            else:
+                kept.append((connection, last_used))
+        self._idle = kept
+
+    def _validate(self, connection):
+        if self.validation_query is None:
+            return True
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(self.validation_query)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception, e:
+            self.logger.debug("validation query '%s' failed with %s" % (self.validation_query, e))
+            return False
+
+    def _forget(self):
+        """Give back the room taken by a connection that has been closed or never opened."""
+        self._lock.acquire()
+        try:
+            self._size -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def _close(self, connection):
+        cache = self.statement_caches.pop(id(connection), None)
+        if cache is not None:
+            cache.close()
+        try:
+            connection.close()
+        except Exception, e:
+            self.logger.debug("Trapped %s while closing a pooled connection, and throwing away." % e)
@@ -0,0 +1,280 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.       
+"""
+import logging
+import re
+import threading
+import time
+from threading import RLock
+from springpython.database import DataAccessException
+from springpython.database.cache import normalize_sql
+
+class QueryInstrumentation(object):
+    """
+    This interface is plugged into a DatabaseTemplate (or DaoSupport) to be told about every
+    statement it runs. All times are in seconds.
+    """
+    def record(self, operation, sql, elapsed, connection_wait, cursor_time, rows, error=None, args=None):
+        """operation is the DatabaseTemplate method (execute, query, query_iter, batch_update), sql the
+        statement as sent to the driver, elapsed the whole call, connection_wait the time spent getting
+        a connection from the factory, cursor_time how long the cursor was open, and rows the number
+        of rows fetched or affected. error is the exception raised by the driver, if any, and args the
+        arguments bound to the statement (None for batch_update)."""
+        raise NotImplementedError()
+
+class CompositeQueryInstrumentation(QueryInstrumentation):
+    """Hands every statement to each of a list of instrumentations."""
+    def __init__(self, instrumentations=None):
+        if instrumentations is None:
+            instrumentations = []
+        self.instrumentations = instrumentations
+
+    def record(self, operation, sql, elapsed, connection_wait, cursor_time, rows, error=None, args=None):
+        for instrumentation in self.instrumentations:
+            instrumentation.record(operation, sql, elapsed, connection_wait, cursor_time, rows, error, args)
+
+class QueryProbe(object):
+    """Collects the timings of one DatabaseTemplate call, and hands them to a QueryInstrumentation."""
+    def __init__(self, instrumentation, operation, sql, args=None):
+        self.instrumentation = instrumentation
+        self.operation = operation
+        self.sql = sql
+        self.args = args
+        self.started = time.time()
+        self.connected = self.cursor_opened = self.cursor_closed = None
+
+    def got_connection(self):
+        self.connected = time.time()
+
+    def opened_cursor(self):
+        self.cursor_opened = time.time()
+
+    def closed_cursor(self):
+        self.cursor_closed = time.time()
+
+    def done(self, rows, error=None):
+        finished = time.time()
+        if self.connected is None:
+            connection_wait = finished - self.started
+        else:
+            connection_wait = self.connected - self.started
+        if self.cursor_opened is None:
+            cursor_time = 0.0
+        else:
+            cursor_time = (self.cursor_closed or finished) - self.cursor_opened
+        self.instrumentation.record(self.operation, self.sql, finished - self.started,
+                                    connection_wait, cursor_time, rows, error, self.args)
+
+class NullQueryProbe(object):
+    """Stands in for QueryProbe when no instrumentation is plugged in, so the cost is a few empty calls."""
+    def got_connection(self):
+        pass
+
+    def opened_cursor(self):
+        pass
+
+    def closed_cursor(self):
+        pass
+
+    def done(self, rows, error=None):
+        pass
+
+NULL_PROBE = NullQueryProbe()
+
+class QueryStatistics(QueryInstrumentation):
+    """
+    This instrumentation keeps, for every distinct statement, the number of calls and errors, the rows
+    fetched or affected, the time spent waiting for connections and with an open cursor, and a latency
+    histogram. Statements slower than slow_query_threshold are logged as warnings.
+
+    Up to max_statements distinct statements are tracked separately, anything beyond that is added
+    up under OTHER_STATEMENTS. snapshot() exports the counters as a dictionary.
+    """
+    OTHER_STATEMENTS = "<other statements>"
+
+    def __init__(self, slow_query_threshold=None, buckets=None, max_statements=1000):
+        self.slow_query_threshold = slow_query_threshold
+        if buckets is None:
+            self.buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+        else:
+            self.buckets = sorted(buckets)
+        self.max_statements = max_statements
+        self.logger = logging.getLogger("springpython.database.instrumentation.QueryStatistics")
+        self.lock = RLock()
+        self.statements = {}
+        self.slow_queries = 0
+
+    def record(self, operation, sql, elapsed, connection_wait, cursor_time, rows, error=None, args=None):
+        self.lock.acquire()
+        try:
+            stats = self.statements.get(sql)
+            if stats is None:
+                if len(self.statements) >= self.max_statements:
+                    sql = self.OTHER_STATEMENTS
+                    stats = self.statements.get(sql)
+                if stats is None:
+                    stats = self.statements[sql] = _StatementStatistics(operation, len(self.buckets))
+            stats.add(self._bucket(elapsed), elapsed, connection_wait, cursor_time, rows, error)
+
+            slow = self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold
+            if slow:
+                self.slow_queries += 1
+        finally:
+            self.lock.release()
+
+        if slow:
+            self.logger.warning("Slow %s (%.3f s, %s rows, waited %.3f s for a connection): %s" % (operation, elapsed, rows, connection_wait, sql))
+
+    def _bucket(self, elapsed):
+        for i, bound in enumerate(self.buckets):
+            if elapsed <= bound:
+                return i
+        return len(self.buckets)
+
+    def snapshot(self):
+        """Returns a copy of the counters, as plain dictionaries and lists."""
+        self.lock.acquire()
+        try:
+            bounds = self.buckets + ["+inf"]
+            statements = {}
+            for sql, stats in self.statements.items():
+                statements[sql] = {
+                    "operation": stats.operation,
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "rows": stats.rows,
+                    "total_time": stats.total_time,
+                    "max_time": stats.max_time,
+                    "mean_time": stats.total_time / stats.count,
+                    "connection_wait": stats.connection_wait,
+                    "cursor_time": stats.cursor_time,
+                    "histogram": zip(bounds, stats.histogram),
+                }
+            return {"statements": statements,
+                    "count": sum([stats.count for stats in self.statements.values()]),
+                    "slow_queries": self.slow_queries}
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.statements = {}
+            self.slow_queries = 0
+        finally:
+            self.lock.release()
+
+class _StatementStatistics(object):
+    def __init__(self, operation, bucket_count):
+        self.operation = operation
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.connection_wait = 0.0
+        self.cursor_time = 0.0
+        self.histogram = [0] * (bucket_count + 1)
+
+    def add(self, bucket, elapsed, connection_wait, cursor_time, rows, error):
+        self.count += 1
+        if error is not None:
+            self.errors += 1
+        self.rows += rows
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.connection_wait += connection_wait
+        self.cursor_time += cursor_time
+        self.histogram[bucket] += 1
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def fingerprint_sql(sql):
+    """Reduces a statement to its shape: literals become binding variables, and IN lists of any length
+    look the same."""
+    return _IN_LIST.sub("(?)", _LITERAL.sub("?", normalize_sql(sql).replace("%s", "?")))
+
+class NPlusOneDetector(QueryInstrumentation):
+    """
+    This instrumentation spots the N+1 query pattern: the same query shape run over and over with
+    different arguments, typically once per row of a previous result. Once a thread has run the same
+    shape with threshold different sets of arguments within one unit of work, a warning is logged
+    (and DataAccessException raised, if raise_on_detection is set).
+
+    A unit of work is whatever runs between begin_request() and end_request() in a thread, such as a web
+    request or a transaction. end_request() returns what was found, as a list of dictionaries. Queries run
+    outside of a unit of work aren't looked at, since a pooled worker thread may serve any number of
+    requests. Given to a ConnectionFactoryTransactionManager as one of its units_of_work, the detector
+    treats each transaction as a unit of work. Units of work started within another one, like a
+    transaction inside a request, are part of the outer one. See DatabaseTemplate.batched_query for a way
+    to turn such loops into one query.
+    """
+    def __init__(self, threshold=5, raise_on_detection=False):
+        self.threshold = threshold
+        self.raise_on_detection = raise_on_detection
+        self.logger = logging.getLogger("springpython.database.instrumentation.NPlusOneDetector")
+        self._bound = threading.local()
+
+    def begin_request(self):
+        depth = getattr(self._bound, "depth", 0)
+        self._bound.depth = depth + 1
+        if depth == 0:
+            self._bound.shapes = {}
+            self._bound.findings = []
+
+    def end_request(self):
+        depth = getattr(self._bound, "depth", 0)
+        if depth > 1:
+            self._bound.depth = depth - 1
+            return []
+        findings = getattr(self._bound, "findings", [])
+        self._bound.depth = 0
+        self._bound.shapes = None
+        self._bound.findings = []
+        return findings
+
+    def record(self, operation, sql, elapsed, connection_wait, cursor_time, rows, error=None, args=None):
+        if operation in ("batch_update", "batched_query"):
+            return
+        shapes = getattr(self._bound, "shapes", None)
+        if shapes is None:
+            return
+
+        shape = fingerprint_sql(sql)
+        seen = shapes.get(shape)
+        if seen is None:
+            seen = shapes[shape] = [set(), None]
+        if seen[1] is not None:
+            seen[1]["count"] += 1
+            return
+
+        if isinstance(args, dict):
+            args = tuple(sorted(args.items()))
+        try:
+            seen[0].add((sql, args))
+        except TypeError:
+            seen[0].add((sql, repr(args)))
+        if len(seen[0]) < self.threshold:
+            return
+
+        finding = {"sql": shape, "operation": operation, "count": len(seen[0])}
+        seen[0] = None
+        seen[1] = finding
+        self._bound.findings.append(finding)
+        message = "Possible N+1 queries, the same %s ran with %s different arguments: %s" % (operation, finding["count"], shape)
+        self.logger.warning(message)
+        if self.raise_on_detection:
+            raise DataAccessException(message)
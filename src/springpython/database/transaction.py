@@ -16,6 +16,7 @@
 import inspect
 import logging
 import re
+import threading
 import types
 from springpython.aop import MethodInterceptor
 from springpython.aop import ProxyFactoryObject
@@ -34,7 +35,30 @@ class TransactionStatus(object):
     pass
 
 class DefaultTransactionStatus(TransactionStatus):
-    pass
+    """
+    Tracks one getTransaction call. transaction is the status that started the physical transaction
+    this call runs in (itself when new_transaction is True), or None when running outside of one.
+    Nested transactions record their savepoint, and transactions that required a new one keep what
+    they suspended, so it can be resumed when they end.
+    """
+    def __init__(self, transaction = None, new_transaction = False, read_only = False):
+        self.connection = None
+        self.transaction = transaction
+        self.new_transaction = new_transaction
+        self.read_only = read_only
+        self.savepoint = None
+        self.savepoint_count = 0
+        self.suspended = None
+        self.rollback_only = False
+        self.global_rollback_only = False
+        self.completed = False
+
+    def set_rollback_only(self):
+        """Make the transaction roll back instead of committing, without raising an exception."""
+        self.rollback_only = True
+
+    def is_new_transaction(self):
+        return self.new_transaction
 
 class PlatformTransactionManager(object):
     """This interface is used to define the operations necessary in handling transactions."""
@@ -52,70 +76,194 @@ class ConnectionFactoryTransactionManager(PlatformTransactionManager):
     This transaction manager is based upon using a connection factory to control transactions. Since
     connection factories are tied to vendor-specific databases, this allows delegation of various
     transactional functions on a per-vendor basis.
+
+    The current transaction is bound to the calling thread, so transactional code can run in several
+    threads at once, as long as the connection factory hands each thread its own connection (see
+    PooledConnectionFactory). PROPAGATION_REQUIRES_NEW suspends the current transaction, which also
+    needs a PooledConnectionFactory, and PROPAGATION_NESTED runs inside a savepoint. Read only
+    transactions run on the factory's read connection (a replica, with a RoutingConnectionFactory),
+    and end with a rollback, so nothing written in them is left pending on the connection.
+
+    units_of_work are told about each transaction, the outermost one of a thread, through their
+    begin_request() and end_request() methods, like an NPlusOneDetector looking at each transaction
+    on its own.
     """
 
-    def __init__(self, connection_factory):
+    def __init__(self, connection_factory, units_of_work = None):
         self.connection_factory = connection_factory
+        if units_of_work is None:
+            units_of_work = []
+        self.units_of_work = units_of_work
         self.logger = logging.getLogger("springpython.database.transaction.ConnectionFactoryTransactionManager")
-        self.status = []
+        self._bound = threading.local()
+
+    def get_current_transaction(self):
+        """Returns the status that started the transaction of the calling thread, or None."""
+        return getattr(self._bound, "transaction", None)
 
     def getTransaction(self, definition):
-        """According to PEP 249, commits and rollbacks silently start new transactions. Until a more
-        robust transaction manager is implemented to handle save points and so forth, this must suffice."""
+        """According to PEP 249, commits and rollbacks silently start new transactions, so starting a transaction
+        means committing whatever was pending on the connection (see ConnectionFactory.begin_transaction)."""
 
         self.logger.debug("Analyzing %s" % definition.propagation)
 
-        start_tx = False
+        current = self.get_current_transaction()
 
         if definition.propagation == "PROPAGATION_REQUIRED":
-            if len(self.status) == 0:
+            if current is None:
                 self.logger.debug("There is no current transaction, and one is required, so starting one.")
-                start_tx = True
-            self.status.append(DefaultTransactionStatus())
+                return self._begin(definition)
+            return DefaultTransactionStatus(current)
 
         elif definition.propagation == "PROPAGATION_SUPPORTS":
             self.logger.debug("This code can execute inside or outside a transaction.")
+            return DefaultTransactionStatus(current)
 
         elif definition.propagation == "PROPAGATION_MANDATORY":
-            if len(self.status) == 0:
+            if current is None:
                 raise TransactionPropagationException("Trying to execute PROPAGATION_MANDATORY operation while outside TX")
-            self.status.append(DefaultTransactionStatus())
+            return DefaultTransactionStatus(current)
 
         elif definition.propagation == "PROPAGATION_NEVER":
-            if len(self.status) != 0:
+            if current is not None:
                 raise TransactionPropagationException("Trying to execute PROPAGATION_NEVER operation while inside TX")
+            return DefaultTransactionStatus()
+
+        elif definition.propagation == "PROPAGATION_REQUIRES_NEW":
+            if current is None:
+                return self._begin(definition)
+            if not hasattr(self.connection_factory, "suspend"):
+                raise TransactionPropagationException("PROPAGATION_REQUIRES_NEW needs a connection factory that can hand out a second connection, like PooledConnectionFactory")
+            self.logger.debug("Suspending the current transaction.")
+            suspended = (current, self.connection_factory.suspend())
+            self._bound.transaction = None
+            try:
+                return self._begin(definition, suspended)
+            except:
+                self._resume(suspended)
+                raise
+
+        elif definition.propagation == "PROPAGATION_NESTED":
+            if current is None:
+                return self._begin(definition)
+            if not self.connection_factory.supports_savepoints():
+                raise TransactionPropagationException("PROPAGATION_NESTED needs savepoints, which %s doesn't support" % self.connection_factory)
+            current.savepoint_count += 1
+            status = DefaultTransactionStatus(current)
+            status.savepoint = "SPRINGPYTHON_SAVEPOINT_%s" % current.savepoint_count
+            self.logger.debug("Setting savepoint %s" % status.savepoint)
+            self.connection_factory.set_savepoint(current.connection, status.savepoint)
+            return status
 
         else:
-            raise TransactionPropagationException("Transaction propagation level %s is not supported!" % definition.start_tx)
+            raise TransactionPropagationException("Transaction propagation level %s is not supported!" % definition.propagation)
+
+    def _begin(self, definition, suspended = None):
+        self.logger.debug("START TRANSACTION")
+        self.logger.debug("Creating a transaction, propagation = %s, isolation = %s, timeout = %s, read_only = %s" % (definition.propagation, definition.isolation, definition.timeout, definition.read_only))
+        status = DefaultTransactionStatus(new_transaction = True, read_only = bool(definition.read_only))
+        status.transaction = status
+        status.suspended = suspended
+        # Hold on to the connection until the transaction ends, so a pooled connection factory
+        # keeps handing the same connection to this thread.
+        if status.read_only:
+            status.connection = self.connection_factory.getReadConnection()
+        else:
+            status.connection = self.connection_factory.getConnection()
+        try:
+            self.connection_factory.begin_transaction(status.connection, status.read_only)
+        except:
+            self._release(status)
+            raise
+        self._bound.transaction = status
+        if suspended is None:
+            for unit_of_work in self.units_of_work:
+                unit_of_work.begin_request()
+        return status
 
-        if start_tx:
-            self.logger.debug("START TRANSACTION")
-            self.logger.debug("Creating a transaction, propagation = %s, isolation = %s, timeout = %s, read_only = %s" % (definition.propagation, definition.isolation, definition.timeout, definition.read_only))
-            self.connection_factory.commit()
+    def commit(self, status):
+        self._complete(status)
 
-        return self.status
+        if status.savepoint is not None:
+            if status.rollback_only:
+                self._rollback_to_savepoint(status)
+            else:
+                self.logger.debug("Releasing savepoint %s" % status.savepoint)
+                self.connection_factory.release_savepoint(status.transaction.connection, status.savepoint)
 
-    def commit(self, status):
-        self.status = status
-        try:
-            self.status.pop()
-            if len(self.status) == 0:
-                self.logger.debug("Commit the changes")
-                self.connection_factory.commit()
-                self.logger.debug("END TRANSACTION")
-        except IndexError:
-            pass
+        elif status.new_transaction:
+            try:
+                if status.rollback_only or status.global_rollback_only:
+                    self.logger.debug("Rolling back the transaction, since it was marked rollback only.")
+                    self.connection_factory.rollback()
+                elif status.read_only:
+                    self.logger.debug("Read only transaction, rolling back rather than committing")
+                    self.connection_factory.rollback()
+                else:
+                    self.logger.debug("Commit the changes")
+                    try:
+                        self.connection_factory.commit()
+                    except:
+                        self.connection_factory.rollback()
+                        raise
+            finally:
+                self._end(status)
+            if status.global_rollback_only and not status.rollback_only:
+                raise TransactionException("Transaction rolled back, because part of it was marked as rollback only")
+
+        elif status.transaction is not None and status.rollback_only:
+            status.transaction.global_rollback_only = True
 
     def rollback(self, status):
-        self.status = status
-        try:
-            self.status.pop()
-            if len(self.status) == 0:
-                self.logger.debug("Rolling back the transaction.")
+        self._complete(status)
+
+        if status.savepoint is not None:
+            self._rollback_to_savepoint(status)
+
+        elif status.new_transaction:
+            self.logger.debug("Rolling back the transaction.")
+            try:
                 self.connection_factory.rollback()
-                self.logger.debug("END TRANSACTION")
-        except IndexError:
-            pass
+            finally:
+                self._end(status)
+
+        elif status.transaction is not None:
+            self.logger.debug("Marking the surrounding transaction rollback only.")
+            status.transaction.global_rollback_only = True
+
+    def _complete(self, status):
+        if status.completed:
+            raise TransactionException("Transaction is already completed, it can't be committed or rolled back again")
+        status.completed = True
+
+    def _rollback_to_savepoint(self, status):
+        self.logger.debug("Rolling back to savepoint %s" % status.savepoint)
+        connection = status.transaction.connection
+        self.connection_factory.rollback_to_savepoint(connection, status.savepoint)
+        self.connection_factory.release_savepoint(connection, status.savepoint)
+
+    def _end(self, status):
+        self._bound.transaction = None
+        connection = status.connection
+        self._release(status)
+        self.connection_factory.end_transaction(connection)
+        if status.suspended is None:
+            for unit_of_work in self.units_of_work:
+                unit_of_work.end_request()
+        if status.suspended is not None:
+            self.logger.debug("Resuming the suspended transaction.")
+            self._resume(status.suspended)
+        self.logger.debug("END TRANSACTION")
+
+    def _resume(self, suspended):
+        transaction, token = suspended
+        self.connection_factory.resume(token)
+        self._bound.transaction = transaction
+
+    def _release(self, tx_status):
+        if tx_status.connection is not None:
+            self.connection_factory.releaseConnection(tx_status.connection)
+            tx_status.connection = None
 
 class TransactionDefinition(object):
     def __init__(self, isolation = None, name = None, propagation = None, timeout = None, read_only = None):
@@ -146,11 +294,11 @@ class TransactionTemplate(DefaultTransactionDefinition):
         try:
             self.logger.debug("Execute the steps inside the transaction")
             result = transactionCallback.do_in_transaction(status)
-            self.tx_manager.commit(status)
         except Exception, e:
             self.logger.debug("Exception: (%s)" % e)
             self.tx_manager.rollback(status)
             raise e
+        self.tx_manager.commit(status)
         return result
 
     def setTxAttributes(self, tx_attributes):
@@ -298,8 +446,10 @@ class AutoTransactionalObject(ObjectPostProcessor):
         # Check every method in the object...
         for name, method in inspect.getmembers(obj, inspect.ismethod):
             try:
+                # @async_transactional keeps the @transactional function it submits.
+                function = getattr(method.im_func, "transactional_function", method.im_func)
                 # If the method contains _call_, then you are looking at a wrapper...
-                wrapper = method.im_func.func_globals["_call_"]
+                wrapper = function.func_globals["_call_"]
                 if wrapper.func_name == "transactional_wrapper":  # name of @transactional's wrapper method
                     self.logger.debug("Linking tx_manager with %s" % name)
                     wrapper.func_globals["tx_manager"] = self.tx_manager
@@ -25,20 +25,30 @@ class ReflectiveObjectFactory(ObjectFactory):
     def __init__(self, module_and_class):
         self.logger = logging.getLogger("springpython.factory.ReflectiveObjectFactory")
         self.module_and_class = module_and_class
+        self.cls = None
 
     def create_object(self, constr, named_constr):
-        self.logger.debug("Creating an instance of %s" % self.module_and_class)
-        parts = self.module_and_class.split(".")
-        module_name = ".".join(parts[:-1])
-        class_name = parts[-1]
-        if module_name == "":
-            return __import__(class_name)(*constr, **named_constr)
-        else:
-            __import__(module_name)
-            cls = getattr(sys.modules[module_name], class_name)
-            return cls(*constr, **named_constr)
+        self.logger.debug("Creating an instance of %s", self.module_and_class)
+        if self.cls is None:
+            # The class is looked up the first time only.
+            parts = self.module_and_class.split(".")
+            module_name = ".".join(parts[:-1])
+            class_name = parts[-1]
+            if module_name == "":
+                self.cls = __import__(class_name)
+            else:
+                __import__(module_name)
+                self.cls = getattr(sys.modules[module_name], class_name)
+        return self.cls(*constr, **named_constr)
 
 
+    def __getstate__(self):
+        """Only the name of the class is kept, loggers can't be pickled."""
+        return {"module_and_class": self.module_and_class}
+
+    def __setstate__(self, state):
+        self.__init__(state["module_and_class"])
+
     def __str__(self):
         return "ReflectiveObjectFactory(%s)" % self.module_and_class
 
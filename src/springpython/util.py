@@ -15,7 +15,7 @@
 """
 import logging
 import traceback
-from threading import RLock, currentThread
+from threading import Lock, RLock, currentThread
 
 try:
     from cStringIO import StringIO
@@ -49,3 +49,98 @@ class synchronized(object):
                 self.lock.release()
                 self.logger.log(TRACE1, "Released lock [%s] thread [%s]" % (self.lock, currentThread()))
         return lockedfunc
+
+class LRUCache(object):
+    """ A bounded, thread-safe mapping. Once max_size entries are stored, adding
+    another one discards the least recently used entry, handing it to on_evict(key, value)
+    if given.
+    """
+
+    def __init__(self, max_size=100, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        # A plain lock, since RLock is implemented in Python before Python 3.2.
+        self.lock = Lock()
+        self._map = {}
+        # A circular, doubly linked list of [prev, next, key, value] links,
+        # most recently used first.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._link_first(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        oldest = None
+        self.lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                if len(self._map) >= self.max_size:
+                    oldest = self._root[0]
+                    self._unlink(oldest)
+                    del self._map[oldest[2]]
+                link = [None, None, key, value]
+                self._map[key] = link
+            self._link_first(link)
+        finally:
+            self.lock.release()
+        if oldest is not None and self.on_evict is not None:
+            self.on_evict(oldest[2], oldest[3])
+
+    def pop(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self._map.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None]
+        finally:
+            self.lock.release()
+
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self._map.keys()
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_first(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
@@ -3,7 +3,15 @@ from springpythontest.contextTestCases import *
 from springpythontest.databaseCoreTestCases import ConnectionFactoryTestCase
 from springpythontest.databaseCoreTestCases import SqliteDatabaseTemplateTestCase
 from springpythontest.databaseCoreTestCases import DatabaseTemplateMockTestCase
+from springpythontest.databaseCoreTestCases import PooledConnectionFactoryTestCase
+from springpythontest.databaseCoreTestCases import QueryStatisticsTestCase
+from springpythontest.databaseCoreTestCases import NPlusOneDetectorTestCase
+from springpythontest.databaseCoreTestCases import QueryCacheTestCase
+from springpythontest.databaseCoreTestCases import RoutingConnectionFactoryTestCase
+from springpythontest.databaseCoreTestCases import AsyncDatabaseTemplateTestCase
 from springpythontest.databaseTransactionTestCases import SqliteTransactionTestCase
+from springpythontest.databaseTransactionTestCases import TransactionManagerTestCase
+from springpythontest.databaseTransactionTestCases import PooledSqliteTransactionTestCase
 from springpythontest.securityEncodingTestCases import *
 from springpythontest.securityProviderTestCases import InMemoryDaoAuthenticationProviderTestCase
 from springpythontest.securityProviderTestCases import DaoAuthenticationProviderHidingUserNotFoundExceptionsTestCase
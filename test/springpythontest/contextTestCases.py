@@ -19,28 +19,41 @@
 # pmock
 from pmock import *
 
+import os
 import sys
+import time
+import shutil
+import tempfile
 import atexit
 import random
 import unittest
+import threading
 from decimal import Decimal
 from StringIO import StringIO
 
 from springpython.context import DisposableObject
 from springpython.context import ApplicationContext
 from springpython.context import ObjectPostProcessor
+from springpython.config import Config
 from springpython.config import PythonConfig
+from springpython.config import SnapshotConfig
 from springpython.config import PyContainerConfig
 from springpython.config import SpringJavaConfig
 from springpython.config import Object
 from springpython.config import XMLConfig, xml_mappings
 from springpython.config import YamlConfig, yaml_mappings
 from springpython.config import Object, ObjectDef
+from springpython.config import ReferenceDef, ValueDef, ListDef
+from springpython.container import CircularReferenceException
+from springpython.container import ObjectContainer
+from springpython.factory import ObjectFactory
+from springpython.factory import ReflectiveObjectFactory
 from springpython.factory import PythonObjectFactory
 from springpython.remoting.pyro import PyroProxyFactory
 from springpython.security.userdetails import InMemoryUserDetailsService
 from springpythontest.support import testSupportClasses
-from springpython.context.scope import SINGLETON, PROTOTYPE
+from springpython.context import scope
+from springpython.context.scope import SINGLETON, PROTOTYPE, THREAD, REQUEST, SESSION, POOLED
 from springpython.container import AbstractObjectException, InvalidObjectScope
 
 class PyContainerTestCase(unittest.TestCase):        
@@ -2002,3 +2015,657 @@ class InvalidScopeContainingContext(PythonConfig):
             exec invalid in _globals, _locals
             
         self.assertRaises(InvalidObjectScope, should_raise_invalid_object_scope)
+
+class CreationPlanTestCase(unittest.TestCase):
+    """Test cases related to the compiled creation plans of ObjectContainer.
+    """
+
+    def _get_container(self):
+        container = ObjectContainer()
+        finder = ObjectDef(id="finder", factory=ReflectiveObjectFactory("springpythontest.support.testSupportClasses.ColonMovieFinder"),
+                           scope=PROTOTYPE)
+        finder.named_constr["filename"] = ValueDef("filename", "support/movies1.txt")
+        container.object_defs["finder"] = finder
+        container.object_defs["holder"] = ObjectDef(id="holder",
+            factory=ReflectiveObjectFactory("springpythontest.support.testSupportClasses.StringHolder"))
+        container.object_defs["lister"] = ObjectDef(id="lister",
+            factory=ReflectiveObjectFactory("springpythontest.support.testSupportClasses.MovieLister"),
+            props=[ReferenceDef("finder", "holder")])
+        return container
+
+    def testPlansAreCompiledOnceAndFollowTheDefinitions(self):
+        container = self._get_container()
+
+        first, second = container.get_object("finder"), container.get_object("finder")
+        self.assertTrue(first is not second)
+        self.assertEquals(second.filename, "support/movies1.txt")
+        plan = container._plans["finder"]
+        container.get_object("finder")
+        self.assertTrue(container._plans["finder"] is plan)
+
+        lister = container.get_object("lister")
+        self.assertTrue(lister.finder is container.get_object("holder"))
+        self.assertTrue(container.get_object("lister") is lister)
+
+        replacement = ObjectDef(id="finder", factory=ReflectiveObjectFactory("springpythontest.support.testSupportClasses.StringHolder"),
+                                scope=PROTOTYPE)
+        container.object_defs["finder"] = replacement
+        self.assertTrue(isinstance(container.get_object("finder"), testSupportClasses.StringHolder))
+
+        container.object_defs["finder"].scope = "scope.NOWHERE"
+        del container._plans["finder"]
+        self.assertRaises(InvalidObjectScope, container.get_object, "finder")
+        self.assertRaises(KeyError, container.get_object, "no_such_object")
+
+    def testAbstractSingletonsStayAbstract(self):
+        container = self._get_container()
+        container.object_defs["lister"].abstract = True
+        lister = container.get_object("lister", ignore_abstract=True)
+        self.assertTrue(container.get_object("lister", ignore_abstract=True) is lister)
+        self.assertRaises(AbstractObjectException, container.get_object, "lister")
+
+class CallableObjectFactory(ObjectFactory):
+    def __init__(self, create):
+        self.create = create
+
+    def create_object(self, constr, named_constr):
+        return self.create()
+
+class ThreadSafeContainerTestCase(unittest.TestCase):
+    """Test cases related to creating singletons from many threads, and to circular references.
+    """
+
+    def _run_in_threads(self, count, target):
+        errors = []
+        def run():
+            try:
+                target()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.isAlive())
+        return errors
+
+    def testLazySingletonsAreCreatedOnce(self):
+        created = []
+        def create():
+            time.sleep(0.05)
+            created.append(object())
+            return created[-1]
+
+        container = ObjectContainer(thread_safe=True)
+        container.object_defs["connection"] = ObjectDef(id="connection", factory=CallableObjectFactory(create), lazy_init=True)
+        fetched = []
+        self.assertEquals(self._run_in_threads(10, lambda: fetched.append(container.get_object("connection"))), [])
+        self.assertEquals(len(created), 1)
+        self.assertEquals(fetched, created * 10)
+
+    def testFailedCreationIsRetried(self):
+        attempts = []
+        def create():
+            attempts.append(1)
+            time.sleep(0.05)
+            if len(attempts) == 1:
+                raise Exception("first attempt fails")
+            return "connection"
+
+        container = ObjectContainer(thread_safe=True)
+        container.object_defs["connection"] = ObjectDef(id="connection", factory=CallableObjectFactory(create))
+        errors = self._run_in_threads(4, lambda: container.get_object("connection"))
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(len(attempts), 2)
+
+    def testCircularReferencesAreReported(self):
+        for thread_safe in (False, True):
+            container = ObjectContainer(thread_safe=thread_safe)
+            for name, ref in [("a", "b"), ("b", "c"), ("c", "b")]:
+                container.object_defs[name] = ObjectDef(id=name, props=[ReferenceDef("ref", ref)],
+                    factory=ReflectiveObjectFactory("springpythontest.support.testSupportClasses.MovieLister"))
+            try:
+                container.get_object("a")
+                self.fail("Expected a CircularReferenceException")
+            except CircularReferenceException, e:
+                self.assertEquals(e.chain, ["b", "c", "b"])
+            self.assertEquals(container.objects, {})
+
+    def testCircularReferencesAcrossThreadsAreReported(self):
+        a_started = threading.Event()
+        b_started = threading.Event()
+        container = ObjectContainer(thread_safe=True)
+        def create_a():
+            a_started.set()
+            b_started.wait(5)
+            return container.get_object("b")
+        def create_b():
+            b_started.set()
+            a_started.wait(5)
+            time.sleep(0.05)
+            return container.get_object("a")
+        container.object_defs["a"] = ObjectDef(id="a", factory=CallableObjectFactory(create_a))
+        container.object_defs["b"] = ObjectDef(id="b", factory=CallableObjectFactory(create_b))
+
+        names = ["a", "b"]
+        errors = self._run_in_threads(2, lambda: container.get_object(names.pop(0)))
+        self.assertEquals(len(errors), 2)
+        for error in errors:
+            self.assertTrue(isinstance(error, CircularReferenceException))
+        self.assertTrue(["a", "b", "a"] in [error.chain for error in errors])
+
+class ObjectDefsConfig(Config):
+    def __init__(self, object_defs):
+        self.object_defs = object_defs
+
+    def read_object_defs(self):
+        return self.object_defs
+
+class ParallelStartupTestCase(unittest.TestCase):
+    """Test cases related to creating the eager objects of an ApplicationContext on many threads.
+    """
+
+    def _get_object_defs(self, created):
+        def slow(name):
+            def create():
+                time.sleep(0.1)
+                created.append(name)
+                return testSupportClasses.MovieLister()
+            return CallableObjectFactory(create)
+
+        object_defs = [ObjectDef(id=name, factory=slow(name)) for name in ("ldap", "mq", "pyro", "cache")]
+        object_defs.append(ObjectDef(id="service", factory=slow("service"),
+                                     props=[ReferenceDef("ldap", "ldap"), ReferenceDef("finder", "finder")]))
+        object_defs.append(ObjectDef(id="finder", factory=slow("finder"), lazy_init=True, props=[ReferenceDef("mq", "mq")]))
+        return object_defs
+
+    def testIndependentObjectsAreCreatedAtTheSameTime(self):
+        created = []
+        start = time.time()
+        ctx = ApplicationContext(ObjectDefsConfig(self._get_object_defs(created)), startup_workers=4)
+        self.assertTrue(time.time() - start < 0.5)
+
+        self.assertEquals(sorted(created), ["cache", "finder", "ldap", "mq", "pyro", "service"])
+        self.assertEquals(created[-2:], ["finder", "service"])
+        self.assertTrue(ctx.get_object("service").ldap is ctx.get_object("ldap"))
+        self.assertTrue(ctx.get_object("service").finder.mq is ctx.get_object("mq"))
+        self.assertFalse(ctx.thread_safe)
+
+        self.assertEquals(ctx.startup_dependencies["service"], set(["ldap", "mq"]))
+        self.assertEquals(sorted(ctx.creation_times.keys()), ["cache", "ldap", "mq", "pyro", "service"])
+        path, seconds = ctx.get_startup_critical_path()
+        self.assertEquals(path[-1], "service")
+        self.assertTrue(path[0] in ("ldap", "mq"))
+        self.assertTrue(seconds >= 0.3)
+
+    def testDependenciesComeFirstWithoutWorkers(self):
+        created = []
+        ApplicationContext(ObjectDefsConfig(list(reversed(self._get_object_defs(created)))))
+        self.assertTrue(created.index("service") > created.index("ldap"))
+        self.assertTrue(created.index("service") > created.index("mq"))
+
+    def testFailuresAreRaisedOnceEverythingElseIsCreated(self):
+        created = []
+        object_defs = self._get_object_defs(created)
+        object_defs.append(ObjectDef(id="broken", factory=CallableObjectFactory(lambda: 1 / 0)))
+        self.assertRaises(ZeroDivisionError, ApplicationContext, ObjectDefsConfig(object_defs), startup_workers=3)
+        self.assertEquals(len(created), 6)
+
+class CountingXMLConfig(XMLConfig):
+    reads = 0
+
+    def read_object_defs(self):
+        CountingXMLConfig.reads += 1
+        return super(CountingXMLConfig, self).read_object_defs()
+
+class SnapshotConfigTestCase(unittest.TestCase):
+    """Test cases related to keeping snapshots of object definitions.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.temp_dir, "context.xml")
+        shutil.copy("support/contextSpringPythonAppContext.xml", self.config_file)
+        self.cache_dir = os.path.join(self.temp_dir, "snapshots")
+        CountingXMLConfig.reads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _get_context(self):
+        return ApplicationContext(SnapshotConfig(CountingXMLConfig(self.config_file), self.cache_dir))
+
+    def testSnapshotsAreUsedUntilTheFilesChange(self):
+        self._get_context()
+        self.assertEquals(CountingXMLConfig.reads, 1)
+        self.assertEquals(len(os.listdir(self.cache_dir)), 1)
+
+        ctx = self._get_context()
+        self.assertEquals(CountingXMLConfig.reads, 1)
+        lister = ctx.get_object("MovieLister2")
+        self.assertEquals(lister.finder.findAll()[0], "The Count of Monte Cristo")
+        self.assertTrue(lister.description is ctx.get_object("SingletonString"))
+
+        # Touching the file without changing it keeps the snapshot.
+        stat = os.stat(self.config_file)
+        os.utime(self.config_file, (stat.st_atime, stat.st_mtime + 10))
+        self._get_context()
+        self.assertEquals(CountingXMLConfig.reads, 1)
+
+        source = open(self.config_file).read()
+        open(self.config_file, "w").write(source.replace("There should only be one copy of this string", "Changed"))
+        ctx = self._get_context()
+        self.assertEquals(CountingXMLConfig.reads, 2)
+        self.assertEquals(ctx.get_object("SingletonString").str, "Changed")
+        self.assertEquals(len(os.listdir(self.cache_dir)), 1)
+
+    def testUnreadableSnapshotsAreIgnored(self):
+        self._get_context()
+        snapshot = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        open(snapshot, "wb").write("not a snapshot")
+        self._get_context()
+        self.assertEquals(CountingXMLConfig.reads, 2)
+        self._get_context()
+        self.assertEquals(CountingXMLConfig.reads, 2)
+
+    def testConfigsNotReadFromFilesAreNotSnapshot(self):
+        ctx = ApplicationContext(SnapshotConfig(XMLConfig(open(self.config_file)), self.cache_dir))
+        self.assertEquals(ctx.get_object("SingletonString").str, "There should only be one copy of this string")
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+class StartupProfileTestCase(unittest.TestCase):
+    """Test cases related to profiling the startup of an ApplicationContext.
+    """
+
+    def testProfilingIsOffByDefault(self):
+        ctx = ApplicationContext(XMLConfig("support/contextObjectPostProcessing.xml"))
+        self.assertTrue(ctx.profile is None)
+
+    def testEveryStepIsReported(self):
+        ctx = ApplicationContext([XMLConfig("support/contextObjectPostProcessing.xml"),
+                                  XMLConfig("support/contextSpringPythonAppContext.xml")], profile=True)
+        ctx.get_object("MovieLister")
+        ctx.get_object("MovieLister")
+        obj = ctx.get_object("value")
+        self.assertTrue(hasattr(obj, "processedBefore"))
+        self.assertTrue(hasattr(obj, "processedAfter"))
+
+        report = ctx.profile.report()
+        self.assertEquals([config["objects"] for config in report["configs"]], [3, 12])
+        self.assertEquals(sorted(report["post_processors"].keys()), ["postProcessor", "postProcessor2"])
+        value = report["objects"]["value"]
+        self.assertEquals(value["count"], 1)
+        self.assertTrue(value["post"] > 0.0)
+        lister = report["objects"]["MovieLister"]
+        self.assertEquals((lister["count"], lister["depth"]), (2, 1))
+        self.assertTrue(lister["create"] >= lister["self"])
+        self.assertEquals(report["objects"]["MovieFinder"]["depth"], 0)
+
+        table = ctx.profile.format_table(sort_by="count", limit=2)
+        lines = table.splitlines()
+        self.assertTrue(lines[0].startswith("Started in "))
+        self.assertTrue(lines[-2].startswith("MovieLister "))
+        self.assertEquals(len([line for line in lines if line.startswith("  read ")]), 2)
+        self.assertRaises(ValueError, ctx.profile.format_table, "colour")
+
+
+class Resource(DisposableObject):
+    destroyed = []
+
+    def destroy(self):
+        self.destroyed.append(self)
+
+class CustomScopesTestCase(unittest.TestCase):
+    """Test cases related to the thread, request and session scopes, and to custom scopes.
+    """
+
+    def _get_container(self, object_scope, **kwargs):
+        container = ObjectContainer(**kwargs)
+        container.object_defs["resource"] = ObjectDef(id="resource", factory=CallableObjectFactory(Resource), scope=object_scope)
+        container.object_defs["other"] = ObjectDef(id="other", factory=CallableObjectFactory(Resource), scope=object_scope)
+        del Resource.destroyed[:]
+        return container
+
+    def testConvert(self):
+        self.assertEquals(scope.convert("request"), REQUEST)
+        self.assertEquals(scope.convert("thread"), THREAD)
+        self.assertRaises(Exception, scope.convert, "conversation")
+
+    def testRequestScope(self):
+        container = self._get_container(REQUEST)
+        requests = container.scopes[REQUEST]
+        self.assertRaises(scope.ScopeNotActive, container.get_object, "resource")
+
+        requests.begin()
+        first = container.get_object("resource")
+        self.assertTrue(container.get_object("resource") is first)
+        self.assertTrue("resource" not in container.objects)
+        requests.end()
+        self.assertEquals(Resource.destroyed, [first])
+        self.assertRaises(scope.ScopeNotActive, container.get_object, "resource")
+
+        requests.begin()
+        self.assertTrue(container.get_object("resource") is not first)
+        requests.end()
+
+    def testThreadScope(self):
+        container = self._get_container(THREAD)
+        mine = container.get_object("resource")
+        theirs = []
+        thread = threading.Thread(target=lambda: theirs.append(container.get_object("resource")))
+        thread.start()
+        thread.join()
+        self.assertTrue(container.get_object("resource") is mine)
+        self.assertTrue(theirs[0] is not mine)
+
+        # The objects of a finished thread go as soon as another thread starts using the scope.
+        thread = threading.Thread(target=lambda: container.get_object("resource"))
+        thread.start()
+        thread.join()
+        self.assertTrue(theirs[0] in Resource.destroyed)
+
+        container.scopes[THREAD].end()
+        self.assertTrue(mine in Resource.destroyed)
+
+    def testBoundedSessions(self):
+        sessions = scope.SessionScope(lambda: current[0], max_objects=1, max_conversations=2)
+        container = self._get_container(SESSION, scopes={SESSION: sessions})
+
+        current = ["a"]
+        a = container.get_object("resource")
+        container.get_object("other")
+        self.assertEquals(Resource.destroyed, [a])
+        current[0] = "b"
+        b = container.get_object("resource")
+        current[0] = "a"
+        self.assertTrue(container.get_object("other") is not b)
+        current[0] = "c"
+        container.get_object("resource")
+        self.assertEquals(Resource.destroyed, [a, b])
+
+        sessions.end("a")
+        self.assertEquals(len(Resource.destroyed), 3)
+        sessions.destroy()
+        self.assertEquals(len(Resource.destroyed), 4)
+
+    def testCustomScope(self):
+        class CountingScope(scope.Scope):
+            def __init__(self):
+                self.objects = {}
+            def get(self, name, create):
+                if name not in self.objects:
+                    self.objects[name] = create()
+                return self.objects[name]
+            def register_destruction_callback(self, name, callback):
+                pass
+
+        scope.register("counting", "scope.COUNTING")
+        try:
+            class CountingConfig(PythonConfig):
+                @Object(scope.convert("counting"))
+                def resource(self):
+                    return Resource()
+
+            ctx = ApplicationContext(CountingConfig(), scopes={"scope.COUNTING": CountingScope()})
+            self.assertTrue("resource" not in ctx.objects)
+            self.assertTrue(ctx.get_object("resource") is ctx.get_object("resource"))
+            self.assertTrue(ctx.get_object("resource") is ctx.scopes["scope.COUNTING"].objects["resource"])
+        finally:
+            del scope._names["counting"]
+
+    def testShutdownDestroysScopedObjects(self):
+        ctx = ApplicationContext()
+        ctx.object_defs["resource"] = ObjectDef(id="resource", factory=CallableObjectFactory(Resource), scope=THREAD)
+        del Resource.destroyed[:]
+        resource = ctx.get_object("resource")
+        ctx.shutdown_hook()
+        self.assertEquals(Resource.destroyed, [resource])
+
+class PooledScopeTestCase(unittest.TestCase):
+    """Test cases related to pooled objects.
+    """
+
+    def _get_container(self, **settings):
+        container = ObjectContainer(scopes={POOLED: scope.PooledScope(**settings)})
+        container.object_defs["resource"] = ObjectDef(id="resource", factory=CallableObjectFactory(Resource), scope=POOLED)
+        container.object_defs["holder"] = ObjectDef(id="holder",
+            factory=ReflectiveObjectFactory("springpythontest.support.testSupportClasses.StringHolder"))
+        del Resource.destroyed[:]
+        return container
+
+    def testBorrowAndReturn(self):
+        container = self._get_container()
+        lease = container.borrow_object("resource")
+        first = lease.object
+        lease.release()
+        lease.release()
+
+        lease = container.borrow_object("resource")
+        self.assertTrue(lease.__enter__() is first)
+        self.assertTrue(container.borrow_object("resource").object is not first)
+        self.assertFalse(lease.__exit__(None, None, None))
+
+        self.assertTrue(container.get_object("resource") is first)
+        self.assertTrue(container.get_object("resource") is not first)
+        stats = container.scopes[POOLED].stats()["resource"]
+        self.assertEquals((stats["hits"], stats["misses"], stats["active"], stats["idle"]), (2, 3, 1, 0))
+
+        self.assertRaises(InvalidObjectScope, container.borrow_object, "holder")
+
+    def testEvictionAndValidation(self):
+        container = self._get_container(max_idle=1, validate=lambda obj: not hasattr(obj, "broken"))
+        first, second = container.borrow_object("resource"), container.borrow_object("resource")
+        first.release()
+        second.release()
+        self.assertEquals(Resource.destroyed, [first.object])
+
+        second.object.broken = True
+        lease = container.borrow_object("resource")
+        self.assertTrue(lease.object is not second.object)
+        self.assertEquals(Resource.destroyed, [first.object, second.object])
+        self.assertEquals(container.scopes[POOLED].stats()["resource"]["invalid"], 1)
+
+        container.scopes[POOLED].configure("other", idle_timeout=0.01)
+        container.object_defs["other"] = ObjectDef(id="other", factory=CallableObjectFactory(Resource), scope=POOLED)
+        other = container.borrow_object("other")
+        other.release()
+        time.sleep(0.05)
+        self.assertTrue(container.borrow_object("other").object is not other.object)
+        self.assertTrue(other.object in Resource.destroyed)
+
+        lease.release()
+        container.scopes[POOLED].destroy()
+        self.assertTrue(lease.object in Resource.destroyed)
+
+    def testMaxActive(self):
+        container = self._get_container(max_active=1)
+        lease = container.borrow_object("resource")
+        self.assertRaises(scope.PoolExhausted, container.borrow_object, "resource", 0.01)
+
+        borrowed = []
+        def borrow():
+            borrowed.append(container.borrow_object("resource").object)
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        pool = container.scopes[POOLED].pools["resource"]
+        while pool.stats()["waits"] < 2:
+            time.sleep(0.01)
+        self.assertEquals(borrowed, [])
+        lease.release()
+        thread.join()
+        self.assertEquals(borrowed, [lease.object])
+        self.assertEquals(container.scopes[POOLED].stats()["resource"]["waits"], 2)
+
+class DependencyGraphTestCase(unittest.TestCase):
+    """Test cases related to the dependency graph and the type index of ApplicationContext.
+    """
+
+    def _get_context(self):
+        def resource(id, scope=SINGLETON, refs=()):
+            object_def = ObjectDef(id=id, factory=CallableObjectFactory(Resource), scope=scope)
+            for ref in refs:
+                object_def.named_constr[ref] = ReferenceDef(ref, ref)
+            return object_def
+        del Resource.destroyed[:]
+        return ApplicationContext(ObjectDefsConfig([resource("registry"), resource("service", PROTOTYPE, ["registry"]),
+                                                    resource("client", refs=["service"]), resource("audit", refs=["client"])]))
+
+    def testDependencies(self):
+        ctx = self._get_context()
+        self.assertEquals(ctx.get_dependencies("client"), set(["service"]))
+        self.assertEquals(ctx.get_dependencies("client", transitive=True), set(["service", "registry"]))
+        self.assertEquals(ctx.get_dependents("registry"), set(["service"]))
+        self.assertEquals(ctx.get_dependents("registry", transitive=True), set(["service", "client", "audit"]))
+        self.assertEquals(ctx.get_dependents("audit"), set())
+
+        ctx.object_defs["late"] = ObjectDef(id="late", factory=CallableObjectFactory(Resource))
+        ctx.object_defs["late"].named_constr["registry"] = ReferenceDef("registry", "registry")
+        self.assertEquals(ctx.get_dependents("registry"), set(["service", "late"]))
+        del ctx.object_defs["late"]
+        self.assertEquals(ctx.get_dependents("registry"), set(["service"]))
+
+    def testShutdownDestroysDependentsFirst(self):
+        ctx = self._get_context()
+        ctx.shutdown_hook()
+        order = [ctx.objects["audit"], ctx.objects["client"], ctx.objects["registry"]]
+        self.assertEquals(Resource.destroyed, order)
+
+    def testShutdownFollowsReferencesInLists(self):
+        del Resource.destroyed[:]
+        defs = [ObjectDef(id=id, factory=CallableObjectFactory(Resource)) for id in ("a", "b", "c", "d")]
+        for object_def, dependency in zip(defs, defs[1:]):
+            object_def.named_constr["uses"] = ListDef("uses", [ReferenceDef(dependency.id, dependency.id)])
+        ctx = ApplicationContext(ObjectDefsConfig(defs))
+        ctx.shutdown_hook()
+        self.assertEquals(Resource.destroyed, [ctx.objects[id] for id in ("a", "b", "c", "d")])
+
+    def testTypeIndex(self):
+        ctx = self._get_context()
+        self.assertEquals(sorted(ctx.get_objects_by_type(Resource).keys()), ["audit", "client", "registry"])
+        self.assertEquals(sorted(ctx.get_objects_by_type(DisposableObject).keys()), ["audit", "client", "registry"])
+        self.assertEquals(ctx.get_objects_by_type(Resource, include_type=False), {})
+
+        ctx.object_defs["late"] = ObjectDef(id="late", factory=CallableObjectFactory(Resource))
+        late = ctx.get_object("late")
+        self.assertTrue(ctx.get_objects_by_type(Resource)["late"] is late)
+        ctx.objects["port"] = 8080
+        self.assertEquals(ctx.get_objects_by_type(int), {"port": 8080})
+        self.assertEquals(len(ctx.get_objects_by_type((Resource, int))), 5)
+
+REFRESH_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<objects xmlns="http://www.springframework.org/springpython/schema/objects">
+    <object id="finder" class="springpythontest.support.testSupportClasses.ColonMovieFinder">
+        <property name="filename"><value>%s</value></property>
+    </object>
+    <object id="lister" class="springpythontest.support.testSupportClasses.MovieLister">
+        <property name="finder" ref="finder"/>
+    </object>
+    <object id="holder" class="springpythontest.support.testSupportClasses.StringHolder">
+        <property name="str"><value>unchanged</value></property>
+    </object>
+    %s
+</objects>
+"""
+
+class RefreshTestCase(unittest.TestCase):
+    """Test cases related to reading configs again into a running ApplicationContext.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "refresh.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, movies, extra=""):
+        f = open(self.filename, "w")
+        f.write(REFRESH_XML % (movies, extra))
+        f.close()
+
+    def testOnlyChangedObjectsAreReplaced(self):
+        self._write("support/movies1.txt")
+        config = XMLConfig(self.filename)
+        self.assertRaises(Exception, ApplicationContext(config).refresh, config)
+        ctx = ApplicationContext(config, refreshable=True)
+        finder, lister, holder = ctx.get_object("finder"), ctx.get_object("lister"), ctx.get_object("holder")
+
+        self.assertEquals(ctx.refresh(config), [])
+        self.assertTrue(ctx.get_object("finder") is finder)
+
+        self._write("support/movies2.txt")
+        self.assertEquals(ctx.refresh([config]), ["finder", "lister"])
+        self.assertEquals(ctx.get_object("finder").filename, "support/movies2.txt")
+        self.assertTrue(ctx.get_object("lister").finder is ctx.get_object("finder"))
+        self.assertTrue(ctx.get_object("lister") is not lister)
+        self.assertTrue(ctx.get_object("holder") is holder)
+
+        self._write("support/movies2.txt", """<object id="extra" class="springpythontest.support.testSupportClasses.StringHolder"/>""")
+        self.assertEquals(ctx.refresh(config), ["extra"])
+        self.assertTrue("extra" in ctx.objects)
+        self._write("support/movies2.txt")
+        self.assertEquals(ctx.refresh(config), ["extra"])
+        self.assertTrue("extra" not in ctx.objects)
+        self.assertTrue("extra" not in ctx.object_defs)
+
+    def testDefinitionsUsedToCreateObjectsStayUnchanged(self):
+        self._write("support/movies1.txt", """<object id="holders" class="springpythontest.support.testSupportClasses.StringHolder">
+            <property name="str"><list><ref object="holder"/></list></property>
+        </object>""")
+        config = XMLConfig(self.filename)
+        ctx = ApplicationContext(config, refreshable=True)
+        holders = ctx.get_object("holders")
+        self.assertTrue(holders.str[0] is ctx.get_object("holder"))
+
+        self.assertEquals(ctx.refresh(config), [])
+        self.assertTrue(ctx.get_object("holders") is holders)
+
+    def testRefreshedObjectsArePostProcessedAndOldOnesDestroyed(self):
+        self._write("support/movies1.txt")
+        config = XMLConfig(self.filename)
+        resources = ObjectDefsConfig([ObjectDef(id="resource", factory=CallableObjectFactory(Resource))])
+        resources.object_defs[0].named_constr["finder"] = ReferenceDef("finder", "finder")
+
+        class Counter(ObjectPostProcessor):
+            processed = []
+            def post_process_after_initialization(self, obj, obj_name):
+                self.processed.append(obj_name)
+                return obj
+        counter = ObjectDefsConfig([ObjectDef(id="counter", factory=CallableObjectFactory(Counter))])
+
+        ctx = ApplicationContext([config, resources, counter], refreshable=True)
+        resource = ctx.get_object("resource")
+        del Resource.destroyed[:]
+        del Counter.processed[:]
+
+        self._write("support/movies2.txt")
+        self.assertEquals(ctx.refresh(config), ["finder", "lister", "resource"])
+        self.assertEquals(Resource.destroyed, [resource])
+        self.assertEquals(sorted(Counter.processed), ["finder", "lister", "resource"])
+
+class StreamingXMLConfigTestCase(unittest.TestCase):
+    """Test cases related to XMLConfig converting objects while parsing.
+    """
+
+    def testChildrenBeforeTheirParents(self):
+        config = XMLConfig(StringIO("""<?xml version="1.0" encoding="UTF-8"?>
+<objects xmlns="http://www.springframework.org/springpython/schema/objects/1.1">
+    <object id="first" class="springpythontest.support.testSupportClasses.StringHolder"/>
+    <object id="child" parent="middle">
+        <property name="str"><value>child</value></property>
+    </object>
+    <object id="middle" parent="root" abstract="True"/>
+    <str id="text">some text</str>
+    <object id="root" class="springpythontest.support.testSupportClasses.StringHolder" abstract="True">
+        <property name="str"><value>root</value></property>
+        <property name="extra"><value>inherited</value></property>
+    </object>
+</objects>"""))
+        object_defs = config.read_object_defs()
+        self.assertEquals([object_def.id for object_def in object_defs], ["first", "child", "middle", "text", "root"])
+
+        ctx = ApplicationContext(ObjectDefsConfig(object_defs))
+        child = ctx.get_object("child")
+        self.assertEquals((child.str, child.extra), ("child", "inherited"))
+        self.assertEquals(ctx.get_object("text"), "some text")
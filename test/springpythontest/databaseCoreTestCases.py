@@ -13,21 +13,40 @@
    See the License for the specific language governing permissions and
    limitations under the License.       
 """
+import array
 import logging
 import os
 import sys
+import threading
+import time
 import types
 import unittest
 from pmock import *
 from springpython.config import XMLConfig
 from springpython.context import ApplicationContext
 from springpython.database import ArgumentMustBeNamed
+from springpython.database import CannotGetConnectionException
 from springpython.database import DataAccessException
 from springpython.database import InvalidArgumentType
+from springpython.database.core import DaoSupport
 from springpython.database.core import DatabaseTemplate
 from springpython.database.core import DictionaryRowMapper
 from springpython.database.core import SimpleRowMapper
 from springpython.database import factory
+from springpython.database.asynchronous import AsyncDatabaseTemplate
+from springpython.database.asynchronous import AsyncTransactionTemplate
+from springpython.database.asynchronous import DatabaseExecutor
+from springpython.database.cache import QueryCache
+from springpython.database.cache import tables_read
+from springpython.database.cache import tables_written
+from springpython.database.instrumentation import CompositeQueryInstrumentation
+from springpython.database.instrumentation import NPlusOneDetector
+from springpython.database.instrumentation import QueryStatistics
+from springpython.database.instrumentation import fingerprint_sql
+from springpython.database.transaction import ConnectionFactoryTransactionManager
+from springpython.database.transaction import TransactionCallback
+from springpython.database.transaction import TransactionCallbackWithoutResult
+from springpython.database.transaction import TransactionTemplate
 from springpythontest.support import testSupportClasses
 
 logger = logging.getLogger("springpythontest.databaseCoreTestCases")
@@ -123,6 +142,43 @@ class ConnectionFactoryTestCase(MockTestCase):
 
         del(sys.modules["cx_Oracle"])
 
+    def testConvertingBindingVariablesLeavesLiteralsAndCommentsAlone(self):
+        sql = "SELECT '?', \"a?b\", name -- why?\n FROM animal /* 100%s ? */ WHERE name = ? AND category = %s AND id::text LIKE '%'"
+        self.assertEquals(factory.compile_sql_binding(sql, "format")[0],
+            "SELECT '?', \"a?b\", name -- why?\n FROM animal /* 100%s ? */ WHERE name = %s AND category = %s AND id::text LIKE '%'")
+        self.assertEquals(factory.compile_sql_binding(sql, "qmark")[0],
+            "SELECT '?', \"a?b\", name -- why?\n FROM animal /* 100%s ? */ WHERE name = ? AND category = ? AND id::text LIKE '%'")
+        self.assertEquals(factory.compile_sql_binding("SELECT 100%% FROM animal WHERE name = ?", "qmark")[0], "SELECT 100% FROM animal WHERE name = ?")
+
+    def testBackslashesEscapeQuotesInMySQLLiterals(self):
+        sql = "SELECT * FROM animal WHERE name LIKE 'it\\'s ?' AND category = ?"
+        self.assertEquals(factory.compile_sql_binding(sql, "format", backslash_escapes=True)[0],
+            "SELECT * FROM animal WHERE name LIKE 'it\\'s ?' AND category = %s")
+        self.assertEquals(factory.MySQLConnectionFactory().convert_sql_binding(sql),
+            "SELECT * FROM animal WHERE name LIKE 'it\\'s ?' AND category = %s")
+        self.assertEquals(factory.MySQLConnectionFactory(backslash_escapes=False).convert_sql_binding("SELECT 'C:\\' WHERE a = ?"),
+            "SELECT 'C:\\' WHERE a = %s")
+        self.assertEquals(factory.expand_binding(sql, 2, backslash_escapes=True),
+            "SELECT * FROM animal WHERE name LIKE 'it\\'s ?' AND category = ?, ?")
+
+    def testConvertingNamedBindingVariables(self):
+        sql = "SELECT * FROM animal WHERE name = :name AND category = :category AND time = '12:30'"
+        self.assertEquals(factory.compile_sql_binding(sql, "format", "pyformat"),
+            ("SELECT * FROM animal WHERE name = %(name)s AND category = %(category)s AND time = '12:30'", ()))
+        self.assertEquals(factory.compile_sql_binding(sql, "qmark", "named"), (sql, ()))
+        self.assertEquals(factory.compile_sql_binding(sql, "qmark", None),
+            ("SELECT * FROM animal WHERE name = ? AND category = ? AND time = '12:30'", ("name", "category")))
+
+    def testConvertedStatementsAreCached(self):
+        connection_factory = factory.SQLServerConnectionFactory()
+        sql, args = connection_factory.convert_sql_binding_args("SELECT * FROM animal WHERE name = :name AND category = :category",
+                                                                {"category":"reptile", "name":"snake"})
+        self.assertEquals(sql, "SELECT * FROM animal WHERE name = ? AND category = ?")
+        self.assertEquals(args, ("snake", "reptile"))
+        self.assertEquals(len(connection_factory.sql_cache), 1)
+        self.assertTrue(connection_factory.convert_sql_binding("SELECT * FROM animal WHERE name = :name AND category = :category") is sql)
+        self.assertEquals(connection_factory.convert_sql_binding("SELECT * FROM animal WHERE name = %s"), "SELECT * FROM animal WHERE name = ?")
+
 class DatabaseTemplateMockTestCase(MockTestCase):
     """Testing the DatabaseTemplate utilizes stubbing and mocking, in order to isolate from different
     vendor implementations. This reduces the overhead in making changes to core functionality."""
@@ -346,6 +402,165 @@ class DatabaseTemplateMockTestCase(MockTestCase):
         name = self.databaseTemplate.query_for_object("select name from animal where name = 'cottonmouth'", required_type=types.StringType)
         self.assertEquals(name, "cottonmouth")
 
+    def testProgrammaticQueryIterFetchesInChunks(self):
+        self.mock.description = [("name", None, None, None, None, None, None), ("category", None, None, None, None, None, None)]
+        self.mock.expects(once()).method("execute").id("#1")
+        self.mock.expects(once()).method("fetchmany").will(return_value([('snake', 'reptile'), ('racoon', 'mammal')])).id("#2").after("#1")
+        self.mock.expects(once()).method("fetchmany").will(return_value([('black mamba', 'kill_bill_viper')])).id("#3").after("#2")
+        self.mock.expects(once()).method("fetchmany").will(return_value([])).id("#4").after("#3")
+        self.mock.expects(once()).method("close").after("#4")
+
+        animals = self.databaseTemplate.query_iter("select name, category from animal", rowhandler=testSupportClasses.AnimalRowMapper(), fetch_size=2)
+        self.assertEquals([animal.name for animal in animals], ["snake", "racoon", "black mamba"])
+        self.assertEquals(self.mock.arraysize, 2)
+
+    def testProgrammaticQueryForIterClosesCursorWhenAbandoned(self):
+        self.mock.description = [("name", None, None, None, None, None, None)]
+        self.mock.expects(once()).method("execute").id("#1")
+        self.mock.expects(once()).method("fetchmany").will(return_value([('snake',), ('racoon',)])).id("#2").after("#1")
+        self.mock.expects(once()).method("close").after("#2")
+
+        rows = self.databaseTemplate.query_for_iter("select name from animal")
+        self.assertEquals(rows.next(), ('snake',))
+        rows.close()
+
+    def testProgrammaticQueryIterValidatesArgumentsEagerly(self):
+        self.assertRaises(ArgumentMustBeNamed, self.databaseTemplate.query_iter, "select * from animal", testSupportClasses.AnimalRowMapper())
+        self.assertRaises(InvalidArgumentType, self.databaseTemplate.query_for_iter, "select * from animal where name = ?", "snake")
+
+class QueryStatisticsTestCase(unittest.TestCase):
+    def testHistogramAndSlowQueries(self):
+        stats = QueryStatistics(slow_query_threshold=0.5, buckets=[0.1, 1.0])
+        stats.record("query", "select 1", 0.05, 0.01, 0.04, 1)
+        stats.record("query", "select 1", 0.7, 0.0, 0.7, 1)
+        stats.record("execute", "delete from t", 2.0, 0.0, 2.0, 5, error=Exception("boom"))
+
+        snapshot = stats.snapshot()
+        self.assertEquals(snapshot["slow_queries"], 2)
+        select = snapshot["statements"]["select 1"]
+        self.assertEquals(select["histogram"], [(0.1, 1), (1.0, 1), ("+inf", 0)])
+        self.assertEquals(select["max_time"], 0.7)
+        self.assertEquals(select["rows"], 2)
+        self.assertEquals(snapshot["statements"]["delete from t"]["errors"], 1)
+
+        stats.reset()
+        self.assertEquals(stats.snapshot(), {"statements": {}, "count": 0, "slow_queries": 0})
+
+    def testStatementsBeyondTheLimitAreAddedUp(self):
+        stats = QueryStatistics(max_statements=2)
+        for i in range(5):
+            stats.record("query", "select %s" % i, 0.0, 0.0, 0.0, 1)
+        statements = stats.snapshot()["statements"]
+        self.assertEquals(len(statements), 3)
+        self.assertEquals(statements[QueryStatistics.OTHER_STATEMENTS]["count"], 3)
+
+    def testDaoSupportPassesInstrumentationToItsTemplate(self):
+        stats = QueryStatistics()
+        dao = DaoSupport()
+        dao.instrumentation = stats
+        self.assertTrue(dao.database_template.instrumentation is stats)
+
+class NPlusOneDetectorTestCase(unittest.TestCase):
+    def testFingerprintsIgnoreLiteralsAndListLengths(self):
+        self.assertEquals(fingerprint_sql("SELECT * FROM pets WHERE owner_id = 12 AND name = 'Leo'"),
+                          fingerprint_sql("SELECT *  FROM pets WHERE owner_id = 7 AND name = 'Basil'"))
+        self.assertEquals(fingerprint_sql("SELECT * FROM pets WHERE id IN (1, 2, 3)"),
+                          fingerprint_sql("SELECT * FROM pets WHERE id IN (?)"))
+
+    def testRepeatedShapesAreReportedOnce(self):
+        detector = NPlusOneDetector(threshold=3)
+        detector.begin_request()
+        for i in range(5):
+            detector.record("query", "SELECT * FROM visits WHERE pet_id = ?", 0.0, 0.0, 0.0, 1, args=(i,))
+            detector.record("query", "SELECT * FROM owners", 0.0, 0.0, 0.0, 1)
+        findings = detector.end_request()
+        self.assertEquals(len(findings), 1)
+        self.assertEquals(findings[0]["count"], 5)
+        self.assertEquals(detector.end_request(), [])
+
+    def testNothingIsRecordedOutsideOfAUnitOfWork(self):
+        detector = NPlusOneDetector(threshold=3)
+        for i in range(5):
+            detector.record("query", "SELECT * FROM visits WHERE pet_id = ?", 0.0, 0.0, 0.0, 1, args=(i,))
+        detector.begin_request()
+        detector.record("query", "SELECT * FROM visits WHERE pet_id = ?", 0.0, 0.0, 0.0, 1, args=(5,))
+        self.assertEquals(detector.end_request(), [])
+
+    def testEachTransactionIsAUnitOfWork(self):
+        detector = NPlusOneDetector(threshold=3, raise_on_detection=True)
+        connection_factory = factory.Sqlite3ConnectionFactory(":memory:")
+        dt = DatabaseTemplate(connection_factory, instrumentation=detector)
+        tx_template = TransactionTemplate(ConnectionFactoryTransactionManager(connection_factory, units_of_work=[detector]))
+        def look_up(pet_ids):
+            class lookUpEachPet(TransactionCallbackWithoutResult):
+                def do_in_tx_without_result(s, status):
+                    for pet_id in pet_ids:
+                        dt.query_for_list("SELECT ? + 1", (pet_id,))
+            tx_template.execute(lookUpEachPet())
+
+        for i in range(3):
+            look_up([1, 2])
+        self.assertRaises(DataAccessException, look_up, [1, 2, 3])
+
+        # Within a request, transactions are part of it.
+        detector.begin_request()
+        look_up([1, 2])
+        self.assertRaises(DataAccessException, look_up, [3])
+        self.assertEquals(len(detector.end_request()), 1)
+
+    def testDetectionCanRaise(self):
+        detector = NPlusOneDetector(threshold=2, raise_on_detection=True)
+        detector.begin_request()
+        stats = QueryStatistics()
+        instrumentation = CompositeQueryInstrumentation([stats, detector])
+        instrumentation.record("query", "SELECT * FROM pets WHERE id = :id", 0.0, 0.0, 0.0, 1, args={"id": 1})
+        self.assertRaises(DataAccessException, instrumentation.record,
+                          "query", "SELECT * FROM pets WHERE id = :id", 0.0, 0.0, 0.0, 1, args={"id": 2})
+        self.assertEquals(stats.snapshot()["count"], 2)
+
+class QueryCacheTestCase(unittest.TestCase):
+    def testFindingTheTablesOfAStatement(self):
+        self.assertEquals(tables_read("""SELECT vets.id, specialties.name FROM vets, vet_specialties vs
+                                         JOIN specialties ON vs.specialty_id = specialties.id
+                                         WHERE vs.vet_id = ? AND name <> 'from nowhere'"""),
+                          set(["vets", "vet_specialties", "specialties"]))
+        self.assertEquals(tables_read("select * from (select id from main.\"Owners\") o"), set(["owners"]))
+        self.assertEquals(tables_written("SELECT * FROM pets"), set())
+        self.assertEquals(tables_written("insert into pets (name) values ('x')"), set(["pets"]))
+        self.assertEquals(tables_written("DELETE pets FROM pets JOIN owners ON owners.id = pets.owner_id"), set(["pets", "owners"]))
+        self.assertEquals(tables_written("call refresh_everything()"), None)
+
+    def testEntriesExpireAndAreInvalidatedByTable(self):
+        cache = QueryCache(ttl=60)
+        cache.put("select * from pets", None, ((1,),), [], cache.begin())
+        cache.put("select *   from\n owners where id = ?", (1,), ((2,),), [], cache.begin())
+        self.assertEquals(cache.get("select * from owners where id = ?", (1,))[0], ((2,),))
+        self.assertEquals(cache.get("select * from owners where id = ?", (2,)), None)
+
+        cache.invalidate("UPDATE pets SET name = 'x'")
+        self.assertEquals(cache.get("select * from pets", None), None)
+        self.assertNotEquals(cache.get("select * from owners where id = ?", (1,)), None)
+
+        cache.invalidate("{call refresh_everything()}")
+        self.assertEquals(cache.get("select * from owners where id = ?", (1,)), None)
+
+        cache.ttl = -1
+        cache.put("select * from pets", None, ((1,),), [], cache.begin())
+        self.assertEquals(cache.get("select * from pets", None), None)
+
+    def testResultsReadBeforeAWriteAreNotCached(self):
+        cache = QueryCache()
+        token = cache.begin()
+        cache.invalidate("delete from pets")
+        cache.put("select * from pets", None, ((1,),), [], token)
+        self.assertEquals(cache.get("select * from pets", None), None)
+
+    def testOnlyConfiguredQueriesAreCached(self):
+        cache = QueryCache(ttl=60, queries={"select * from vets": None, "select  * from pets": 0, "select * from types": 5})
+        for sql in ["select * from vets", "select * from pets", "select * from types", "select * from owners"]:
+            cache.put(sql, None, (), [], cache.begin())
+        self.assertEquals(sorted([key[0] for key in cache.entries.keys()]), ["select * from types", "select * from vets"])
+
 class AbstractDatabaseTemplateTestCase(unittest.TestCase):
     def __init__(self, methodName='runTest'):
         unittest.TestCase.__init__(self, methodName)
@@ -452,6 +667,183 @@ class AbstractDatabaseTemplateTestCase(unittest.TestCase):
         self.assertRaises(InvalidArgumentType, self.databaseTemplate.query_for_list, "select * from animal where name = %s", "snake")
         self.assertRaises(InvalidArgumentType, self.databaseTemplate.query_for_list, "select * from animal where name = ?", "snake")
 
+    def testRowMappersCompileEachResultSetShapeOnce(self):
+        mapper = DictionaryRowMapper()
+        first = self.databaseTemplate.query("select name, category from animal", rowhandler=mapper)
+        compiled = mapper._compiled
+        second = list(self.databaseTemplate.query_iter("select name, category from animal where population = ?", (1,), mapper))
+        self.assertTrue(mapper._compiled is compiled)
+        self.assertEquals(first[0], {"name":"snake", "category":"reptile"})
+        self.assertEquals(len(second), 3)
+
+    def testSimpleRowMapperHonorsPropertiesAndOverriddenMapRow(self):
+        class Pet(object):
+            def _set_name(self, name):
+                self.upper_name = name.upper()
+            name = property(fset=_set_name)
+        pets = self.databaseTemplate.query("select name, category from animal", rowhandler=SimpleRowMapper(Pet))
+        self.assertEquals(pets[0].upper_name, "SNAKE")
+        self.assertEquals(pets[0].category, "reptile")
+
+        class CountingRowMapper(DictionaryRowMapper):
+            def map_row(s, row, metadata=None):
+                return len(DictionaryRowMapper.map_row(s, row, metadata))
+        self.assertEquals(self.databaseTemplate.query("select name, category from animal", rowhandler=CountingRowMapper()), [2, 2, 2, 2])
+
+    def testProgrammaticQueryWithNamedArguments(self):
+        animals = self.databaseTemplate.query("select name, category from animal where name = :name", {"name":"snake"}, DictionaryRowMapper())
+        self.assertEquals(animals[0]["category"], "reptile")
+
+        animals = self.databaseTemplate.query("select name, category from animal where name = '?' or name = ?", ("racoon",), DictionaryRowMapper())
+        self.assertEquals(len(animals), 1)
+
+    def testProgrammaticQueryIter(self):
+        animals = self.databaseTemplate.query_iter("select name, category from animal", rowhandler=DictionaryRowMapper(), fetch_size=3)
+        self.assertEquals([animal["name"] for animal in animals], ["snake", "racoon", "black mamba", "cottonmouth"])
+
+    def testProgrammaticQueryForIterWithBoundArguments(self):
+        rows = list(self.databaseTemplate.query_for_iter("select name, category from animal where category = ?", ("kill_bill_viper",)))
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(rows[0][0], "black mamba")
+
+    def testProgrammaticQueryForIterWithBadSql(self):
+        self.assertRaises(DataAccessException, list, self.databaseTemplate.query_for_iter("select * from no_such_table"))
+
+    def testProgrammaticBatchUpdate(self):
+        self.databaseTemplate.execute("DELETE FROM animal")
+        animals = (("snake%s" % i, "reptile", i) for i in range(5))
+        rows = self.databaseTemplate.batch_update("INSERT INTO animal (name, category, population) VALUES (?, ?, ?)", animals, batch_size=2)
+        self.assertEquals(rows, [2, 2, 1])
+        self.assertEquals(self.databaseTemplate.query_for_int("SELECT count(*) FROM animal WHERE category = 'reptile'"), 5)
+
+        rows = self.databaseTemplate.batch_update("UPDATE animal SET population = %s WHERE name = %s", [(10, "snake0"), (10, "snake4")])
+        self.assertEquals(rows, [2])
+        self.assertEquals(self.databaseTemplate.query_for_int("SELECT sum(population) FROM animal"), 26)
+
+    def testProgrammaticBatchUpdateWithBoundArgumentsNotProperlyTuplized(self):
+        self.assertRaises(InvalidArgumentType, self.databaseTemplate.batch_update, "DELETE FROM animal WHERE name = ?", ["snake"])
+
+    def testInstrumentationRecordsEveryOperation(self):
+        stats = QueryStatistics()
+        self.databaseTemplate.instrumentation = stats
+        self.databaseTemplate.query_for_list("select name from animal")
+        self.databaseTemplate.query_for_list("select name from animal")
+        list(self.databaseTemplate.query_for_iter("select name from animal where category = ?", ("kill_bill_viper",)))
+        self.databaseTemplate.update("UPDATE animal SET population = 2 WHERE category = 'kill_bill_viper'")
+        self.databaseTemplate.batch_update("DELETE FROM animal WHERE name = ?", [("snake",), ("racoon",)])
+        self.assertRaises(DataAccessException, list, self.databaseTemplate.query_for_iter("select * from no_such_table"))
+
+        snapshot = stats.snapshot()
+        self.assertEquals(snapshot["count"], 6)
+        by_operation = dict([(s["operation"], s) for s in snapshot["statements"].values() if s["errors"] == 0])
+        self.assertEquals(by_operation["query"]["count"], 2)
+        self.assertEquals(by_operation["query"]["rows"], 8)
+        self.assertEquals(by_operation["query_iter"]["rows"], 2)
+        self.assertEquals(by_operation["execute"]["rows"], 2)
+        self.assertEquals(by_operation["batch_update"]["rows"], 2)
+        self.assertEquals(sum([count for bound, count in by_operation["query"]["histogram"]]), 2)
+        self.assertEquals(len([s for s in snapshot["statements"].values() if s["errors"] == 1]), 1)
+
+        self.databaseTemplate.instrumentation = None
+        self.databaseTemplate.query_for_list("select name from animal")
+        self.assertEquals(stats.snapshot()["count"], 6)
+
+    def testProgrammaticQueryColumns(self):
+        result = self.databaseTemplate.query_columns("select name, population from animal order by name", fetch_size=3)
+        self.assertEquals(result.names, ["name", "population"])
+        self.assertEquals(len(result), 4)
+        self.assertEquals(result["name"], ["black mamba", "cottonmouth", "racoon", "snake"])
+        self.assertEquals(result["population"], array.array("l", [1, 1, 0, 1]))
+        self.assertEquals(result[-1], ("snake", 1))
+
+        window = result[1:3]
+        self.assertTrue(window.columns is result.columns)
+        self.assertEquals(list(window), [("cottonmouth", 1), ("racoon", 0)])
+        self.assertEquals(window.as_dict(), {"name": ["cottonmouth", "racoon"], "population": array.array("l", [1, 0])})
+
+    def testProgrammaticQueryColumnsFallsBackToListsForNulls(self):
+        self.databaseTemplate.execute("INSERT INTO animal (name, category, population) VALUES ('unicorn', 'myth', NULL)")
+        result = self.databaseTemplate.query_columns("select population from animal order by population desc", fetch_size=2)
+        self.assertEquals(result["population"], [1, 1, 1, 0, None])
+
+        result = self.databaseTemplate.query_columns("select name, population from animal where name = ?", ("nobody",))
+        self.assertEquals((len(result), result["population"]), (0, []))
+
+        result = self.databaseTemplate.query_to_arrays("select population from animal where population is not null")
+        self.assertEquals(sorted(result["population"]), [0, 1, 1, 1])
+
+    def testQueryCacheReadsThroughAndIsInvalidatedByUpdates(self):
+        cache = QueryCache()
+        self.databaseTemplate.query_cache = cache
+        sql = "select name from animal where category = ? order by name"
+        self.assertEquals(len(self.databaseTemplate.query_for_list(sql, ("kill_bill_viper",))), 2)
+        self.assertEquals(len(self.databaseTemplate.query(sql, ("kill_bill_viper",), DictionaryRowMapper())), 2)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+        self.databaseTemplate.update("DELETE FROM animal WHERE name = ?", ("cottonmouth",))
+        self.assertEquals(len(self.databaseTemplate.query_for_list(sql, ("kill_bill_viper",))), 1)
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+        self.databaseTemplate.batch_update("INSERT INTO animal (name, category, population) VALUES (?, ?, ?)", [("sidewinder", "kill_bill_viper", 1)])
+        self.assertEquals(len(self.databaseTemplate.query_for_list(sql, ("kill_bill_viper",))), 2)
+
+    def testFailingQueriesMapToNoRowsWithEveryRowMapper(self):
+        for rowhandler in [DictionaryRowMapper(), SimpleRowMapper(testSupportClasses.Animal), testSupportClasses.SampleRowMapper()]:
+            self.assertEquals(self.databaseTemplate.query("SELECT * FROM nosuch", rowhandler=rowhandler), [])
+        self.assertEquals(self.databaseTemplate.batched_query("SELECT * FROM nosuch WHERE id IN (?)", [1, 2], rowhandler=DictionaryRowMapper()),
+                          {1: [], 2: []})
+
+    def testQueryManyRaisesFailingQueries(self):
+        self.assertRaises(DataAccessException, self.databaseTemplate.query_many,
+                          ["SELECT * FROM animal", ("SELECT * FROM nosuch", None, DictionaryRowMapper())])
+
+    def testQueryCacheIsBypassedInsideTransactions(self):
+        cache = QueryCache()
+        self.databaseTemplate.query_cache = cache
+        sql = "select name from animal where category = ?"
+        def vipers():
+            return [row[0] for row in self.databaseTemplate.query_for_list(sql, ("kill_bill_viper",))]
+
+        class insertThenRollBack(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                self.databaseTemplate.update("INSERT INTO animal (name, category, population) VALUES ('sidewinder', 'kill_bill_viper', 1)")
+                self.assertEquals(len(vipers()), 3)
+                # What another thread would cache while the transaction runs.
+                cache.put(sql, ("kill_bill_viper",), (("sidewinder",),), None, cache.begin())
+                status.set_rollback_only()
+        TransactionTemplate(ConnectionFactoryTransactionManager(self.factory)).execute(insertThenRollBack())
+
+        self.assertEquals(len(vipers()), 2)
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+
+    def testBatchedQuery(self):
+        detector = NPlusOneDetector(threshold=2, raise_on_detection=True)
+        self.databaseTemplate.instrumentation = detector
+        results = self.databaseTemplate.batched_query("select category, name from animal where population = ? and category in (?) order by name",
+                                                      ["kill_bill_viper", "reptile", "dragon", "kill_bill_viper"], (1,), batch_size=2)
+        self.assertEquals(results, {"kill_bill_viper": [("kill_bill_viper", "black mamba"), ("kill_bill_viper", "cottonmouth")],
+                                    "reptile": [("reptile", "snake")],
+                                    "dragon": []})
+
+        results = self.databaseTemplate.batched_query("select name, category from animal where category in (:keys) and population = :population",
+                                                      ["mammal", "reptile", "kill_bill_viper"], {"population": 0},
+                                                      DictionaryRowMapper(), key_column="category")
+        self.assertEquals(results, {"mammal": [{"name": "racoon", "category": "mammal"}], "reptile": [], "kill_bill_viper": []})
+        self.assertEquals(detector.end_request(), [])
+
+        self.assertRaises(DataAccessException, self.databaseTemplate.batched_query, "select * from animal", ["snake"])
+
+    def testBulkLoad(self):
+        def animals():
+            for i in range(25):
+                yield ("bulk %s" % i, "bulk\tload", i)
+            yield ("stray", None, None)
+
+        self.assertEquals(self.databaseTemplate.bulk_load("animal", ["name", "category", "population"], animals(), batch_size=10), 26)
+        self.assertEquals(self.databaseTemplate.query_for_int("select count(*) from animal where category = 'bulk\tload'"), 25)
+        self.assertEquals(self.databaseTemplate.query_for_int("select sum(population) from animal where category = 'bulk\tload'"), 300)
+        self.assertEquals(self.databaseTemplate.query_for_list("select category, population from animal where name = 'stray'"), [(None, None)])
+
     def testProgrammaticStaticQueryForInt(self):
         count = self.databaseTemplate.query_for_int("select population from animal where name = 'snake'")
         self.assertEquals(count, 1)
@@ -671,6 +1063,24 @@ class SqliteDatabaseTemplateTestCase(AbstractDatabaseTemplateTestCase):
             """)
             raise e
 
+    def testBulkLoadSplitsInsertsAndFallsBackFromTheNativeLoader(self):
+        class NativeLoadingFactory(factory.Sqlite3ConnectionFactory):
+            native_bulk_load = True
+            bulk_insert_max_parameters = 6
+            def _native_load(self, connection, table, columns, rows):
+                raise Exception("no COPY in sqlite")
+
+        connection_factory = NativeLoadingFactory(self.db_filename)
+        dt = DatabaseTemplate(connection_factory)
+        rows = [("bulk %s" % i, "bulk", i) for i in range(5)]
+        self.assertEquals(connection_factory.bulk_load("animal", ["name", "category", "population"], rows), 5)
+        self.assertFalse(connection_factory.native_bulk_load)
+        self.assertEquals(dt.query_for_int("select count(*) from animal where category = 'bulk'"), 5)
+        self.assertEquals(len([key for key in connection_factory.sql_cache.keys() if "INSERT" in key[2]]), 2)
+        connection_factory.rollback()
+
+        self.assertRaises(DataAccessException, connection_factory.bulk_load, "no_such_table", ["name"], [("x",)])
+
     def testIoCGeneralQuery(self):
         appContext = ApplicationContext(XMLConfig("support/databaseTestSqliteApplicationContext.xml"))
         factory = appContext.get_object("connection_factory")
@@ -819,3 +1229,336 @@ class SQLServerDatabaseTemplateTestCase(AbstractDatabaseTemplateTestCase):
         databaseTemplate = DatabaseTemplate(factory)
         results = databaseTemplate.query("select * from animal", rowhandler=testSupportClasses.SampleRowMapper())
         
+
+class PooledConnectionFactoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_filename = "springpython_pool.db"
+        try:
+            os.remove(self.db_filename)
+        except OSError:
+            pass
+        self.target = factory.Sqlite3ConnectionFactory(self.db_filename, check_same_thread=False)
+        dt = DatabaseTemplate(self.target)
+        dt.execute("""
+            CREATE TABLE animal (
+              id serial PRIMARY KEY,
+              name VARCHAR(11),
+              category VARCHAR(20),
+              population integer
+            )
+        """)
+        self.target.commit()
+        self.target.getConnection().close()
+
+    def tearDown(self):
+        try:
+            os.remove(self.db_filename)
+        except OSError:
+            pass
+
+    def testConnectionIsBoundToTheThreadUntilReleased(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=2)
+        conn = pool.getConnection()
+        self.assertTrue(pool.getConnection() is conn)
+        pool.releaseConnection(conn)
+        self.assertEquals(pool.get_idle_count(), 0)
+        pool.releaseConnection(conn)
+        self.assertEquals(pool.get_idle_count(), 1)
+        self.assertEquals(pool.get_pool_size(), 1)
+        self.assertTrue(pool.getConnection() is conn)
+
+    def testEachThreadGetsItsOwnConnection(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=3)
+        connections = []
+        holding = threading.Semaphore(0)
+        done = threading.Event()
+
+        def worker():
+            conn = pool.getConnection()
+            connections.append(conn)
+            holding.release()
+            done.wait()
+            pool.releaseConnection(conn)
+
+        threads = [threading.Thread(target=worker) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            holding.acquire()
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(set([id(conn) for conn in connections])), 3)
+        self.assertEquals(pool.get_pool_size(), 3)
+        self.assertEquals(pool.get_idle_count(), 3)
+
+    def testExhaustedPoolTimesOut(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=1, wait_timeout=0.1)
+        conn = pool.getConnection()
+        errors = []
+
+        def worker():
+            try:
+                pool.getConnection()
+            except CannotGetConnectionException, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        pool.releaseConnection(conn)
+        self.assertEquals(len(errors), 1)
+
+    def testInvalidConnectionsAreDiscardedOnCheckout(self):
+        pool = factory.PooledConnectionFactory(self.target, validation_query="SELECT 1")
+        conn = pool.getConnection()
+        pool.releaseConnection(conn)
+        conn.close()
+        fresh = pool.getConnection()
+        self.assertTrue(fresh is not conn)
+        self.assertEquals(pool.get_pool_size(), 1)
+        pool.releaseConnection(fresh)
+
+    def testIdleConnectionsAreEvictedDownToMinSize(self):
+        pool = factory.PooledConnectionFactory(self.target, min_size=1, max_idle_time=0)
+        first = pool.getConnection()
+        second = self._checkout_in_other_thread(pool)
+        pool.releaseConnection(first)
+        self.assertEquals(pool.get_pool_size(), 2)
+        conn = pool.getConnection()
+        self.assertEquals(pool.get_pool_size(), 1)
+        pool.releaseConnection(conn)
+
+    def _checkout_in_other_thread(self, pool):
+        connections = []
+        def worker():
+            connections.append(pool.getConnection())
+            pool.releaseConnection(connections[0])
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        return connections[0]
+
+    def testDatabaseTemplateAndTransactionsWithAPool(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=2)
+        dt = DatabaseTemplate(pool)
+        dt.execute("INSERT INTO animal (name) VALUES (?)", ('black mamba',))
+        self.assertEquals(len(dt.query_for_list("SELECT * FROM animal")), 1)
+
+        class txDefinition(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                dt.execute("INSERT INTO animal (name) VALUES (?)", ('copperhead',))
+                self.assertEquals(pool.get_idle_count(), 0)
+                raise DataAccessException("This should rollback the insert.")
+
+        tx_template = TransactionTemplate(ConnectionFactoryTransactionManager(pool))
+        self.assertRaises(DataAccessException, tx_template.execute, txDefinition())
+        self.assertEquals(len(dt.query_for_list("SELECT * FROM animal")), 1)
+        self.assertEquals(pool.get_pool_size(), 1)
+
+    def testConnectionsCheckedOutWhenClosingAreClosedOnReturn(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=2)
+        connection = pool.getConnection()
+        pool.close()
+        self.assertEquals(pool.get_pool_size(), 1)
+
+        pool.releaseConnection(connection)
+        self.assertEquals((pool.get_pool_size(), pool.get_idle_count()), (0, 0))
+        self.assertRaises(Exception, connection.cursor)
+        self.assertRaises(CannotGetConnectionException, pool.getConnection)
+
+    def testStatementCacheReusesCursorsPerConnection(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=1, statement_cache_size=2)
+        dt = DatabaseTemplate(pool)
+        for i in range(5):
+            dt.update("INSERT INTO animal (name, population) VALUES (?, ?)", ("animal%s" % i, i))
+            dt.query_for_int("SELECT count(*) FROM animal")
+        self.assertEquals(pool.get_statement_cache_stats(), {"prepares": 2, "hits": 8})
+
+        dt.query_for_list("SELECT name FROM animal")
+        dt.query_for_int("SELECT count(*) FROM animal")
+        self.assertEquals(pool.get_statement_cache_stats(), {"prepares": 3, "hits": 9})
+
+        rows = dt.query_for_iter("SELECT name FROM animal", fetch_size=1)
+        rows.next()
+        rows.close()
+        self.assertEquals(list(dt.query_for_iter("SELECT name FROM animal")), [("animal%s" % i,) for i in range(5)])
+        self.assertEquals(pool.get_statement_cache_stats(), {"prepares": 4, "hits": 10})
+
+        pool.close()
+        self.assertEquals(pool.statement_caches, {})
+
+    def testQueryManyRunsQueriesAtTheSameTime(self):
+        class SleepyFactory(factory.Sqlite3ConnectionFactory):
+            def connect(self):
+                connection = factory.Sqlite3ConnectionFactory.connect(self)
+                connection.create_function("sleep", 1, time.sleep)
+                return connection
+        pool = factory.PooledConnectionFactory(SleepyFactory(self.db_filename, check_same_thread=False), max_size=3)
+        dt = DatabaseTemplate(pool)
+        dt.update("INSERT INTO animal (name, population) VALUES ('snake', 1)")
+
+        start = time.time()
+        results = dt.query_many(["SELECT sleep(0.2), 1",
+                                 ("SELECT sleep(0.2), name FROM animal WHERE name = ?", ("snake",)),
+                                 ("SELECT sleep(0.2), population FROM animal", None, DictionaryRowMapper())])
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(results, [[(None, 1)], [(None, "snake")], [{"sleep(0.2)": None, "population": 1}]])
+
+        class BrokenRowMapper(DictionaryRowMapper):
+            def map_row(self, row, metadata=None):
+                raise ValueError("can't map %s" % (row,))
+        self.assertRaises(DataAccessException, dt.query_many, ["SELECT 1", ("SELECT name FROM animal", None, BrokenRowMapper())])
+        self.assertRaises(DataAccessException, dt.query_many, ["SELECT 1", "SELECT * FROM nosuch"])
+
+        executor = pool.get_executor()
+        self.assertEquals(DatabaseTemplate(pool).query_many(["SELECT 1", "SELECT 2"]), [[(1,)], [(2,)]])
+        self.assertTrue(pool.get_executor() is executor)
+        pool.close()
+        self.assertEquals(pool.get_executor(), None)
+        self.assertRaises(RuntimeError, executor.submit, len, ())
+
+    def testQueryManyJoinsTheCurrentTransaction(self):
+        pool = factory.PooledConnectionFactory(self.target, max_size=3)
+        dt = DatabaseTemplate(pool)
+        class insertAndCount(TransactionCallback):
+            def do_in_transaction(s, status):
+                dt.update("INSERT INTO animal (name, population) VALUES ('snake', 1)")
+                return dt.query_many(["SELECT count(*) FROM animal", "SELECT name FROM animal"])
+        results = TransactionTemplate(ConnectionFactoryTransactionManager(pool)).execute(insertAndCount())
+        self.assertEquals(results, [[(1,)], [("snake",)]])
+        self.assertEquals(dt.fan_out_executor, None)
+        pool.close()
+
+class RoutingConnectionFactoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.factories = {}
+        for name in ["primary", "replica1", "replica2"]:
+            db_filename = "springpython_%s.db" % name
+            try:
+                os.remove(db_filename)
+            except OSError:
+                pass
+            self.factories[name] = factory.Sqlite3ConnectionFactory(db_filename)
+            dt = DatabaseTemplate(self.factories[name])
+            dt.execute("CREATE TABLE whoami (name VARCHAR(10))")
+            dt.execute("INSERT INTO whoami (name) VALUES (?)", (name,))
+            self.factories[name].commit()
+        self.router = factory.RoutingConnectionFactory(self.factories["primary"], [self.factories["replica1"], self.factories["replica2"]])
+        self.dt = DatabaseTemplate(self.router)
+
+    def tearDown(self):
+        for name, connection_factory in self.factories.items():
+            connection_factory.getConnection().close()
+            os.remove("springpython_%s.db" % name)
+
+    def whoami(self):
+        return self.dt.query_for_object("SELECT name FROM whoami", required_type=types.UnicodeType)
+
+    def testReadsAreSpreadOverReplicasAndWritesGoToThePrimary(self):
+        self.assertEquals(sorted([self.whoami() for i in range(4)]), ["replica1", "replica1", "replica2", "replica2"])
+        self.dt.execute("UPDATE whoami SET name = 'written'")
+        self.router.commit()
+        self.assertEquals(self.factories["primary"].getConnection().execute("SELECT name FROM whoami").fetchall(), [("written",)])
+
+    def testReadsStickToThePrimaryAfterAWriteUntilTheRequestEnds(self):
+        self.dt.update("UPDATE whoami SET name = 'primary2'")
+        self.assertEquals([self.whoami() for i in range(3)], ["primary2"] * 3)
+        self.router.end_request()
+        self.assertTrue(self.whoami().startswith("replica"))
+
+        self.router.sticky_seconds = 0
+        self.dt.update("UPDATE whoami SET name = 'primary3'")
+        time.sleep(0.01)
+        self.assertTrue(self.whoami().startswith("replica"))
+
+    def testWritesWhileReadingFromAReplicaGoToThePrimary(self):
+        for row in self.dt.query_for_iter("SELECT name FROM whoami"):
+            self.dt.update("INSERT INTO whoami (name) VALUES (?)", ("copy of %s" % row[0],))
+        self.router.commit()
+
+        names = {}
+        for name, connection_factory in self.factories.items():
+            names[name] = [row[0] for row in connection_factory.getConnection().execute("SELECT name FROM whoami ORDER BY name").fetchall()]
+        self.assertEquals(len(names["primary"]), 2)
+        self.assertTrue(names["primary"][0].startswith("copy of replica"))
+        self.assertEquals(names["replica1"], ["replica1"])
+        self.assertEquals(names["replica2"], ["replica2"])
+
+    def testTransactionsStayOnOneFactory(self):
+        tx_manager = ConnectionFactoryTransactionManager(self.router)
+        seen = []
+        class readTwice(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                seen.append((self.whoami(), self.whoami()))
+
+        read_only = TransactionTemplate(tx_manager)
+        read_only.setTxAttributes(["PROPAGATION_REQUIRED", "read_only"])
+        read_only.execute(readTwice())
+        TransactionTemplate(tx_manager).execute(readTwice())
+        self.router.end_request()
+
+        self.assertEquals(seen[0][0], seen[0][1])
+        self.assertTrue(seen[0][0].startswith("replica"))
+        self.assertEquals(seen[1], ("primary", "primary"))
+
+    def testFailingReplicasFallBackToThePrimary(self):
+        class BrokenFactory(factory.Sqlite3ConnectionFactory):
+            def connect(self):
+                raise Exception("replica is down")
+        self.router.replicas = [BrokenFactory()]
+        self.assertEquals(self.whoami(), "primary")
+
+class AsyncDatabaseTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_filename = "springpython_async.db"
+        try:
+            os.remove(self.db_filename)
+        except OSError:
+            pass
+        self.factory = factory.PooledConnectionFactory(factory.Sqlite3ConnectionFactory(self.db_filename, check_same_thread=False), max_size=3)
+        self.databaseTemplate = AsyncDatabaseTemplate(self.factory)
+        self.databaseTemplate.execute("CREATE TABLE animal (id serial PRIMARY KEY, name VARCHAR(11), population integer)").result()
+
+    def tearDown(self):
+        self.databaseTemplate.executor.shutdown()
+        self.factory.close()
+        os.remove(self.db_filename)
+
+    def testManyCallsInFlightShareAFewWorkers(self):
+        threads_before = threading.activeCount()
+        futures = [self.databaseTemplate.update("INSERT INTO animal (name, population) VALUES (?, ?)", ("animal%s" % i, i)) for i in range(100)]
+        self.assertTrue(threading.activeCount() <= threads_before + 3)
+        self.assertEquals(sum([future.result() for future in futures]), 100)
+
+        total = self.databaseTemplate.query_for_int("SELECT sum(population) FROM animal")
+        animals = self.databaseTemplate.query("SELECT name FROM animal WHERE population < ?", (2,), rowhandler=DictionaryRowMapper())
+        self.assertEquals(total.result(), 4950)
+        self.assertEquals(sorted([animal["name"] for animal in animals.result()]), ["animal0", "animal1"])
+
+    def testErrorsAreRaisedByTheFuture(self):
+        future = self.databaseTemplate.query_for_list("SELECT * FROM no_such_table")
+        self.assertEquals(future.result(), [])
+        future = self.databaseTemplate.execute("INSERT INTO no_such_table VALUES (1)")
+        self.assertRaises(DataAccessException, future.result)
+        self.assertTrue(isinstance(future.exception(), DataAccessException))
+
+    def testTransactionsRunInOneWorker(self):
+        tx_template = AsyncTransactionTemplate(ConnectionFactoryTransactionManager(self.factory), self.databaseTemplate.executor)
+        databaseTemplate = self.databaseTemplate
+        class insertThenFail(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                databaseTemplate.update("INSERT INTO animal (name, population) VALUES ('ghost', 1)").result()
+                raise DataAccessException("changed my mind")
+        self.assertRaises(DataAccessException, tx_template.execute(insertThenFail()).result)
+        self.assertEquals(self.databaseTemplate.query_for_int("SELECT count(*) FROM animal").result(), 0)
+
+    def testExecutorRunsWorkInSubmissionOrderWithOneWorker(self):
+        executor = DatabaseExecutor()
+        seen = []
+        futures = [executor.submit(seen.append, i) for i in range(10)]
+        [future.result() for future in futures]
+        executor.shutdown()
+        self.assertEquals(seen, range(10))
+        self.assertRaises(RuntimeError, executor.submit, seen.append, 10)
@@ -16,6 +16,7 @@
 import logging
 import os
 import subprocess
+import threading
 import types
 import unittest
 from springpython.context import ApplicationContext
@@ -26,6 +27,7 @@ from springpython.database.transaction import ConnectionFactoryTransactionManage
 from springpython.database.transaction import TransactionTemplate
 from springpython.database.transaction import TransactionCallback
 from springpython.database.transaction import TransactionCallbackWithoutResult
+from springpython.database.transaction import TransactionException
 from springpython.database.transaction import TransactionPropagationException
 from springpythontest.support.testSupportClasses import DatabaseTxTestAppContext
 from springpythontest.support.testSupportClasses import DatabaseTxTestDecorativeTransactions
@@ -117,6 +119,16 @@ class AbstractTransactionTestCase(unittest.TestCase):
         self.assertRaises(DataAccessException, self.transactionTemplate.execute, txDefinition())
         self.assertEquals(len(self.dt.query_for_list("SELECT * FROM animal")), 0)
 
+    def testBatchUpdateInsideATransactionIsRolledBack(self):
+        class txDefinition(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                self.dt.batch_update("INSERT INTO animal (name) VALUES (?)", [('black mamba',), ('copperhead',)])
+                self.assertEquals(len(self.dt.query_for_list("SELECT * FROM animal")), 2)
+                raise DataAccessException("This should break the transaction, and rollback the inserts.")
+
+        self.assertRaises(DataAccessException, self.transactionTemplate.execute, txDefinition())
+        self.assertEquals(len(self.dt.query_for_list("SELECT * FROM animal")), 0)
+
     def testDeclarativeTransactions(self):
         appContext = ApplicationContext(DatabaseTxTestAppContext(self.factory))
         bank = appContext.get_object("bank")
@@ -381,6 +393,183 @@ class AbstractTransactionTestCase(unittest.TestCase):
         self.assertEquals(bank.balance("Savings"), 225.00, "Bad transfer did NOT fail atomically!")
         self.assertEquals(bank.balance("Checking"), -60.00, "Bad transfer did NOT fail as expected (not atomically due to lack of AutoTransactionalObject)")
        
+class RecordingConnection(object):
+    def __init__(self, log):
+        self.log = log
+
+    def cursor(self):
+        return RecordingCursor(self.log)
+
+    def commit(self):
+        self.log.append("COMMIT")
+
+    def rollback(self):
+        self.log.append("ROLLBACK")
+
+class RecordingCursor(object):
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, sql, args = None):
+        self.log.append(sql)
+
+    def close(self):
+        pass
+
+class RecordingConnectionFactory(factory.ConnectionFactory):
+    """Records the statements, commits and rollbacks the transaction manager sends to its connection."""
+    def __init__(self):
+        factory.ConnectionFactory.__init__(self, [types.TupleType])
+        self.log = []
+
+    def connect(self):
+        return RecordingConnection(self.log)
+
+    def in_transaction(self):
+        return True
+
+class TransactionManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.factory = RecordingConnectionFactory()
+        self.tx_manager = ConnectionFactoryTransactionManager(self.factory)
+
+    def template(self, *tx_attributes):
+        tx_template = TransactionTemplate(self.tx_manager)
+        tx_template.setTxAttributes(tx_attributes)
+        return tx_template
+
+    def run_in(self, tx_template, action):
+        class callback(TransactionCallback):
+            def do_in_transaction(s, status):
+                return action(status)
+        return tx_template.execute(callback())
+
+    def testNestedTransactionsUseSavepoints(self):
+        def fail(status):
+            self.factory.log.append("work")
+            raise DataAccessException("inner failure")
+
+        def outer(status):
+            self.assertRaises(DataAccessException, self.run_in, self.template("PROPAGATION_NESTED"), fail)
+            self.run_in(self.template("PROPAGATION_NESTED"), lambda status: None)
+
+        self.run_in(self.template("PROPAGATION_REQUIRED"), outer)
+        self.assertEquals(self.factory.log, ["COMMIT",
+                                             "SAVEPOINT SPRINGPYTHON_SAVEPOINT_1", "work",
+                                             "ROLLBACK TO SAVEPOINT SPRINGPYTHON_SAVEPOINT_1", "RELEASE SAVEPOINT SPRINGPYTHON_SAVEPOINT_1",
+                                             "SAVEPOINT SPRINGPYTHON_SAVEPOINT_2", "RELEASE SAVEPOINT SPRINGPYTHON_SAVEPOINT_2",
+                                             "COMMIT"])
+
+    def testReadOnlyTransactionsRollBackInsteadOfCommitting(self):
+        def write(status):
+            self.factory.log.append("UPDATE")
+        self.run_in(self.template("PROPAGATION_REQUIRED", "read_only"), write)
+        self.assertEquals(self.factory.log, ["COMMIT", "UPDATE", "ROLLBACK"])
+        self.assertEquals(self.tx_manager.get_current_transaction(), None)
+
+    def testReadOnlyTransactionsOnAPoolNeverCommit(self):
+        pool = factory.PooledConnectionFactory(self.factory)
+        self.tx_manager = ConnectionFactoryTransactionManager(pool)
+        self.run_in(self.template("PROPAGATION_REQUIRED", "read_only"), lambda status: None)
+        self.assertEquals(self.factory.log, ["ROLLBACK"])
+        self.assertEquals(pool.get_idle_count(), 1)
+
+    def testSettingRollbackOnly(self):
+        self.run_in(self.template("PROPAGATION_REQUIRED"), lambda status: status.set_rollback_only())
+        self.assertEquals(self.factory.log, ["COMMIT", "ROLLBACK"])
+
+    def testParticipatingTransactionMarkedRollbackOnlyFailsTheOuterCommit(self):
+        def outer(status):
+            self.run_in(self.template("PROPAGATION_REQUIRED"), lambda status: status.set_rollback_only())
+        self.assertRaises(TransactionException, self.run_in, self.template("PROPAGATION_REQUIRED"), outer)
+        self.assertEquals(self.factory.log, ["COMMIT", "ROLLBACK"])
+
+    def testRequiresNewNeedsAPooledConnectionFactory(self):
+        def outer(status):
+            self.run_in(self.template("PROPAGATION_REQUIRES_NEW"), lambda status: None)
+        self.assertRaises(TransactionPropagationException, self.run_in, self.template("PROPAGATION_REQUIRED"), outer)
+        self.assertEquals(self.tx_manager.get_current_transaction(), None)
+
+    def testTransactionsAreBoundToTheirThread(self):
+        in_outer = threading.Event()
+        seen = []
+        def other_thread():
+            in_outer.wait()
+            seen.append(self.tx_manager.get_current_transaction())
+            try:
+                self.run_in(self.template("PROPAGATION_MANDATORY"), lambda status: None)
+            except TransactionPropagationException:
+                seen.append("outside")
+
+        def outer(status):
+            in_outer.set()
+            thread.join()
+            self.assertTrue(self.tx_manager.get_current_transaction() is status)
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        self.run_in(self.template("PROPAGATION_REQUIRED"), outer)
+        self.assertEquals(seen, [None, "outside"])
+
+class PooledSqliteTransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_filename = "springpython_tx_pool.db"
+        if os.path.exists(self.db_filename):
+            os.remove(self.db_filename)
+        self.factory = factory.PooledConnectionFactory(factory.Sqlite3ConnectionFactory(self.db_filename, check_same_thread=False), max_size=4)
+        self.dt = DatabaseTemplate(self.factory)
+        self.dt.execute("CREATE TABLE animal (id serial PRIMARY KEY, name VARCHAR(11))")
+        self.tx_manager = ConnectionFactoryTransactionManager(self.factory)
+
+    def tearDown(self):
+        self.factory.close()
+        os.remove(self.db_filename)
+
+    def template(self, propagation):
+        tx_template = TransactionTemplate(self.tx_manager)
+        tx_template.setTxAttributes([propagation])
+        return tx_template
+
+    def insert(self, name):
+        class callback(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                self.dt.execute("INSERT INTO animal (name) VALUES (?)", (name,))
+        return callback()
+
+    def testRequiresNewCommitsIndependentlyOfTheOuterTransaction(self):
+        class outer(TransactionCallbackWithoutResult):
+            def do_in_tx_without_result(s, status):
+                self.template("PROPAGATION_REQUIRES_NEW").execute(self.insert("inner"))
+                self.dt.execute("INSERT INTO animal (name) VALUES (?)", ("outer",))
+                raise DataAccessException("outer failure")
+
+        self.assertRaises(DataAccessException, self.template("PROPAGATION_REQUIRED").execute, outer())
+        self.assertEquals(self.dt.query_for_list("SELECT name FROM animal"), [("inner",)])
+        self.assertEquals(self.factory.get_idle_count(), self.factory.get_pool_size())
+
+    def testConcurrentTransactionsDoNotInterfere(self):
+        errors = []
+        def work(name, fail):
+            class callback(TransactionCallbackWithoutResult):
+                def do_in_tx_without_result(s, status):
+                    for i in range(5):
+                        self.dt.execute("INSERT INTO animal (name) VALUES (?)", ("%s%s" % (name, i),))
+                    if fail:
+                        raise DataAccessException("rolling back %s" % name)
+            try:
+                self.template("PROPAGATION_REQUIRED").execute(callback())
+            except DataAccessException, e:
+                errors.append(name)
+
+        threads = [threading.Thread(target=work, args=("ok%s" % i, i % 2)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sorted(errors), ["ok1", "ok3"])
+        names = [row[0] for row in self.dt.query_for_list("SELECT name FROM animal")]
+        self.assertEquals(sorted(names), sorted(["ok%s%s" % (t, i) for t in (0, 2) for i in range(5)]))
+
 class MySQLTransactionTestCase(AbstractTransactionTestCase):
 
     def __init__(self, methodName='runTest'):
@@ -18,6 +18,7 @@ import logging
 import unittest
 
 from springpython.util import TRACE1
+from springpython.util import LRUCache
 
 class TraceLoggingLevelTestCase(unittest.TestCase):
     """Testing the TRACE1 level is correctly defined."""
@@ -25,3 +26,38 @@ class TraceLoggingLevelTestCase(unittest.TestCase):
     def test_trace(self):
         self.assertEqual(TRACE1, 6)
         self.assertEqual(logging.getLevelName(TRACE1), "TRACE1")
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_discarded(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("b" not in cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_put_pop_and_clear(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("a", 10)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.pop("a"), 10)
+        self.assertEqual(cache.pop("a", "missing"), "missing")
+        cache.put("b", 2)
+        cache.clear()
+        self.assertEqual(cache.get("b"), None)
+        cache.put("c", 3)
+        self.assertEqual(cache.keys(), ["c"])
+
+    def test_evicted_entries_are_handed_to_on_evict(self):
+        evicted = []
+        cache = LRUCache(max_size=1, on_evict=lambda key, value: evicted.append((key, value)))
+        cache.put("a", 1)
+        cache.put("a", 2)
+        cache.put("b", 3)
+        cache.pop("b")
+        self.assertEqual(evicted, [("a", 2)])
@@ -0,0 +1,83 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+########################################################################
+# This is a stand-alone benchmark, comparing DatabaseTemplate.batch_update
+# against issuing one DatabaseTemplate.update per row, on a sqlite3 file.
+#
+# % python batch_update_benchmark.py [number of rows]
+########################################################################
+
+import os
+import sys
+import time
+from springpython.database.core import DatabaseTemplate
+from springpython.database.factory import Sqlite3ConnectionFactory
+
+DB_FILENAME = "batch_update_benchmark.db"
+INSERT = "INSERT INTO animal (name, category, population) VALUES (?, ?, ?)"
+
+def rows(count):
+    for i in xrange(count):
+        yield ("animal%s" % i, "category%s" % (i % 10), i)
+
+def setup():
+    try:
+        os.remove(DB_FILENAME)
+    except OSError:
+        pass
+    factory = Sqlite3ConnectionFactory(DB_FILENAME)
+    dt = DatabaseTemplate(factory)
+    dt.execute("""
+        CREATE TABLE animal (
+          id serial PRIMARY KEY,
+          name VARCHAR(20),
+          category VARCHAR(20),
+          population integer
+        )
+    """)
+    factory.commit()
+    return factory, dt
+
+def row_at_a_time(dt, count):
+    for args in rows(count):
+        dt.update(INSERT, args)
+
+def batched(dt, count, batch_size):
+    dt.batch_update(INSERT, rows(count), batch_size=batch_size)
+
+def run(label, func, *args):
+    factory, dt = setup()
+    start = time.time()
+    func(dt, *args)
+    factory.commit()
+    elapsed = time.time() - start
+    print "%-30s %8.3f s  %10.0f rows/s" % (label, elapsed, args[0] / elapsed)
+    return elapsed
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 100000
+
+    print "Inserting %s rows into sqlite3" % count
+    baseline = run("update() row at a time", row_at_a_time, count)
+    for batch_size in [100, 1000, 10000]:
+        elapsed = run("batch_update(batch_size=%s)" % batch_size, batched, count, batch_size)
+        print "%-30s %8.1fx" % ("", baseline / elapsed)
+
+    os.remove(DB_FILENAME)
@@ -0,0 +1,87 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+########################################################################
+# This is a stand-alone benchmark of ObjectContainer.get_object, measuring
+# how many lookups per second it serves for a singleton that exists already,
+# and for a prototype built with a reflective factory, two constructor
+# arguments, a reference and a list property. The same object is then
+# declared POOLED, and borrowed and given back instead.
+#
+# % python container_benchmark.py [number of calls]
+########################################################################
+
+import sys
+import time
+from springpython.config import ListDef
+from springpython.config import ObjectDef
+from springpython.config import ReferenceDef
+from springpython.config import ValueDef
+from springpython.container import ObjectContainer
+from springpython.context.scope import POOLED
+from springpython.context.scope import PROTOTYPE
+from springpython.factory import ReflectiveObjectFactory
+
+class Service(object):
+    def __init__(self, host = None, port = None):
+        self.host = host
+        self.port = port
+        self.names = None
+        self.registry = None
+
+class Registry(object):
+    pass
+
+def build_container():
+    container = ObjectContainer()
+    container.object_defs["registry"] = ObjectDef(id="registry", factory=ReflectiveObjectFactory("__main__.Registry"))
+
+    service = ObjectDef(id="service", factory=ReflectiveObjectFactory("__main__.Service"), scope=PROTOTYPE,
+                        props=[ReferenceDef("registry", "registry"), ListDef("names", ["a", "b", "c"])])
+    service.pos_constr = [ValueDef(None, "localhost")]
+    service.named_constr = {"port": ValueDef("port", 8080)}
+    container.object_defs["service"] = service
+
+    pooled = ObjectDef(id="pooled", factory=service.factory, scope=POOLED, props=service.props)
+    pooled.pos_constr = service.pos_constr
+    pooled.named_constr = service.named_constr
+    container.object_defs["pooled"] = pooled
+    return container
+
+def measure(container, name, calls):
+    get_object = container.get_object
+    start = time.time()
+    for i in xrange(calls):
+        get_object(name)
+    return calls / (time.time() - start)
+
+def measure_pooled(container, name, calls):
+    borrow_object = container.borrow_object
+    start = time.time()
+    for i in xrange(calls):
+        borrow_object(name).release()
+    return calls / (time.time() - start)
+
+if __name__ == "__main__":
+    calls = 200000
+    if len(sys.argv) > 1:
+        calls = int(sys.argv[1])
+
+    container = build_container()
+    container.get_object("registry")
+    print "singleton: %10.0f get_object calls per second" % measure(container, "registry", calls)
+    print "prototype: %10.0f get_object calls per second" % measure(container, "service", calls)
+    print "pooled:    %10.0f borrow_object calls per second" % measure_pooled(container, "pooled", calls)
@@ -0,0 +1,119 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+########################################################################
+# This is a stand-alone benchmark, comparing the compiled DictionaryRowMapper
+# and SimpleRowMapper against the per-row metadata loops they replaced,
+# on a wide sqlite3 result set.
+#
+# % python row_mapper_benchmark.py [number of rows] [number of columns]
+########################################################################
+
+import os
+import sys
+import time
+from springpython.database.core import DatabaseTemplate
+from springpython.database.core import DictionaryRowMapper
+from springpython.database.core import RowMapper
+from springpython.database.core import SimpleRowMapper
+from springpython.database.factory import Sqlite3ConnectionFactory
+
+DB_FILENAME = "row_mapper_benchmark.db"
+
+class LoopingDictionaryRowMapper(RowMapper):
+    """The original DictionaryRowMapper, walking the metadata for every row."""
+    def map_row(self, row, metadata=None):
+        obj = {}
+        for i, column in enumerate(metadata):
+            obj[column["name"]] = row[i]
+        return obj
+
+class LoopingSimpleRowMapper(RowMapper):
+    """The original SimpleRowMapper, walking the metadata for every row."""
+    def __init__(self, clazz):
+        self.clazz = clazz
+
+    def map_row(self, row, metadata=None):
+        obj = self.clazz()
+        for i, column in enumerate(metadata):
+            setattr(obj, column["name"], row[i])
+        return obj
+
+class Record(object):
+    pass
+
+def setup(count, width):
+    try:
+        os.remove(DB_FILENAME)
+    except OSError:
+        pass
+    factory = Sqlite3ConnectionFactory(DB_FILENAME)
+    dt = DatabaseTemplate(factory)
+    columns = ["col%s" % i for i in range(width)]
+    dt.execute("CREATE TABLE wide (%s)" % ", ".join(["%s integer" % column for column in columns]))
+    insert = "INSERT INTO wide VALUES (%s)" % ", ".join(["?"] * width)
+    dt.batch_update(insert, (tuple(range(i, i + width)) for i in xrange(count)))
+    factory.commit()
+    return dt
+
+def run(dt, label, mapper):
+    """Time the whole query, fetching included."""
+    start = time.time()
+    rows = dt.query("SELECT * FROM wide", rowhandler=mapper)
+    elapsed = time.time() - start
+    print "%-30s %8.3f s  %10.0f rows/s" % (label, elapsed, len(rows) / elapsed)
+    return elapsed
+
+def run_mapping_only(rows, metadata, label, mapper):
+    """Time the mapping of rows already fetched, the way DatabaseTemplate.query does it."""
+    start = time.time()
+    if hasattr(mapper, "compile_row_mapper"):
+        map_row = mapper.compile_row_mapper(metadata)
+        [map_row(row) for row in rows]
+    else:
+        [mapper.map_row(row, metadata) for row in rows]
+    elapsed = time.time() - start
+    print "%-30s %8.3f s  %10.0f rows/s" % (label, elapsed, len(rows) / elapsed)
+    return elapsed
+
+if __name__ == "__main__":
+    count, width = 50000, 40
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        width = int(sys.argv[2])
+
+    dt = setup(count, width)
+    mappers = [("dictionary, per-row loop", LoopingDictionaryRowMapper()),
+               ("DictionaryRowMapper", DictionaryRowMapper()),
+               ("object, per-row loop", LoopingSimpleRowMapper(Record)),
+               ("SimpleRowMapper", SimpleRowMapper(Record))]
+
+    print "Querying and mapping %s rows of %s columns" % (count, width)
+    for i in range(0, len(mappers), 2):
+        before = run(dt, *mappers[i])
+        after = run(dt, *mappers[i + 1])
+        print "%-30s %8.1fx" % ("", before / after)
+
+    print "Mapping only"
+    rows = dt.query_for_list("SELECT * FROM wide")
+    metadata = [{"name":"col%s" % i} for i in range(width)]
+    for i in range(0, len(mappers), 2):
+        before = run_mapping_only(rows, metadata, *mappers[i])
+        after = run_mapping_only(rows, metadata, *mappers[i + 1])
+        print "%-30s %8.1fx" % ("", before / after)
+
+    os.remove(DB_FILENAME)
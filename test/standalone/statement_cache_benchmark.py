@@ -0,0 +1,123 @@
+"""
+   Copyright 2006-2008 SpringSource (http://springsource.com), All Rights Reserved
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+########################################################################
+# This is a stand-alone benchmark, comparing a PooledConnectionFactory with
+# and without its per-connection statement cache.
+#
+# sqlite3 has no server-side prepare, so the connections are wrapped by a
+# stand-in driver that behaves like cx_Oracle: a cursor parses a statement
+# when it is prepared, or when it executes a different statement than the
+# last one. Each parse costs parse_cost seconds of CPU, standing in for the
+# server's parse.
+#
+# % python statement_cache_benchmark.py [number of calls] [parse cost in microseconds]
+########################################################################
+
+import sys
+import time
+from springpython.database.core import DatabaseTemplate
+from springpython.database.factory import PooledConnectionFactory
+from springpython.database.factory import Sqlite3ConnectionFactory
+
+class StandInCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.connection.cursor()
+        self.statement = None
+
+    def prepare(self, sql):
+        if sql != self.statement:
+            self.connection.parse(sql)
+            self.statement = sql
+
+    def execute(self, sql, args = ()):
+        self.prepare(sql)
+        return self.cursor.execute(sql, args)
+
+    def executemany(self, sql, seq_of_args):
+        self.prepare(sql)
+        return self.cursor.executemany(sql, seq_of_args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class StandInConnection(object):
+    def __init__(self, connection, parse_cost):
+        self.connection = connection
+        self.parse_cost = parse_cost
+        self.parses = 0
+
+    def parse(self, sql):
+        self.parses += 1
+        deadline = time.clock() + self.parse_cost
+        while time.clock() < deadline:
+            pass
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+class StandInConnectionFactory(Sqlite3ConnectionFactory):
+    def __init__(self, db, parse_cost):
+        Sqlite3ConnectionFactory.__init__(self, db)
+        self.parse_cost = parse_cost
+        self.connections = []
+
+    def connect(self):
+        connection = StandInConnection(Sqlite3ConnectionFactory.connect(self), self.parse_cost)
+        self.connections.append(connection)
+        return connection
+
+def run(label, count, parse_cost, statement_cache_size):
+    """The pool holds a single in-memory database connection, so the table is created on it."""
+    target = StandInConnectionFactory(":memory:", parse_cost)
+    pool = PooledConnectionFactory(target, max_size=1, statement_cache_size=statement_cache_size)
+    dt = DatabaseTemplate(pool)
+    dt.execute("CREATE TABLE owners (id integer PRIMARY KEY, first_name VARCHAR(30), last_name VARCHAR(30))")
+    dt.batch_update("INSERT INTO owners VALUES (?, ?, ?)", ((i, "first%s" % i, "last%s" % i) for i in range(100)))
+    for connection in target.connections:
+        connection.parses = 0
+
+    start = time.time()
+    for i in xrange(count):
+        dt.query_for_list("SELECT first_name, last_name FROM owners WHERE id = ?", (i % 100,))
+        dt.update("UPDATE owners SET last_name = ? WHERE id = ?", ("last%s" % i, i % 100))
+    elapsed = time.time() - start
+    pool.close()
+    parses = sum([connection.parses for connection in target.connections])
+    print "%-25s %8.3f s  %10.0f calls/s  %8s parses" % (label, elapsed, 2 * count / elapsed, parses)
+    return elapsed
+
+if __name__ == "__main__":
+    count, parse_cost = 20000, 50
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        parse_cost = int(sys.argv[2])
+
+    print "%s queries and %s updates, %s microseconds per parse" % (count, count, parse_cost)
+    before = run("no statement cache", count, parse_cost / 1000000.0, 0)
+    after = run("statement cache", count, parse_cost / 1000000.0, 10)
+    print "%-25s %8.1fx" % ("", before / after)